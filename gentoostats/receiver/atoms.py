@@ -0,0 +1,130 @@
+"""
+Fast, cached atom parsing for ingestion.
+
+Constructing a portage.dep.Atom is expensive, and the receiver parses the same
+strings (e.g. "=sys-libs/glibc-2.37-r3") over and over again. parse_atom()
+handles the plain shapes sent by the client ("=cat/pkg-ver[:slot][::repo]" and
+"cat/pkg[:slot][::repo]") with a regular expression, falls back to portage for
+everything else, and keeps the results in a bounded LRU cache.
+"""
+
+import re
+import logging
+from collections import namedtuple
+
+from portage.dep import Atom as PortageAtom
+
+from django.conf import settings
+
+from gentoostats.stats.util import LRUCache
+
+logger = logging.getLogger(__name__)
+
+ATOM_CACHE_SIZE = getattr(settings, 'GENTOOSTATS_ATOM_CACHE_SIZE', 50000)
+
+# See PMS, section 3.1 ("Restrictions upon names"):
+_CATEGORY = r'[A-Za-z0-9_][A-Za-z0-9+_.-]*'
+_PACKAGE  = r'[A-Za-z0-9_][A-Za-z0-9+_-]*'
+_VERSION  = r'\d+(?:\.\d+)*[a-z]?(?:_(?:alpha|beta|pre|rc|p)\d*)*(?:-r\d+)?'
+_SLOT     = r'[A-Za-z0-9_][A-Za-z0-9+_.-]*'
+_REPO     = r'[A-Za-z0-9_][A-Za-z0-9_-]*'
+
+_SUFFIX   = r'(?::(?P<slot>%s)(?:/(?P<sub_slot>%s))?)?(?:::(?P<repo>%s))?$' \
+            % (_SLOT, _SLOT, _REPO)
+
+VERSIONED_ATOM_RE = re.compile(
+    r'^=(?P<category>%s)/(?P<package_name>%s)-(?P<version>%s)' \
+    % (_CATEGORY, _PACKAGE, _VERSION) + _SUFFIX
+)
+
+UNVERSIONED_ATOM_RE = re.compile(
+    r'^(?P<category>%s)/(?P<package_name>%s)' % (_CATEGORY, _PACKAGE) + _SUFFIX
+)
+
+# A package name must not end in something that looks like a version:
+VERSION_SUFFIX_RE = re.compile(r'-%s$' % _VERSION)
+
+class ParsedAtom(namedtuple( 'ParsedAtom'
+                           , 'operator category package_name version slot repo'
+)):
+    """
+    The parts of an atom that are stored in the database. 'version' is '' for
+    atoms without a version, 'slot' and 'repo' are None if not given.
+    """
+
+    __slots__ = ()
+
+    @property
+    def cp(self):
+        return "%s/%s" % (self.category, self.package_name)
+
+    @property
+    def cpv(self):
+        if self.version:
+            return "%s-%s" % (self.cp, self.version)
+        return self.cp
+
+_cache = LRUCache(ATOM_CACHE_SIZE)
+
+def _parse_fast(atom):
+    """
+    Parse 'atom' with a regular expression, or return None if it has an
+    unusual shape.
+    """
+
+    match = VERSIONED_ATOM_RE.match(atom) or UNVERSIONED_ATOM_RE.match(atom)
+    if not match:
+        return None
+
+    package_name = match.group('package_name')
+    if VERSION_SUFFIX_RE.search(package_name):
+        return None
+
+    version = match.groupdict().get('version') or ''
+
+    return ParsedAtom( operator     = '=' if version else ''
+                     , category     = match.group('category')
+                     , package_name = package_name
+                     , version      = version
+                     , slot         = match.group('slot')
+                     , repo         = match.group('repo')
+    )
+
+def _parse_portage(atom):
+    """
+    Parse 'atom' with portage. Raises InvalidAtom.
+    """
+
+    patom = PortageAtom(atom, allow_wildcard=False, allow_repo=True)
+    category, package_name = patom.cp.split('/')
+
+    return ParsedAtom( operator     = patom.operator or ''
+                     , category     = category
+                     , package_name = package_name
+                       # cpv = cp + '-' + version (+ revision):
+                     , version      = patom.cpv[len(patom.cp) + 1:]
+                     , slot         = patom.slot
+                     , repo         = patom.repo
+    )
+
+def parse_atom(atom):
+    """
+    Return a ParsedAtom for 'atom'.
+
+    Raises InvalidAtom (like portage.dep.Atom) if the atom is invalid. Invalid
+    atoms are not cached.
+    """
+
+    result = _cache.get(atom)
+    if result is not None:
+        return result
+
+    result = _parse_fast(atom)
+    if result is None:
+        result = _parse_portage(atom)
+
+    _cache.set(atom, result)
+    return result
+
+def clear_cache():
+    _cache.clear()
@@ -0,0 +1,75 @@
+"""
+Shared GeoIP country lookups.
+
+Creating a GeoIP object opens (and possibly reads) the database files under
+GEOIP_PATH, so the receiver keeps a single memory-mapped instance per process
+and caches the country of recently seen IP addresses.
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.gis.geoip import GeoIP
+
+from gentoostats.stats.util import LRUCache
+
+logger = logging.getLogger(__name__)
+
+GEOIP_CACHE_SIZE = getattr(settings, 'GENTOOSTATS_GEOIP_CACHE_SIZE', 10000)
+
+# See GeoIP.cache_options:
+GEOIP_MMAP_CACHE = 8
+
+# Cached for addresses without a known country, to tell them apart from misses:
+_UNKNOWN = object()
+
+class CountryResolver(object):
+    def __init__(self, max_size=GEOIP_CACHE_SIZE):
+        self._geoip = None
+        self._lock  = threading.Lock()
+        self._cache = LRUCache(max_size)
+
+    def _get_geoip(self):
+        with self._lock:
+            if self._geoip is None:
+                self._geoip = GeoIP(cache=GEOIP_MMAP_CACHE)
+
+            return self._geoip
+
+    def country_name(self, ip_addr):
+        """
+        Return the country name of 'ip_addr', or None if it is unknown.
+        """
+
+        country = self._cache.get(ip_addr)
+
+        if country is None:
+            try:
+                country = self._get_geoip().country_name(ip_addr)
+            except Exception as e:
+                # Don't reject submissions because of a broken GeoIP setup:
+                logger.error("country_name(): %s" % e, exc_info=True)
+                return None
+
+            if country is None:
+                country = _UNKNOWN
+
+            self._cache.set(ip_addr, country)
+
+        return None if country is _UNKNOWN else country
+
+    def clear(self):
+        self._cache.clear()
+
+_resolver = None
+def get_resolver():
+    """
+    Return the process-wide CountryResolver object.
+    """
+
+    global _resolver
+    if _resolver is None:
+        _resolver = CountryResolver()
+
+    return _resolver
@@ -0,0 +1,878 @@
+"""
+Batched ingestion of stats submissions.
+
+Each stage parses its whole section first, then resolves all referenced lookup
+rows with a few IN (...) queries and writes the missing rows (and M2M links)
+with bulk_create(). This keeps the number of queries per submission roughly
+constant, no matter how many packages a host reports.
+"""
+
+import json
+import time
+import logging
+from datetime import datetime
+from collections import defaultdict
+
+from portage.exception import InvalidAtom
+from portage._sets import SETPREFIX as SET_PREFIX
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.utils.timezone import utc
+
+from .util import BadRequestException
+from .atoms import parse_atom
+from .geoip import get_resolver
+from .metrics import stage, set_package_count
+from .validation import validate_submission, validate_packages
+from .stream import parse_stream, iter_batches, StreamError, \
+                    MAX_SUBMISSION_SIZE
+from gentoostats.stats.util import chunked, validate_new_item, \
+                                   get_or_create_many, add_relations, \
+                                   bulk_create_or_fallback
+from gentoostats.stats.interning import feature_cache, useflag_cache, \
+                                        keyword_cache, mirror_cache, \
+                                        lang_cache, sync_cache, discard_staged
+from gentoostats.stats.rollups import update_rollups
+from gentoostats.stats.useflags import COMPACT_USE_FLAGS, flag_numbers, \
+                                       encode_flags
+from gentoostats.stats.versions import version_key
+from gentoostats.stats.models import *
+
+logger = logging.getLogger(__name__)
+
+CURRENT_PROTOCOL_VERSION = 3
+
+# Decode the PACKAGES section incrementally (see stream.py):
+STREAMING_PARSER = getattr(settings, 'GENTOOSTATS_STREAMING_PARSER', True)
+
+# Version 2 submissions list all installed packages. Version 3 submissions only
+# list the packages added or changed (PACKAGES) and removed (REMOVED) since the
+# submission with the id BASE; everything else is copied from that submission.
+SUPPORTED_PROTOCOL_VERSIONS = (2, 3)
+
+# Attempts at ingesting a submission whose transaction deadlocks with (or, on
+# PostgreSQL, can't be serialized with) a concurrent one:
+MAX_ATTEMPTS = 3
+DEADLOCK_MESSAGES = ('deadlock', 'could not serialize access')
+
+# Composite keys used to match parsed packages against existing rows:
+def _package_key(p):
+    return (p['category'], p['package_name'], p['version'], p['slot'], p['repo'])
+
+def _parse_int(value, package, name):
+    """
+    Convert an optional numeric string to an int ('' -> None).
+    """
+
+    if value in (None, ''):
+        return None
+
+    try:
+        return int(value)
+    except (TypeError, ValueError) as e:
+        error_message = "Error: Invalid %s for package '%s'." % (name, package)
+        logger.info("_parse_int(): " + error_message, exc_info=True)
+        raise BadRequestException(error_message)
+
+def parse_package(package, info):
+    """
+    Parse a single PACKAGES entry into a dict of plain values.
+
+    Nothing is looked up in the database here.
+    """
+
+    try:
+        atom = parse_atom("=" + package)
+    except InvalidAtom as e:
+        error_message = "Error: Atom '%s' failed validation." % package
+        logger.info("parse_package(): " + error_message, exc_info=True)
+        raise BadRequestException(error_message)
+
+    keyword = info.get('KEYWORD')
+    if not keyword:
+        error_message = "Error: Package '%s' has no KEYWORD." % package
+        logger.info("parse_package(): " + error_message)
+        raise BadRequestException(error_message)
+
+    built_at = info.get('BUILD_TIME')
+    if not built_at:
+        # Sometimes clients report BUILD_TIME as ''.
+        built_at = None
+    else:
+        try:
+            built_at = datetime.utcfromtimestamp(float(built_at))
+        except (TypeError, ValueError) as e:
+            error_message = "Error: Invalid BUILD_TIME for '%s'." % package
+            logger.info("parse_package(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+
+        built_at = built_at.replace(tzinfo=utc)
+
+    p = dict(
+        atom         = package,
+
+        category     = atom.category,
+        package_name = atom.package_name,
+        version      = atom.version,
+        slot         = atom.slot,
+        repo         = atom.repo or info.get('REPO') or None,
+
+        keyword        = keyword,
+        built_at       = built_at,
+        build_duration = _parse_int(info.get('BUILD_DURATION'), package, 'BUILD_DURATION'),
+        size           = _parse_int(info.get('SIZE'), package, 'SIZE'),
+
+        iuse   = info.get('IUSE')   or [],
+        pkguse = info.get('PKGUSE') or [],
+        use    = info.get('USE')    or [],
+    )
+
+    return p
+
+def add_state_hashes(parsed):
+    """
+    Add the state hash to packages parsed by parse_package(), once they have
+    passed validate_packages() (which makes sure that the USE flags are lists).
+    """
+
+    for p in parsed:
+        p['state_hash'] = installation_state_hash(
+            p['category'], p['package_name'], p['version'], p['slot'], p['repo'],
+            p['keyword'], p['built_at'], p['build_duration'], p['size'],
+            p['iuse'], p['pkguse'], p['use'],
+        )
+
+def _fetch_packages(keys):
+    """
+    Return a dict mapping package keys to Package IDs for the existing rows.
+    """
+
+    result = dict()
+
+    # A chunk of keys needs 2 * len(chunk) query parameters at most:
+    for chunk in chunked(keys, 200):
+        cps      = set("%s/%s" % (k[0], k[1]) for k in chunk)
+        versions = set(k[2] for k in chunk)
+
+        rows = Package.objects.order_by()\
+                .filter(cp__in=cps, version__in=versions)\
+                .values_list('id', 'cp', 'version', 'slot', 'repository')
+
+        for id, cp, version, slot, repo in rows:
+            category, package_name = cp.split('/', 1)
+            result[(category, package_name, version, slot, repo)] = id
+
+    return result
+
+def resolve_packages(parsed):
+    """
+    Set p['package_id'] for every parsed package, creating missing Package rows
+    (and their categories, package names and repositories) in bulk.
+    """
+
+    categories = get_or_create_many(
+        Category, (p['category'] for p in parsed)
+    )
+    package_names = get_or_create_many(
+        PackageName, (p['package_name'] for p in parsed)
+    )
+    repositories = get_or_create_many(
+        Repository, (p['repo'] for p in parsed)
+    )
+
+    for p in parsed:
+        p['repo'] = repositories[p['repo']].pk if p['repo'] else None
+
+    keys = set(_package_key(p) for p in parsed)
+    packages = _fetch_packages(keys)
+
+    missing = []
+    for key in keys:
+        if key in packages:
+            continue
+
+        category, package_name, version, slot, repo = key
+        package = Package( category        = categories[category]
+                         , package_name    = package_names[package_name]
+                         , version         = version
+                         , slot            = slot
+                         , repository_id   = repo
+
+                           # bulk_create() does not call Package.save():
+                         , cp              = "%s/%s" % (category, package_name)
+                         , version_key     = version_key(version)
+        )
+
+        validate_new_item(package)
+        missing.append(package)
+
+    if missing:
+        bulk_create_or_fallback(
+            Package, missing,
+            lambda p: Package.objects.get_or_create(
+                category     = p.category,
+                package_name = p.package_name,
+                version      = p.version,
+                slot         = p.slot,
+                repository   = p.repository,
+            )
+        )
+
+        packages.update(_fetch_packages(set(keys) - set(packages)))
+
+    for p in parsed:
+        p['package_id'] = packages[_package_key(p)]
+
+def _fetch_installations(hashes):
+    """
+    Return a dict mapping state hashes to Installation IDs for the existing
+    rows.
+    """
+
+    result = dict()
+
+    for chunk in chunked(hashes):
+        rows = Installation.objects.order_by()\
+                .filter(state_hash__in=chunk)\
+                .values_list('state_hash', 'id')
+
+        result.update(rows)
+
+    return result
+
+def create_installations(parsed):
+    """
+    Create Installation rows (and their USE flag links, or packed USE flags)
+    for parsed packages that have no matching installation yet. Sets
+    p['installation_id'].
+    """
+
+    resolve_packages(parsed)
+
+    keywords = keyword_cache.get_or_create_many(p['keyword'] for p in parsed)
+
+    if COMPACT_USE_FLAGS:
+        numbers = flag_numbers(
+            u for p in parsed for u in p['iuse'] + p['pkguse'] + p['use']
+        )
+
+    # Identical packages of the same submission share an installation:
+    installations = dict()
+    for p in parsed:
+        if p['state_hash'] in installations:
+            continue
+
+        installation = Installation( package_id     = p['package_id']
+                                   , keyword        = keywords[p['keyword']]
+                                   , built_at       = p['built_at']
+                                   , build_duration = p['build_duration']
+                                   , size           = p['size']
+                                   , state_hash     = p['state_hash']
+        )
+
+        if COMPACT_USE_FLAGS:
+            installation.packed_iuse   = encode_flags(p['iuse'],   numbers)
+            installation.packed_pkguse = encode_flags(p['pkguse'], numbers)
+            installation.packed_use    = encode_flags(p['use'],    numbers)
+
+        validate_new_item(installation)
+        installations[p['state_hash']] = installation
+
+    # Installations created by a concurrent submission in the meantime already
+    # have their USE flags, so they must not get them again:
+    created = set(installations)
+
+    def fallback(installation):
+        values = dict( (f.attname, getattr(installation, f.attname))
+                       for f in Installation._meta.local_fields
+                       if not f.primary_key and f.name != 'state_hash'
+        )
+
+        _, was_created = Installation.objects.get_or_create(
+            state_hash = installation.state_hash,
+            defaults   = values,
+        )
+        if not was_created:
+            created.discard(installation.state_hash)
+
+    bulk_create_or_fallback(Installation, installations.values(), fallback)
+
+    ids = _fetch_installations(installations)
+    for p in parsed:
+        p['installation_id'] = ids[p['state_hash']]
+
+    if COMPACT_USE_FLAGS:
+        return
+
+    parsed = [p for p in parsed if p['state_hash'] in created]
+
+    useflags = useflag_cache.get_or_create_many(
+        u for p in parsed for u in p['iuse'] + p['pkguse'] + p['use']
+    )
+
+    for field in ('iuse', 'pkguse', 'use'):
+        add_relations(
+            Installation, field,
+            ( (p['installation_id'], useflags[u].pk)
+              for p in parsed for u in set(p[field]) if u
+            ),
+            check_existing = False,
+        )
+
+def ingest_packages(packages):
+    """
+    Ingest (a batch of) the PACKAGES section of a submission, given as a list
+    of (package, info) pairs.
+
+    Returns the IDs of the matching Installation rows.
+    """
+
+    if not packages:
+        return []
+
+    parsed = [parse_package(k, v) for k, v in packages]
+    validate_packages(parsed)
+    add_state_hashes(parsed)
+
+    # Known installations are matched by their state hash alone. Their USE
+    # flags are part of the hash, so there is nothing else to write for them.
+    existing = _fetch_installations(p['state_hash'] for p in parsed)
+
+    missing = []
+    for p in parsed:
+        if p['state_hash'] in existing:
+            p['installation_id'] = existing[p['state_hash']]
+        else:
+            missing.append(p)
+
+    if missing:
+        create_installations(missing)
+
+    return [p['installation_id'] for p in parsed]
+
+def _fetch_package_ids_by_cpv(atoms):
+    """
+    Return the IDs of all Package rows matching 'atoms' (REMOVED entries):
+    their cpv, and also their slot and repository where they have one.
+    """
+
+    # (cp, version) -> [(slot, repository)], where None matches anything:
+    cpvs = defaultdict(list)
+    for entry in atoms:
+        try:
+            atom = parse_atom("=" + entry)
+        except InvalidAtom as e:
+            error_message = "Error: Atom '%s' failed validation." % entry
+            logger.info("_fetch_package_ids_by_cpv(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+
+        cpvs[(atom.cp, atom.version)].append((atom.slot, atom.repo))
+
+    def matches(cp, version, slot, repo):
+        return any( s in (None, slot) and r in (None, repo)
+                    for s, r in cpvs.get((cp, version), [])
+        )
+
+    result = set()
+
+    for chunk in chunked(cpvs, 200):
+        cps      = set(cp for cp, _ in chunk)
+        versions = set(version for _, version in chunk)
+
+        rows = Package.objects.order_by()\
+                .filter(cp__in=cps, version__in=versions)\
+                .values_list('id', 'cp', 'version', 'slot', 'repository__name')
+
+        result.update( id for id, cp, version, slot, repo in rows
+                       if matches(cp, version, slot, repo)
+        )
+
+    return result
+
+def _fetch_package_ids(installation_ids):
+    """
+    Return the IDs of the packages of 'installation_ids'.
+    """
+
+    result = set()
+    for chunk in chunked(installation_ids):
+        result.update(
+            Installation.objects.order_by().filter(pk__in=chunk)\
+                    .values_list('package', flat=True)
+        )
+
+    return result
+
+def base_installation_ids(base, excluded_package_ids):
+    """
+    Return the IDs of the installations of the 'base' submission, except for
+    the installations of 'excluded_package_ids' (changed or removed packages).
+    """
+
+    rows = Installation.objects.order_by()\
+            .filter(installation_sets=base.installation_set_id)\
+            .values_list('id', 'package')
+
+    return set(id for id, package_id in rows
+                  if package_id not in excluded_package_ids)
+
+def get_installation_set(installation_ids):
+    """
+    Return the InstallationSet of 'installation_ids' (or None if there are no
+    installations), creating it if necessary.
+
+    Unchanged systems map to an existing set, so they cost a single query.
+    """
+
+    if not installation_ids:
+        return None
+
+    state_hash = installation_set_hash(installation_ids)
+
+    try:
+        return InstallationSet.objects.get(state_hash=state_hash)
+    except InstallationSet.DoesNotExist as e:
+        pass
+
+    sid = transaction.savepoint()
+    try:
+        installation_set = InstallationSet.objects.create(state_hash=state_hash)
+        transaction.savepoint_commit(sid)
+    except IntegrityError as e:
+        # A concurrent submission has created the same set in the meantime:
+        transaction.savepoint_rollback(sid)
+        return InstallationSet.objects.get(state_hash=state_hash)
+
+    add_relations(
+        InstallationSet, 'installations',
+        ((installation_set.pk, i) for i in installation_ids),
+        check_existing = False,
+    )
+
+    return installation_set
+
+def create_atoms(entries):
+    """
+    Create the missing Atom rows (and their categories, package names and
+    repositories) for world set entries in bulk.
+
+    Atoms are identified by the entries themselves, so there's nothing to
+    return.
+    """
+
+    parsed = dict((e, parse_atom(e)) for e in set(entries))
+    if not parsed:
+        return
+
+    existing = set()
+    for chunk in chunked(parsed):
+        existing.update(
+            Atom.objects.order_by().filter(full_atom__in=chunk)\
+                    .values_list('full_atom', flat=True)
+        )
+
+    missing = [(e, a) for e, a in parsed.items() if e not in existing]
+    if missing:
+        categories = get_or_create_many(
+            Category, (a.category for _, a in missing)
+        )
+        package_names = get_or_create_many(
+            PackageName, (a.package_name for _, a in missing)
+        )
+        repositories = get_or_create_many(
+            Repository, (a.repo for _, a in missing)
+        )
+
+        atoms = []
+        for entry, a in missing:
+            atom = Atom( full_atom     = entry
+                       , operator      = a.operator
+                       , category      = categories[a.category]
+                       , package_name  = package_names[a.package_name]
+                       , version       = a.version
+                       , slot          = a.slot
+                       , repository    = repositories[a.repo] if a.repo else None
+            )
+
+            validate_new_item(atom)
+            atoms.append(atom)
+
+        bulk_create_or_fallback(
+            Atom, atoms,
+            lambda atom: Atom.objects.get_or_create(
+                full_atom  = atom.full_atom,
+                defaults   = dict( operator     = atom.operator
+                                 , category     = atom.category
+                                 , package_name = atom.package_name
+                                 , version      = atom.version
+                                 , slot         = atom.slot
+                                 , repository   = atom.repository
+                            ),
+            )
+        )
+
+def ingest_worldset(submission, reported_sets):
+    """
+    Ingest the WORLDSET section of a (new) submission.
+
+    All sets of the submission, including the ones that are only referenced
+    as subsets, are created in one go. Atoms are resolved in bulk, and the
+    atoms, subsets and reported_sets links are written with bulk inserts.
+    All values have been checked by validate_submission() already.
+    """
+
+    if not reported_sets:
+        return
+
+    set_names = set(reported_sets)
+    atom_entries = []
+
+    for entries in reported_sets.values():
+        for entry in entries:
+            if entry.startswith(SET_PREFIX):
+                set_names.add(entry[len(SET_PREFIX):])
+            else:
+                atom_entries.append(entry)
+
+    create_atoms(atom_entries)
+
+    atom_sets = [AtomSet(name=n, owner=submission) for n in set_names]
+    for atom_set in atom_sets:
+        validate_new_item(atom_set)
+
+    # The submission is new, so nobody else can create its sets concurrently:
+    for chunk in chunked(atom_sets):
+        AtomSet.objects.bulk_create(chunk)
+
+    set_ids = dict(
+        AtomSet.objects.filter(owner=submission).values_list('name', 'id')
+    )
+
+    atom_links   = []
+    subset_links = []
+
+    for set_name, entries in reported_sets.items():
+        for entry in entries:
+            if entry.startswith(SET_PREFIX):
+                subset_links.append(
+                    (set_ids[set_name], set_ids[entry[len(SET_PREFIX):]])
+                )
+            else:
+                atom_links.append((set_ids[set_name], entry))
+
+    add_relations(AtomSet, 'atoms',   atom_links,   check_existing=False)
+    add_relations(AtomSet, 'subsets', subset_links, check_existing=False)
+
+    add_relations(
+        Submission, 'reported_sets',
+        ((submission.pk, set_ids[n]) for n in reported_sets),
+        check_existing = False,
+    )
+
+def parse_submission(body, streaming=STREAMING_PARSER):
+    """
+    Parse the JSON body of a submission and check its AUTH and PROTOCOL data.
+
+    Returns the parsed data. If 'streaming' is set, PACKAGES is returned as a
+    PackageStream (see stream.py) instead of a dict. Nothing is written to the
+    database.
+    """
+
+    if len(body) > MAX_SUBMISSION_SIZE:
+        error_message = "Error: Submission too large."
+        logger.info("parse_submission(): " + error_message)
+        raise BadRequestException(error_message)
+
+    try:
+        with stage('parse'):
+            if streaming:
+                data = parse_stream(body)
+            else:
+                data = json.loads(body)
+    except Exception as e:
+        error_message = "Error: Unable to parse JSON data."
+        logger.warning("parse_submission(): " + error_message, exc_info=True)
+        raise BadRequestException(error_message)
+
+    # Check for AUTH data:
+    try:
+        data['AUTH']['UUID'], data['AUTH']['PASSWD']
+    except KeyError as e:
+        error_message = "Error: Incomplete AUTH data."
+        logger.info("parse_submission(): " + error_message, exc_info=True)
+        raise BadRequestException(error_message)
+
+    try:
+        protocol = data['PROTOCOL']
+        assert type(protocol) == int
+    except KeyError as e:
+        error_message = "Error: No protocol specified."
+        logger.info("parse_submission(): " + error_message, exc_info=True)
+        raise BadRequestException(error_message)
+    except AssertionError as e:
+        error_message = "Error: PROTOCOL must be an integer."
+        logger.info("parse_submission(): " + error_message, exc_info=True)
+        raise BadRequestException(error_message)
+
+    if protocol not in SUPPORTED_PROTOCOL_VERSIONS:
+        logger.info(
+            "parse_submission(): Unsupported protocol: %s." % (protocol),
+            exc_info=True
+        )
+
+        raise BadRequestException(
+            "Error: Unsupported protocol " + \
+            "(supported versions: %s). " % \
+                    ", ".join(str(v) for v in SUPPORTED_PROTOCOL_VERSIONS) + \
+            "Please update your client."
+        )
+
+    if protocol >= 3:
+        try:
+            assert type(data['BASE']) == int
+            assert type(data.get('REMOVED') or []) == list
+        except KeyError as e:
+            error_message = "Error: No BASE submission specified."
+            logger.info("parse_submission(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+        except AssertionError as e:
+            error_message = "Error: Invalid BASE or REMOVED data."
+            logger.info("parse_submission(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+
+    return data
+
+def _is_deadlock(e):
+    """
+    Whether 'e' is the database telling a transaction to start over.
+    """
+
+    return isinstance(e, DatabaseError) and \
+           any(m in str(e).lower() for m in DEADLOCK_MESSAGES)
+
+def ingest_submission( data
+                     , meta
+                     , raw_request_filename
+                     , received_at = None
+                     , base_ref    = None
+):
+    """
+    Write a submission (as returned by parse_submission()) to the database, in
+    a transaction of its own. The transaction is retried (up to MAX_ATTEMPTS
+    times in all) if it deadlocks with a concurrent one.
+
+    'meta' holds the request's META variables. 'received_at' overrides the
+    submission's date, for requests that are ingested some time after they have
+    been received. 'base_ref' is the raw_request_filename of the BASE of a delta
+    submission, for requests replayed into a database where the BASE id means
+    something else.
+
+    Returns the new Submission object.
+    """
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        # Like commit_on_success, but with the commit timed separately:
+        with transaction.commit_manually():
+            try:
+                submission = _ingest_submission( data
+                                               , meta
+                                               , raw_request_filename
+                                               , received_at
+                                               , base_ref
+                )
+            except Exception as e:
+                transaction.rollback()
+
+                if attempt < MAX_ATTEMPTS and _is_deadlock(e):
+                    logger.info( "ingest_submission(): %s (attempt %d), retrying"
+                               , e, attempt
+                    )
+
+                    # The rows of the rolled back attempt are gone:
+                    discard_staged()
+                    continue
+
+                raise
+
+            with stage('commit'):
+                transaction.commit()
+
+        return submission
+
+def _ingest_submission(data, meta, raw_request_filename, received_at, base_ref):
+
+    # Make UUIDs case-insensitive by always using lower().
+    uuid       = data['AUTH']['UUID'].lower()
+    upload_key = data['AUTH']['PASSWD']
+    protocol   = data['PROTOCOL']
+
+    lastsync = data.get('LASTSYNC')
+    if lastsync:
+        try:
+            # FIXME: I've hardcoded the time zone here.
+            # Here's why: http://bugs.python.org/issue6641 .
+            lastsync = datetime.utcfromtimestamp(
+                time.mktime(
+                    time.strptime(lastsync, "%a, %d %b %Y %H:%M:%S +0000")
+                )
+            )
+            lastsync = lastsync.replace(tzinfo=utc)
+        except ValueError as e:
+            error_message = "Error: Invalid date in LASTSYNC."
+            logger.info("ingest_submission(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+
+    # Check everything but PACKAGES before writing anything:
+    with stage('validate'):
+        validate_submission(data)
+
+    with stage('host'):
+        try:
+            host, _ = Host.objects.get_or_create(id=uuid, upload_key=upload_key)
+        except IntegrityError as e:
+            error_message = "Error: Invalid password."
+            logger.info("ingest_submission(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+
+        base = None
+        if protocol >= 3:
+            # Submissions without an installation set (stored before there
+            # were any, until "manage.py build_installation_sets" has run)
+            # can't be used as a base either:
+            if base_ref is None:
+                lookup = dict(pk=data['BASE'])
+            else:
+                lookup = dict(raw_request_filename=base_ref)
+
+            try:
+                base = Submission.objects.get(
+                    host                     = host,
+                    installation_set__isnull = False,
+                    **lookup
+                )
+            except Submission.DoesNotExist as e:
+                error_message = "Error: Unknown BASE submission."
+                logger.info("ingest_submission(): " + error_message, exc_info=True)
+                raise BadRequestException(error_message + " Please send a full submission.")
+
+    with stage('lookups'):
+        features = feature_cache.get_or_create_many(data.get('FEATURES') or [])
+        useflags = useflag_cache.get_or_create_many(data.get('USE') or [])
+        keywords = keyword_cache.get_or_create_many(data.get('ACCEPT_KEYWORDS') or [])
+        mirrors  = mirror_cache.get_or_create_many(data.get('GENTOO_MIRRORS') or [])
+
+        lang = data.get('LANG')
+        if lang:
+            lang = lang_cache.get_or_create_many([lang])[lang]
+
+        sync = data.get('SYNC')
+        if sync:
+            sync = sync_cache.get_or_create_many([sync])[sync]
+
+    ip_addr  = meta['REMOTE_ADDR']
+    fwd_addr = meta.get('HTTP_X_FORWARDED_FOR') # TODO
+
+    with stage('geoip'):
+        country = get_resolver().country_name(ip_addr)
+
+    submission = Submission(
+        raw_request_filename = raw_request_filename,
+        base_request         = base.raw_request_filename if base else None,
+
+        host          = host,
+        country       = country,
+        email         = data['AUTH'].get('EMAIL'),
+        ip_addr       = ip_addr,
+        fwd_addr      = fwd_addr,
+
+        protocol      = protocol,
+
+        arch          = data.get('ARCH'),
+        chost         = data.get('CHOST'),
+        cbuild        = data.get('CBUILD'),
+        ctarget       = data.get('CTARGET'),
+
+        platform      = data.get('PLATFORM'),
+        profile       = data.get('PROFILE'),
+        makeconf      = data.get('MAKECONF'),
+
+        cflags        = data.get('CFLAGS'),
+        cxxflags      = data.get('CXXFLAGS'),
+        ldflags       = data.get('LDFLAGS'),
+        fflags        = data.get('FFLAGS'),
+
+        makeopts      = data.get('MAKEOPTS'),
+        emergeopts    = data.get('EMERGE_DEFAULT_OPTS'),
+        syncopts      = data.get('PORTAGE_RSYNC_EXTRA_OPTS'),
+        acceptlicense = data.get('ACCEPT_LICENSE'),
+
+        lang          = lang,
+        sync          = sync,
+
+        lastsync      = lastsync,
+    )
+
+    with stage('submission'):
+        validate_new_item(submission)
+        submission.save()
+
+        for field, objects in ( ('features',        features)
+                              , ('mirrors',         mirrors)
+                              , ('global_use',      useflags)
+                              , ('global_keywords', keywords)
+        ):
+            add_relations(
+                Submission, field,
+                ((submission.pk, o.pk) for o in objects.values()),
+                check_existing = False,
+            )
+
+    with stage('packages'):
+        reported = set()
+        installation_ids = set()
+        try:
+            for batch in iter_batches(data.get('PACKAGES')):
+                reported.update(k for k, _ in batch)
+                installation_ids.update(ingest_packages(batch))
+        except StreamError as e:
+            error_message = "Error: Unable to parse PACKAGES."
+            logger.info("ingest_submission(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+
+        set_package_count(len(reported))
+
+        # Packages that are reported as changed take precedence:
+        removed = set(data.get('REMOVED') or []) - reported
+
+        if base and not reported and not removed:
+            # Nothing has changed since the base submission:
+            installation_set_id = base.installation_set_id
+        else:
+            if base:
+                installation_ids.update(base_installation_ids(
+                    base,
+                    _fetch_package_ids(installation_ids) |
+                    _fetch_package_ids_by_cpv(removed)
+                ))
+
+            installation_set = get_installation_set(installation_ids)
+            installation_set_id = installation_set.pk if installation_set else None
+
+        submission.installation_set_id = installation_set_id
+        Submission.objects.filter(pk=submission.pk)\
+                .update(installation_set=installation_set_id)
+
+    with stage('worldset'):
+        ingest_worldset(submission, data.get('WORLDSET'))
+
+    with stage('rollups'):
+        update_rollups(submission)
+
+    if received_at:
+        # 'datetime' is an auto_now_add field, so it can't be set on create():
+        submission.datetime = received_at
+        Submission.objects.filter(pk=submission.pk)\
+                .update(datetime=received_at)
+
+    return submission
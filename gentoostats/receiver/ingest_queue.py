@@ -0,0 +1,258 @@
+"""
+Asynchronous ingestion queue.
+
+When GENTOOSTATS_ASYNC_INGEST is enabled, accept_submission() only checks a
+submission's AUTH and PROTOCOL data, saves the raw request and queues it. The
+'ingest_worker' management command then drains the queue with a pool of worker
+processes, using the same ingestion code as the synchronous path.
+"""
+
+import os
+import time
+import socket
+import logging
+import datetime
+from multiprocessing import Process
+
+from django.db import connection
+from django.db.models import Count, Min
+from django.conf import settings
+from django.utils.timezone import now
+
+from .util import load_request, BadRequestException
+from .models import QueuedSubmission
+from .ingest import parse_submission, ingest_submission
+from .metrics import record
+from gentoostats.stats.interning import deferred
+
+logger = logging.getLogger(__name__)
+
+ASYNC_INGEST = getattr(settings, 'GENTOOSTATS_ASYNC_INGEST', False)
+
+# Processing items older than this (in seconds) are assumed to be orphaned by a
+# crashed worker and are put back into the queue:
+STALE_TIMEOUT = getattr(settings, 'GENTOOSTATS_INGEST_STALE_TIMEOUT', 10 * 60)
+
+def enqueue(raw_request_filename, data):
+    """
+    Queue a saved (and already parsed) request for ingestion.
+
+    Returns the QueuedSubmission object, whose id is the ticket id.
+    """
+
+    return QueuedSubmission.objects.create(
+        raw_request_filename = raw_request_filename,
+        host_id              = data['AUTH']['UUID'].lower()[:63],
+    )
+
+def claimable(candidates=10):
+    """
+    Return the ids of up to 'candidates' pending items that may be processed
+    now, oldest first.
+
+    Submissions of a host have to be ingested in the order they were received
+    (their PKs decide which one is the host's latest submission), so only the
+    first pending item of each host qualifies, and only while no other item of
+    the host is being processed.
+    """
+
+    busy = QueuedSubmission.objects\
+            .filter(state=QueuedSubmission.STATE_PROCESSING)\
+            .values_list('host_id', flat=True)
+
+    heads = dict(
+        (row['host_id'], row['first'])
+        for row in QueuedSubmission.objects.order_by()\
+            .filter(state=QueuedSubmission.STATE_PENDING)\
+            .exclude(host_id__in=busy)\
+            .values('host_id')\
+            .annotate(first=Min('received_at'))\
+            .order_by('first')[:candidates]
+    )
+
+    if not heads:
+        return []
+
+    rows = QueuedSubmission.objects\
+            .filter(state=QueuedSubmission.STATE_PENDING, host_id__in=list(heads))\
+            .order_by('received_at', 'id')\
+            .values_list('id', 'host_id', 'received_at')
+
+    ids = []
+    for id, host_id, received_at in rows:
+        # The head may have been claimed since, in which case the next item
+        # of the host has to wait for it:
+        if heads.pop(host_id, None) == received_at:
+            ids.append(id)
+
+    return ids
+
+def claim(worker_name, candidates=10):
+    """
+    Mark the oldest pending item that may be processed now (see claimable())
+    as being processed by 'worker_name'.
+
+    Returns the claimed item, or None if there is none. Workers race for items
+    with a conditional UPDATE, so no row locks are needed.
+    """
+
+    while True:
+        ids = claimable(candidates)
+
+        if not ids:
+            return None
+
+        for id in ids:
+            claimed = QueuedSubmission.objects\
+                    .filter(id=id, state=QueuedSubmission.STATE_PENDING)\
+                    .update( state      = QueuedSubmission.STATE_PROCESSING
+                           , worker     = worker_name
+                           , started_at = now()
+                    )
+
+            if claimed:
+                return QueuedSubmission.objects.get(id=id)
+
+def requeue_stale(timeout=STALE_TIMEOUT):
+    """
+    Put items that have been 'processing' for too long back into the queue.
+
+    Returns the number of requeued items.
+    """
+
+    deadline = now() - datetime.timedelta(seconds=timeout)
+
+    return QueuedSubmission.objects\
+            .filter( state          = QueuedSubmission.STATE_PROCESSING
+                   , started_at__lt = deadline
+            )\
+            .update(state=QueuedSubmission.STATE_PENDING, worker=None)
+
+def process(item):
+    """
+    Ingest a claimed item and record the outcome.
+
+    Returns True on success.
+    """
+
+    update = dict(attempts=item.attempts + 1, finished_at=None, error=None)
+
+    try:
+        request = load_request(item.raw_request_filename)
+
+        with record():
+            data = parse_submission(request.body)
+
+            with deferred():
+                submission = ingest_submission( data
+                                              , request.META
+                                              , item.raw_request_filename
+                                              , received_at = item.received_at
+                )
+
+        update.update(
+            state         = QueuedSubmission.STATE_DONE,
+            submission_id = submission.id,
+        )
+    except BadRequestException as e:
+        update.update(state=QueuedSubmission.STATE_FAILED, error=str(e))
+    except Exception as e:
+        logger.error("process(): ticket #%d: %s" % (item.id, e), exc_info=True)
+        update.update(state=QueuedSubmission.STATE_FAILED, error=str(e))
+
+    update['finished_at'] = now()
+    QueuedSubmission.objects.filter(id=item.id).update(**update)
+
+    return update['state'] == QueuedSubmission.STATE_DONE
+
+def run_worker(worker_name, poll_interval=1.0, exit_when_empty=False):
+    """
+    Process queued submissions until the queue is empty (if exit_when_empty is
+    set) or forever.
+    """
+
+    logger.info("run_worker(): %s started" % worker_name)
+
+    while True:
+        item = claim(worker_name)
+
+        if item is None:
+            # Pending items may only be waiting for another worker:
+            if exit_when_empty and not QueuedSubmission.objects\
+                    .filter(state=QueuedSubmission.STATE_PENDING).exists():
+                break
+
+            time.sleep(poll_interval)
+            continue
+
+        process(item)
+
+    logger.info("run_worker(): %s finished" % worker_name)
+
+def run_pool(num_workers, poll_interval=1.0, exit_when_empty=False):
+    """
+    Run 'num_workers' worker processes and wait for them to finish.
+    """
+
+    requeue_stale()
+
+    # Children must not share the parent's database connection:
+    connection.close()
+
+    base_name = "%s-%d" % (socket.gethostname(), os.getpid())
+
+    workers = [
+        Process( target = run_worker
+               , args   = ( "%s-%d" % (base_name, i)
+                          , poll_interval
+                          , exit_when_empty
+                 )
+        )
+        for i in range(num_workers)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        raise
+
+def queue_stats():
+    """
+    Return a dict describing the state of the queue.
+
+    'lag' is the age (in seconds) of the oldest pending item, or 0 if the queue
+    is empty.
+    """
+
+    counts = dict(
+        (state, 0) for state, _ in QueuedSubmission.STATES
+    )
+
+    counts.update(
+        QueuedSubmission.objects.order_by().values_list('state')\
+            .annotate(num=Count('id'))
+    )
+
+    oldest = list(
+        QueuedSubmission.objects\
+            .filter(state=QueuedSubmission.STATE_PENDING)\
+            .order_by('received_at').values_list('received_at', flat=True)[:1]
+    )
+
+    lag = 0
+    if oldest:
+        lag = int((now() - oldest[0]).total_seconds())
+
+    return dict(
+        depth      = counts[QueuedSubmission.STATE_PENDING],
+        processing = counts[QueuedSubmission.STATE_PROCESSING],
+        done       = counts[QueuedSubmission.STATE_DONE],
+        failed     = counts[QueuedSubmission.STATE_FAILED],
+        lag        = lag,
+    )
@@ -0,0 +1,57 @@
+from optparse import make_option
+from collections import defaultdict
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from gentoostats.stats.util import chunked
+from gentoostats.stats.models import Submission
+from gentoostats.receiver.geoip import get_resolver
+
+class Command(BaseCommand):
+    help = "Resolves the country of submissions that don't have one yet."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 10000
+                   , help    = 'Number of submissions per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        resolver = get_resolver()
+
+        total = resolved = 0
+        last_id = 0
+
+        while True:
+            batch = list(
+                Submission.objects.order_by('id')\
+                    .filter(country__isnull=True, id__gt=last_id)\
+                    .values_list('id', 'ip_addr')\
+                    [:options['batch_size']]
+            )
+
+            if not batch:
+                break
+
+            by_country = defaultdict(list)
+            for id, ip_addr in batch:
+                country = resolver.country_name(ip_addr)
+                if country:
+                    by_country[country].append(id)
+
+            with transaction.commit_on_success():
+                for country, ids in by_country.items():
+                    for chunk in chunked(ids):
+                        Submission.objects.filter(pk__in=chunk)\
+                                .update(country=country)
+
+            last_id = batch[-1][0]
+            total += len(batch)
+            resolved += sum(len(ids) for ids in by_country.values())
+
+            self.stdout.write( "%d submissions checked, %d resolved\n"
+                             % (total, resolved)
+            )
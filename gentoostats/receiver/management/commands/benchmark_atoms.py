@@ -0,0 +1,82 @@
+import time
+from optparse import make_option
+
+from portage.dep import Atom as PortageAtom
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gentoostats.receiver import atoms
+
+# A typical mix of PACKAGES keys (prefixed with '=' by the receiver) and
+# WORLDSET entries:
+SAMPLE_ATOMS = (
+    "=sys-libs/glibc-2.37-r3",
+    "=sys-libs/glibc-2.37-r3:2.2::gentoo",
+    "=sys-devel/gcc-13.2.1_p20230826:13",
+    "=dev-lang/python-3.11.5_p2:3.11/3.11",
+    "=dev-qt/qtcore-5.15.10-r1:5/5.15.10",
+    "=x11-libs/gtk+-3.24.38:3",
+    "=app-misc/screen-4.9.1::gentoo",
+    "=sys-kernel/gentoo-sources-6.1.57:6.1.57",
+    "app-editors/vim",
+    "dev-lang/python:3.11",
+    "www-client/firefox::gentoo",
+    ">=sys-apps/portage-3.0",
+)
+
+class Command(BaseCommand):
+    help = "Compares parse_atom() with direct portage.dep.Atom construction."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--iterations'
+                   , type    = 'int'
+                   , default = 10000
+                   , help    = 'Number of passes over the atoms.'
+        ),
+        make_option( '--atoms'
+                   , help = 'Read the atoms from this file (one per line) '
+                            'instead of using the built-in sample.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        if iterations < 1:
+            raise CommandError("--iterations must be positive.")
+
+        if options['atoms']:
+            with open(options['atoms']) as f:
+                sample = [l.strip() for l in f if l.strip()]
+        else:
+            sample = SAMPLE_ATOMS
+
+        # portage.dep.Atom caches instances itself, so repeated atoms only
+        # measure cache lookups. Distinct atoms measure the actual parsing:
+        distinct = [ "=cat-%d/pkg%d-1.%d-r1:0::gentoo" % (i % 100, i, i)
+                     for i in range(iterations)
+        ]
+
+        def portage_atom(atom):
+            return PortageAtom(atom, allow_wildcard=False, allow_repo=True)
+
+        for title, atom_list, passes in ( ('Repeated atoms', sample,   iterations)
+                                        , ('Distinct atoms', distinct, 1)
+        ):
+            self.stdout.write("%s:\n" % title)
+
+            for name, parse in ( ('portage.dep.Atom', portage_atom)
+                               , ('parse_atom',       atoms.parse_atom)
+            ):
+                atoms.clear_cache()
+
+                started = time.time()
+                for _ in range(passes):
+                    for atom in atom_list:
+                        parse(atom)
+                elapsed = time.time() - started
+
+                self.stdout.write(
+                    "  %-18s %8.2f us/atom\n" % ( name
+                                                 , elapsed * 1e6 / (passes * len(atom_list))
+                    )
+                )
@@ -0,0 +1,143 @@
+import time
+import shutil
+import tempfile
+from optparse import make_option
+
+from django.db import connection, reset_queries
+from django.core.urlresolvers import reverse
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import Client
+from django.test.utils import setup_test_environment, \
+                              teardown_test_environment
+
+from gentoostats.receiver import metrics, spool
+from gentoostats.receiver.ingest_queue import ASYNC_INGEST
+from gentoostats.receiver.synthetic import SubmissionGenerator
+
+def percentile(values, p):
+    values = sorted(values)
+    index  = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+class Command(BaseCommand):
+    help = "Measures ingestion throughput with synthetic submissions, " \
+           "posted through the test client into a fresh test database."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--submissions'
+                   , type    = 'int'
+                   , default = 100
+                   , help    = 'Number of submissions to post.'
+        ),
+        make_option( '--packages'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of packages per submission.'
+        ),
+        make_option( '--useflags'
+                   , type    = 'int'
+                   , default = 500
+                   , help    = 'Number of distinct USE flags.'
+        ),
+        make_option( '--use-per-package'
+                   , type    = 'int'
+                   , default = 10
+                   , help    = 'Number of IUSE flags per package.'
+        ),
+        make_option( '--world-size'
+                   , type    = 'int'
+                   , default = 50
+                   , help    = 'Number of atoms in the world set.'
+        ),
+        make_option( '--host-reuse'
+                   , type    = 'float'
+                   , default = 0.5
+                   , help    = 'Probability that a submission comes from a '
+                               'host that has submitted before.'
+        ),
+        make_option( '--seed'
+                   , type    = 'int'
+                   , default = 0
+                   , help    = 'Random seed (for reproducible runs).'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['submissions'] < 1:
+            raise CommandError("--submissions must be positive.")
+
+        if ASYNC_INGEST:
+            self.stderr.write( "Warning: GENTOOSTATS_ASYNC_INGEST is enabled, "
+                               "only queueing will be measured.\n"
+            )
+
+        generator = SubmissionGenerator(
+            packages        = options['packages'],
+            useflags        = options['useflags'],
+            use_per_package = options['use_per_package'],
+            world_size      = options['world_size'],
+            host_reuse      = options['host_reuse'],
+            seed            = options['seed'],
+        )
+
+        # Generate everything up front, so only ingestion is measured:
+        bodies = [generator.generate()[1] for _ in range(options['submissions'])]
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        # Keep the synthetic requests out of the real spool:
+        spool_dir = tempfile.mkdtemp(prefix='gentoostats-spool-')
+        old_spool = spool._spool
+        spool._spool = spool.Spool(spool_dir)
+
+        # Count queries ourselves (and don't write metrics files):
+        metrics_enabled = metrics.METRICS_ENABLED
+        metrics.METRICS_ENABLED = False
+        connection.use_debug_cursor = True
+
+        try:
+            latencies, queries = self.post_all(bodies)
+        finally:
+            connection.use_debug_cursor = None
+            metrics.METRICS_ENABLED = metrics_enabled
+
+            spool._spool = old_spool
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        total = sum(latencies)
+
+        self.stdout.write("submissions:     %d\n"     % len(latencies))
+        self.stdout.write("submissions/s:   %.2f\n"   % (len(latencies) / total))
+        self.stdout.write("p50 latency:     %.1f ms\n" % (percentile(latencies, 50) * 1000))
+        self.stdout.write("p99 latency:     %.1f ms\n" % (percentile(latencies, 99) * 1000))
+        self.stdout.write("queries/submission (mean): %.1f\n"
+                          % (float(sum(queries)) / len(queries)))
+        self.stdout.write("queries/submission (max):  %d\n" % max(queries))
+
+    def post_all(self, bodies):
+        client = Client(REMOTE_ADDR='127.0.0.1')
+        url    = reverse('receiver:accept_submission_url')
+
+        latencies = []
+        queries   = []
+
+        for body in bodies:
+            reset_queries()
+
+            started  = time.time()
+            response = client.post(url, body, content_type='application/json')
+            latencies.append(time.time() - started)
+
+            queries.append(len(connection.queries))
+
+            if response.status_code not in (200, 202):
+                raise CommandError( "Submission failed (%d): %s"
+                                  % (response.status_code, response.content)
+                )
+
+        return latencies, queries
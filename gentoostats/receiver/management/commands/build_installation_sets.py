@@ -0,0 +1,78 @@
+from optparse import make_option
+from collections import defaultdict
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.core.management.base import BaseCommand, CommandError
+
+from gentoostats.stats.util import chunked
+from gentoostats.stats.models import Submission
+from gentoostats.receiver.ingest import get_installation_set
+
+# Where older versions linked each submission to its installations:
+LEGACY_TABLE = 'stats_submission_installations'
+
+class Command(BaseCommand):
+    help = "Moves the installations of older submissions from their own " \
+           "links (the %s table) to shared installation sets." % LEGACY_TABLE
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--database'
+                   , default = DEFAULT_DB_ALIAS
+                   , help    = 'The DATABASES entry holding the %s table '
+                               '(default: %s).' % (LEGACY_TABLE, DEFAULT_DB_ALIAS)
+        ),
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of submissions per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError( "There is no '%s' database in DATABASES."
+                              % options['database']
+            )
+
+        # Only the links are read from there, the submissions are always the
+        # ones in the default database:
+        connection = connections[options['database']]
+
+        if LEGACY_TABLE not in connection.introspection.table_names():
+            raise CommandError("There is no %s table." % LEGACY_TABLE)
+
+        qn  = connection.ops.quote_name
+        sql = "SELECT submission_id, installation_id FROM %s " \
+              "WHERE submission_id IN (%%s)" % qn(LEGACY_TABLE)
+
+        total = 0
+        last_id = 0
+
+        while True:
+            batch = list(
+                Submission.objects.order_by('id')\
+                    .filter(installation_set__isnull=True, id__gt=last_id)\
+                    .values_list('id', flat=True)\
+                    [:options['batch_size']]
+            )
+
+            if not batch:
+                break
+
+            installations = defaultdict(set)
+            cursor = connection.cursor()
+            for chunk in chunked(batch):
+                cursor.execute(sql % ', '.join(['%s'] * len(chunk)), chunk)
+                for submission_id, installation_id in cursor.fetchall():
+                    installations[submission_id].add(installation_id)
+
+            with transaction.commit_on_success():
+                for submission_id, installation_ids in installations.items():
+                    Submission.objects.filter(pk=submission_id).update(
+                        installation_set = get_installation_set(installation_ids)
+                    )
+
+            last_id = batch[-1]
+            total += len(batch)
+
+            self.stdout.write("%d submissions converted\n" % total)
@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from gentoostats.receiver.metrics import load_metrics, format_metrics, \
+                                         reset_metrics
+
+class Command(BaseCommand):
+    help = "Shows per-stage ingestion timings, bucketed by package count."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--reset'
+                   , action  = 'store_true'
+                   , default = False
+                   , help    = 'Delete the collected metrics (processes that '
+                               'are still running keep their own totals).'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            reset_metrics()
+            return
+
+        for line in format_metrics(load_metrics()):
+            self.stdout.write(line + "\n")
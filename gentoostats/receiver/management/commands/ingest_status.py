@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from gentoostats.receiver.ingest_queue import queue_stats
+
+class Command(BaseCommand):
+    help = "Shows the depth and lag of the submission ingestion queue."
+
+    def handle(self, *args, **options):
+        stats = queue_stats()
+
+        for key in ('depth', 'processing', 'done', 'failed', 'lag'):
+            self.stdout.write("%-10s %d\n" % (key, stats[key]))
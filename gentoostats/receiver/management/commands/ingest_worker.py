@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gentoostats.receiver.ingest_queue import run_pool
+
+class Command(BaseCommand):
+    help = "Ingests queued submissions with a pool of worker processes."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--workers'
+                   , type    = 'int'
+                   , default = getattr(settings, 'GENTOOSTATS_INGEST_WORKERS', 2)
+                   , help    = 'Number of worker processes.'
+        ),
+        make_option( '--poll-interval'
+                   , type    = 'float'
+                   , default = 1.0
+                   , help    = 'Seconds to wait when the queue is empty.'
+        ),
+        make_option( '--once'
+                   , action  = 'store_true'
+                   , default = False
+                   , help    = 'Exit once the queue has been drained.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1.")
+
+        run_pool( options['workers']
+                , poll_interval   = options['poll_interval']
+                , exit_when_empty = options['once']
+        )
@@ -0,0 +1,92 @@
+import datetime
+from optparse import make_option
+
+from django.db import connections
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import utc
+
+from gentoostats.receiver.replay import replay, iter_spool, iter_legacy
+
+def parse_date(value):
+    """
+    Parse a YYYY-MM-DD[THH:MM:SS] (UTC) date.
+    """
+
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            date = datetime.datetime.strptime(value, date_format)
+            return date.replace(tzinfo=utc)
+        except ValueError:
+            pass
+
+    raise CommandError("Invalid date: '%s'." % value)
+
+class Command(BaseCommand):
+    help = "Re-ingests stored raw requests (from the spool by default)."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--legacy-dir'
+                   , help = 'Replay the pickled requests in this directory '
+                            'instead of the spool.'
+        ),
+        make_option( '--since'
+                   , help = 'Only replay requests received at or after this '
+                            'date (YYYY-MM-DD[THH:MM:SS], UTC).'
+        ),
+        make_option( '--until'
+                   , help = 'Only replay requests received before this date.'
+        ),
+        make_option( '--workers'
+                   , type    = 'int'
+                   , default = 4
+                   , help    = 'Number of worker processes.'
+        ),
+        make_option( '--chunk-size'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of records per checkpoint.'
+        ),
+        make_option( '--checkpoint'
+                   , help = 'Resume from (and keep updating) this file.'
+        ),
+        make_option( '--ids-from'
+                   , help = 'The DATABASES entry that the requests were '
+                            'ingested into originally (e.g. default), to '
+                            'find the BASE of delta submissions in. Without '
+                            'it, delta submissions fail.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError("--workers and --chunk-size must be positive.")
+
+        if options['legacy_dir']:
+            source = lambda position: \
+                    iter_legacy(options['legacy_dir'], position)
+        else:
+            source = iter_spool
+
+        if options['ids_from'] and \
+                options['ids_from'] not in connections.databases:
+            raise CommandError( "There is no '%s' database in DATABASES."
+                              % options['ids_from']
+            )
+
+        since = parse_date(options['since']) if options['since'] else None
+        until = parse_date(options['until']) if options['until'] else None
+
+        def report(stats):
+            self.stdout.write("%s\n" % stats)
+
+        stats = replay( source
+                      , workers    = options['workers']
+                      , chunk_size = options['chunk_size']
+                      , since      = since
+                      , until      = until
+                      , checkpoint = options['checkpoint']
+                      , report     = report
+                      , ids_from   = options['ids_from']
+        )
+
+        self.stdout.write("Finished: %s\n" % stats)
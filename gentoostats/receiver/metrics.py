@@ -0,0 +1,351 @@
+"""
+Per-stage timing of submission ingestion.
+
+Entry points (the upload view, the queue worker and replay) wrap each
+submission in record(). The ingest code marks its stages with stage(), which
+measures the wall time and the number of queries of each stage, and does
+nothing if no submission is being recorded.
+
+Finished recordings are added to per-process histograms, keyed by stage and by
+the number of packages in the submission. Each process periodically writes its
+histograms to GENTOOSTATS_METRICS_DIR, and load_metrics() merges the files of
+all processes (see the metrics view and "manage.py ingest_metrics"). Files of
+processes that have exited, or that haven't been written for
+GENTOOSTATS_METRICS_MAX_AGE seconds, are deleted instead.
+"""
+
+import os
+import re
+import json
+import time
+import errno
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = getattr(settings, 'GENTOOSTATS_INGEST_METRICS', True)
+
+METRICS_DIR = getattr( settings
+                     , 'GENTOOSTATS_METRICS_DIR'
+                     , os.path.join(os.path.dirname(__file__), 'metrics')
+)
+
+# Minimum number of seconds between two writes of a process' metrics file:
+FLUSH_INTERVAL = 10
+
+# Metrics files are named after the host and the process ID. Those of other
+# hosts (if METRICS_DIR is shared) can only be aged out:
+METRICS_FILE_RE = re.compile(r'^metrics-(?:(?P<host>.+)-)?(?P<pid>\d+)\.json$')
+
+METRICS_MAX_AGE = getattr(settings, 'GENTOOSTATS_METRICS_MAX_AGE', 24 * 60 * 60)
+
+# Upper bounds of the package count buckets (the last bucket is open):
+PACKAGE_COUNT_BUCKETS = (100, 500, 1000, 2000)
+
+# In pipeline order:
+STAGES = ( 'parse'
+         , 'validate'
+         , 'host'
+         , 'lookups'
+         , 'geoip'
+         , 'submission'
+         , 'packages'
+         , 'worldset'
+         , 'rollups'
+         , 'commit'
+         , 'total'
+)
+
+def bucket_name(package_count):
+    lower = 0
+    for upper in PACKAGE_COUNT_BUCKETS:
+        if package_count < upper:
+            return "%d-%d" % (lower, upper - 1)
+        lower = upper
+
+    return "%d+" % lower
+
+def bucket_names():
+    names = []
+    lower = 0
+    for upper in PACKAGE_COUNT_BUCKETS:
+        names.append(bucket_name(lower))
+        lower = upper
+    names.append(bucket_name(lower))
+
+    return names
+
+class Recording(object):
+    """
+    The stage timings of a single submission.
+    """
+
+    def __init__(self):
+        self.stages        = dict()
+        self.package_count = 0
+        self.queries       = 0
+
+    def add(self, name, seconds, queries):
+        total = self.stages.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += queries
+
+class Histograms(object):
+    """
+    Count, total and maximum time and total queries per (stage, bucket).
+    """
+
+    def __init__(self, data=None):
+        self.data = data or dict()
+        self.lock = threading.Lock()
+
+    def add(self, recording):
+        bucket = bucket_name(recording.package_count)
+
+        with self.lock:
+            for name, (seconds, queries) in recording.stages.items():
+                entry = self.data.setdefault( "%s %s" % (name, bucket)
+                                            , dict( count   = 0
+                                                  , seconds = 0.0
+                                                  , max     = 0.0
+                                                  , queries = 0
+                                              )
+                )
+
+                entry['count']   += 1
+                entry['seconds'] += seconds
+                entry['max']      = max(entry['max'], seconds)
+                entry['queries'] += queries
+
+    def merge(self, other):
+        for key, other_entry in other.data.items():
+            entry = self.data.setdefault(key, dict(count=0, seconds=0.0, max=0.0, queries=0))
+
+            entry['count']   += other_entry['count']
+            entry['seconds'] += other_entry['seconds']
+            entry['max']      = max(entry['max'], other_entry['max'])
+            entry['queries'] += other_entry['queries']
+
+    def rows(self):
+        """
+        Yield (stage, bucket, count, mean seconds, max seconds, mean queries)
+        in pipeline and bucket order.
+        """
+
+        for name in STAGES:
+            for bucket in bucket_names():
+                entry = self.data.get("%s %s" % (name, bucket))
+                if not entry or not entry['count']:
+                    continue
+
+                yield ( name
+                      , bucket
+                      , entry['count']
+                      , entry['seconds'] / entry['count']
+                      , entry['max']
+                      , float(entry['queries']) / entry['count']
+                )
+
+class CountingCursor(object):
+    """
+    A cursor that counts the statements executed through it, which (unlike
+    Django's debug cursor) costs next to nothing.
+    """
+
+    def __init__(self, cursor, recording):
+        self.cursor    = cursor
+        self.recording = recording
+
+    def execute(self, *args, **kwargs):
+        self.recording.queries += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.recording.queries += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+_histograms = Histograms()
+_last_flush = [0.0]
+_local      = threading.local()
+
+@contextmanager
+def record():
+    """
+    Record the stages of the submission ingested in this block.
+    """
+
+    if not METRICS_ENABLED or getattr(_local, 'recording', None) is not None:
+        yield None
+        return
+
+    recording = _local.recording = Recording()
+
+    # Count the queries of this thread's connection (connections are per
+    # thread) by wrapping its cursors:
+    connection = connections[DEFAULT_DB_ALIAS]
+    cursor = connection.cursor
+    connection.cursor = lambda: CountingCursor(cursor(), recording)
+
+    started = time.time()
+    try:
+        yield recording
+    finally:
+        recording.add('total', time.time() - started, recording.queries)
+
+        _local.recording = None
+        del connection.cursor
+
+    # Only successful submissions are recorded:
+    _histograms.add(recording)
+    flush()
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the submission that is being recorded (if any).
+    """
+
+    recording = getattr(_local, 'recording', None)
+    if recording is None:
+        yield
+        return
+
+    first_query = recording.queries
+    started = time.time()
+    try:
+        yield
+    finally:
+        recording.add(name, time.time() - started, recording.queries - first_query)
+
+def set_package_count(package_count):
+    recording = getattr(_local, 'recording', None)
+    if recording is not None:
+        recording.package_count = package_count
+
+def flush(force=False):
+    """
+    Write this process' histograms to METRICS_DIR (at most every
+    FLUSH_INTERVAL seconds, unless 'force' is set).
+    """
+
+    if not force and time.time() - _last_flush[0] < FLUSH_INTERVAL:
+        return
+
+    _last_flush[0] = time.time()
+
+    try:
+        if not os.path.isdir(METRICS_DIR):
+            os.makedirs(METRICS_DIR)
+
+        path = os.path.join( METRICS_DIR
+                           , "metrics-%s-%d.json" % ( socket.gethostname()
+                                                    , os.getpid()
+                                                    )
+        )
+        with _histograms.lock:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(_histograms.data, f)
+
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        logger.warning("flush(): %s" % e, exc_info=True)
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: running, as another user
+        return e.errno != errno.ESRCH
+
+    return True
+
+def is_stale(path):
+    """
+    Whether the metrics file at 'path' belongs to a process that has exited,
+    or hasn't been written for METRICS_MAX_AGE seconds.
+    """
+
+    match = METRICS_FILE_RE.match(os.path.basename(path))
+    if match is not None \
+            and match.group('host') in (None, socket.gethostname()) \
+            and not is_running(int(match.group('pid'))):
+        return True
+
+    return time.time() - os.path.getmtime(path) > METRICS_MAX_AGE
+
+def load_metrics():
+    """
+    Return the merged Histograms of all processes, and delete the stale
+    metrics files.
+    """
+
+    result = Histograms()
+    if not os.path.isdir(METRICS_DIR):
+        return result
+
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            if is_stale(path):
+                os.remove(path)
+                continue
+        except OSError as e:
+            # Deleted by another process in the meantime
+            if e.errno != errno.ENOENT:
+                logger.warning("load_metrics(): %s: %s" % (name, e))
+            continue
+
+        try:
+            with open(path) as f:
+                result.merge(Histograms(json.load(f)))
+        except (IOError, ValueError) as e:
+            logger.warning("load_metrics(): %s: %s" % (name, e))
+
+    return result
+
+def format_metrics(histograms):
+    """
+    Return the rows of 'histograms' as lines of a plain text table.
+    """
+
+    lines = ["%-10s %-10s %8s %10s %10s %8s" % ( 'stage', 'packages', 'count'
+                                               , 'mean (ms)', 'max (ms)'
+                                               , 'queries'
+    )]
+
+    for name, bucket, count, mean, maximum, queries in histograms.rows():
+        lines.append("%-10s %-10s %8d %10.1f %10.1f %8.1f" % ( name, bucket, count
+                                                             , mean * 1000
+                                                             , maximum * 1000
+                                                             , queries
+        ))
+
+    return lines
+
+def reset_metrics():
+    """
+    Delete the metrics of all processes.
+    """
+
+    with _histograms.lock:
+        _histograms.data.clear()
+
+    if os.path.isdir(METRICS_DIR):
+        for name in os.listdir(METRICS_DIR):
+            if name.endswith('.json'):
+                os.remove(os.path.join(METRICS_DIR, name))
@@ -1,3 +1,50 @@
 from django.db import models
 
-# Create your models here.
+class QueuedSubmission(models.Model):
+    """
+    A submission that has been accepted and spooled, but not necessarily
+    ingested yet. Only used when GENTOOSTATS_ASYNC_INGEST is enabled.
+
+    The id doubles as the ticket id returned to the client.
+    """
+
+    STATE_PENDING    = 'pending'
+    STATE_PROCESSING = 'processing'
+    STATE_DONE       = 'done'
+    STATE_FAILED     = 'failed'
+
+    STATES = (
+        (STATE_PENDING,    'Pending'),
+        (STATE_PROCESSING, 'Processing'),
+        (STATE_DONE,       'Done'),
+        (STATE_FAILED,     'Failed'),
+    )
+
+    # The spool reference returned by save_request():
+    raw_request_filename = models.CharField(max_length=127, unique=True)
+
+    # For debugging only, the UUID is not validated at this point:
+    host_id = models.CharField(max_length=63)
+
+    state = models.CharField( max_length = 15
+                            , choices    = STATES
+                            , default    = STATE_PENDING
+                            , db_index   = True
+    )
+
+    received_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    started_at  = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    worker   = models.CharField(max_length=63, blank=True, null=True)
+    attempts = models.IntegerField(default=0)
+    error    = models.TextField(blank=True, null=True)
+
+    # Filled in once the submission has been ingested:
+    submission_id = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return "Ticket #%s (%s)" % (self.id, self.state)
@@ -0,0 +1,304 @@
+"""
+Re-ingestion of stored raw requests.
+
+Records are read sequentially (from the spool or from a directory of pickled
+requests saved by older versions) and handed out in chunks to a pool of worker
+processes. All records of a host end up in the same worker, in their original
+order, and a chunk must be finished before the next one starts, so per-host
+ordering is preserved. The position after each finished chunk can be saved as a
+checkpoint to resume from.
+
+Delta (PROTOCOL 3) submissions name their BASE by the id it was given in the
+database the request was ingested into originally. That database has to be
+available (as 'ids_from') to find out which request the BASE was, since the
+ids are different once the requests have been replayed.
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import pickle
+import logging
+import datetime
+from multiprocessing import Pool
+
+from django.db import connection
+from django.utils.timezone import utc
+
+from .util import BadRequestException
+from .spool import get_spool, make_ref, parse_ref
+from .ingest import parse_submission, ingest_submission
+from . import metrics
+from gentoostats.stats.util import chunked
+from gentoostats.stats.interning import deferred
+from gentoostats.stats.models import Submission
+
+logger = logging.getLogger(__name__)
+
+# Good enough to route a record to a worker without parsing the whole body:
+UUID_RE = re.compile(r'"UUID"\s*:\s*"([^"]+)"')
+
+# Likewise for finding delta submissions (which are parsed properly later):
+BASE_RE = re.compile(r'"BASE"\s*:\s*(\d+)')
+
+class ReplayStats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.counts  = dict(done=0, skipped=0, failed=0)
+
+    def add(self, results):
+        for status in results:
+            self.counts[status] += 1
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def __str__(self):
+        elapsed = max(time.time() - self.started, 0.001)
+
+        return "%d records (%d done, %d skipped, %d failed) " \
+               "in %.0fs, %.1f records/s" % ( self.total
+                                            , self.counts['done']
+                                            , self.counts['skipped']
+                                            , self.counts['failed']
+                                            , elapsed
+                                            , self.total / elapsed
+        )
+
+# Sources: #{{{
+def iter_spool(position=None):
+    """
+    Yield (position, request) for every record in the spool, where 'position'
+    is the reference of the next record (to checkpoint and resume from).
+    """
+
+    spool = get_spool()
+    start_segment, start_offset = parse_ref(position) if position else (0, 0)
+
+    for segment in spool.segments():
+        if segment < start_segment:
+            continue
+
+        offset = start_offset if segment == start_segment else 0
+        for next_offset, request in spool.iter_segment(segment, offset):
+            yield make_ref(segment, next_offset), request
+
+def _legacy_timestamp(file_name):
+    # File names look like "<ip>-<unix timestamp>-<random int>".
+    try:
+        return int(file_name.rsplit('-', 2)[1])
+    except (IndexError, ValueError) as e:
+        return 0
+
+def iter_legacy(directory, position=None):
+    """
+    Like iter_spool(), but for a directory of pickled requests saved by older
+    versions. 'position' is the last processed file name.
+    """
+
+    names = [n for n in os.listdir(directory) if not n.startswith('.')]
+    names.sort(key=lambda n: (_legacy_timestamp(n), n))
+
+    for name in names:
+        if position and (_legacy_timestamp(name), name) <= \
+                        (_legacy_timestamp(position), position):
+            continue
+
+        with open(os.path.join(directory, name), 'rb') as f:
+            request = pickle.load(f)
+
+        request.ref  = name
+        request.META = dict(request.META)
+        request.received_at = datetime.datetime\
+                .utcfromtimestamp(_legacy_timestamp(name)).replace(tzinfo=utc)
+
+        yield name, request
+#}}}
+
+def load_base_refs(records, database):
+    """
+    Return a dict mapping the refs of the delta submissions among 'records' to
+    the refs of their BASE submissions, as found in 'database' (which the
+    records were ingested into originally).
+    """
+
+    bases = dict()
+    for ref, body, _, _ in records:
+        match = BASE_RE.search(body)
+        if match:
+            bases[ref] = int(match.group(1))
+
+    submissions = Submission.objects.using(database)
+
+    # Stored with the delta submission itself, unless it predates that:
+    base_refs = dict()
+    for chunk in chunked(list(bases)):
+        base_refs.update(
+            submissions.filter( raw_request_filename__in = chunk
+                              , base_request__isnull     = False
+            ).values_list('raw_request_filename', 'base_request')
+        )
+
+    missing = [ref for ref in bases if ref not in base_refs]
+
+    ids = dict()
+    for chunk in chunked(list(set(bases[ref] for ref in missing))):
+        ids.update(
+            submissions.filter(pk__in=chunk)\
+                .values_list('pk', 'raw_request_filename')
+        )
+
+    for ref in missing:
+        if bases[ref] in ids:
+            base_refs[ref] = ids[bases[ref]]
+
+    return base_refs
+
+def replay_record(record, base_refs):
+    """
+    Ingest a single (ref, body, META, received_at) record. Runs in a worker.
+
+    'base_refs' is the result of load_base_refs(). Delta submissions that are
+    not in it fail, rather than risking a BASE id that now means a different
+    submission.
+
+    Returns 'done', 'skipped' (already in the database) or 'failed'.
+    """
+
+    ref, body, meta, received_at = record
+
+    if Submission.objects.filter(raw_request_filename=ref).exists():
+        return 'skipped'
+
+    try:
+        with metrics.record():
+            data = parse_submission(body)
+
+            base_ref = None
+            if data['PROTOCOL'] >= 3:
+                base_ref = base_refs.get(ref)
+                if base_ref is None:
+                    raise BadRequestException("Error: Unknown BASE submission.")
+
+            with deferred():
+                ingest_submission( data
+                                 , meta
+                                 , ref
+                                 , received_at = received_at
+                                 , base_ref    = base_ref
+                )
+    except BadRequestException as e:
+        logger.info("replay_record(): %s: %s" % (ref, e))
+        return 'failed'
+    except Exception as e:
+        logger.error("replay_record(): %s: %s" % (ref, e), exc_info=True)
+        return 'failed'
+
+    return 'done'
+
+def replay_partition(args):
+    """
+    Ingest a list of records in order. Runs in a worker.
+
+    'args' is a (records, base_refs) tuple, see replay_record().
+    """
+
+    records, base_refs = args
+    return [replay_record(r, base_refs) for r in records]
+
+def _init_worker():
+    # Forked workers must not share the parent's database connection:
+    connection.close()
+
+def _partition(records, num_partitions):
+    partitions = [[] for _ in range(num_partitions)]
+
+    for record in records:
+        match = UUID_RE.search(record[1])
+        key = match.group(1).lower() if match else record[0]
+
+        partitions[zlib.crc32(key) % num_partitions].append(record)
+
+    return [p for p in partitions if p]
+
+def replay( source
+          , workers       = 4
+          , chunk_size    = 1000
+          , since         = None
+          , until         = None
+          , checkpoint    = None
+          , report        = None
+          , ids_from      = None
+):
+    """
+    Replay all records yielded by 'source' (a function taking the position to
+    resume from, see iter_spool() and iter_legacy()).
+
+    'since' and 'until' are aware datetimes limiting the records' receipt
+    times. If 'checkpoint' (a file name) is given, replay resumes from the
+    position stored in it, which is updated after each finished chunk.
+    'report' is called with a ReplayStats object after each chunk. 'ids_from'
+    is the DATABASES entry that the records were ingested into originally;
+    without it, delta submissions can't be replayed.
+
+    Returns the final ReplayStats object.
+    """
+
+    position = None
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            position = json.load(f)['position']
+
+    stats = ReplayStats()
+
+    connection.close()
+    pool = Pool(workers, initializer=_init_worker)
+
+    def flush(chunk, position):
+        if chunk:
+            base_refs = load_base_refs(chunk, ids_from) if ids_from else dict()
+            partitions = [ (records, base_refs)
+                           for records in _partition(chunk, workers)
+            ]
+
+            for results in pool.map(replay_partition, partitions):
+                stats.add(results)
+
+        if checkpoint and position:
+            with open(checkpoint + '.tmp', 'w') as f:
+                json.dump(dict(position=position), f)
+            os.rename(checkpoint + '.tmp', checkpoint)
+
+        if report:
+            report(stats)
+
+    try:
+        chunk = []
+        for position, request in source(position):
+            received_at = getattr(request, 'received_at', None)
+
+            if since and received_at and received_at < since:
+                continue
+            if until and received_at and received_at >= until:
+                continue
+
+            chunk.append( ( request.ref
+                          , request.body
+                          , request.META
+                          , received_at
+                          )
+            )
+
+            if len(chunk) >= chunk_size:
+                flush(chunk, position)
+                chunk = []
+
+        flush(chunk, position)
+    finally:
+        pool.close()
+        pool.join()
+
+    return stats
@@ -0,0 +1,330 @@
+"""
+Append-only spool for raw requests.
+
+Requests are appended to numbered segment files as length-prefixed,
+zlib-compressed records. Once the active segment grows past SEGMENT_SIZE a new
+one is started, so the spool directory holds a few large files instead of one
+file per submission.
+
+A record is referenced by "<segment>:<offset>" (see make_ref()). Its layout is:
+
+    header: magic (4 bytes), meta length, body length, CRC32 (3 x uint32, BE)
+    meta:   zlib-compressed JSON ({'META': {...}, 'received_at': <timestamp>})
+    body:   zlib-compressed request body
+
+Writers within a process are group-committed: while one thread writes and
+fsync()s a batch of records, the others queue up theirs for the next batch.
+Writers in different processes are serialised with a lock file.
+"""
+
+import os
+import re
+import json
+import zlib
+import fcntl
+import struct
+import logging
+import datetime
+import threading
+
+from django.conf import settings
+from django.utils.timezone import utc
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DIR = getattr( settings
+                   , 'GENTOOSTATS_SPOOL_DIR'
+                   , os.path.join(os.path.dirname(__file__), 'requests')
+)
+
+SEGMENT_SIZE = getattr(settings, 'GENTOOSTATS_SPOOL_SEGMENT_SIZE', 64 * 2**20)
+
+MAGIC         = b'GSR1'
+HEADER        = struct.Struct('>4sIII')
+REF_RE        = re.compile(r'^(\d{8}):(\d+)$')
+SEGMENT_RE    = re.compile(r'^segment-(\d{8})\.log$')
+
+class SpoolException(Exception): pass
+
+class SpooledRequest(object):
+    """
+    A request read back from the spool.
+
+    Provides the same 'body' and 'META' attributes as a Django request.
+    """
+
+    def __init__(self, ref, body, meta, received_at):
+        self.ref         = ref
+        self.body        = body
+        self.META        = meta
+        self.received_at = received_at
+
+def make_ref(segment, offset):
+    return "%08d:%d" % (segment, offset)
+
+def parse_ref(ref):
+    """
+    Split a record reference into (segment, offset).
+
+    Returns None if 'ref' is not a spool reference (e.g. the file name of a
+    request saved by older versions).
+    """
+
+    match = REF_RE.match(ref)
+    if not match:
+        return None
+
+    return int(match.group(1)), int(match.group(2))
+
+def encode_record(meta, body):
+    meta = zlib.compress(json.dumps(meta))
+    body = zlib.compress(body)
+
+    crc = zlib.crc32(meta + body) & 0xffffffff
+    return HEADER.pack(MAGIC, len(meta), len(body), crc) + meta + body
+
+class Spool(object):
+    def __init__(self, directory=SPOOL_DIR, segment_size=SEGMENT_SIZE):
+        self.directory    = directory
+        self.segment_size = segment_size
+
+        # Group commit state:
+        self._cond     = threading.Condition()
+        self._pending  = []
+        self._results  = dict()
+        self._flushing = False
+        self._next_id  = 0
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, "segment-%08d.log" % segment)
+
+    def segments(self):
+        """
+        Return the numbers of all existing segments, in ascending order.
+        """
+
+        numbers = []
+        for name in os.listdir(self.directory):
+            match = SEGMENT_RE.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+
+        return sorted(numbers)
+
+    # Writing: #{{{
+    def append(self, meta, body):
+        """
+        Durably append a record and return its reference.
+
+        Blocks until the record has been fsync()ed.
+        """
+
+        record = encode_record(meta, body)
+
+        with self._cond:
+            record_id = self._next_id
+            self._next_id += 1
+            self._pending.append((record_id, record))
+
+            while record_id not in self._results:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+
+                # Become the leader and write everything that's pending:
+                self._flushing = True
+                batch, self._pending = self._pending, []
+
+                self._cond.release()
+                try:
+                    try:
+                        refs = self._write_batch([r for _, r in batch])
+                        results = zip([i for i, _ in batch], refs)
+                    except Exception as e:
+                        logger.error("append(): %s" % e, exc_info=True)
+                        results = [(i, e) for i, _ in batch]
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+
+                self._results.update(results)
+                self._cond.notify_all()
+
+            result = self._results.pop(record_id)
+
+        if isinstance(result, Exception):
+            raise SpoolException("Unable to spool the request: %s" % result)
+
+        return result
+
+    def _write_batch(self, records):
+        """
+        Append 'records' to the active segment (rotating it if necessary) and
+        fsync() them. Returns their references.
+        """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        lock_path = os.path.join(self.directory, 'spool.lock')
+        with open(lock_path, 'a+') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            segment = self._current_segment()
+            path    = self.segment_path(segment)
+            size    = os.path.getsize(path) if os.path.exists(path) else 0
+
+            batch_size = sum(len(r) for r in records)
+            if size and size + batch_size > self.segment_size:
+                segment += 1
+                path     = self.segment_path(segment)
+                size     = 0
+
+                self._set_current_segment(segment)
+
+            refs = []
+            with open(path, 'ab') as f:
+                for record in records:
+                    refs.append(make_ref(segment, size))
+                    size += len(record)
+
+                f.write(b''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+
+        # (The lock has been released by closing its file.)
+        return refs
+
+    def _current_segment(self):
+        try:
+            with open(os.path.join(self.directory, 'CURRENT')) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError) as e:
+            segments = self.segments()
+            return segments[-1] if segments else 0
+
+    def _set_current_segment(self, segment):
+        path = os.path.join(self.directory, 'CURRENT')
+
+        with open(path + '.tmp', 'w') as f:
+            f.write("%d\n" % segment)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(path + '.tmp', path)
+    #}}}
+
+    # Reading: #{{{
+    def _read_record(self, f, segment, offset):
+        """
+        Read the record at 'offset' of the open segment 'f'.
+
+        Returns a SpooledRequest, or None at the end of the segment. Raises
+        SpoolException for corrupt or incomplete records.
+        """
+
+        f.seek(offset)
+        header = f.read(HEADER.size)
+        if not header:
+            return None
+
+        if len(header) != HEADER.size:
+            raise SpoolException("Truncated record header")
+
+        magic, meta_len, body_len, crc = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise SpoolException("Bad record magic")
+
+        data = f.read(meta_len + body_len)
+        if len(data) != meta_len + body_len:
+            raise SpoolException("Truncated record")
+
+        if zlib.crc32(data) & 0xffffffff != crc:
+            raise SpoolException("Record checksum mismatch")
+
+        meta = json.loads(zlib.decompress(data[:meta_len]))
+        body = zlib.decompress(data[meta_len:])
+
+        received_at = datetime.datetime.utcfromtimestamp(meta['received_at'])\
+                .replace(tzinfo=utc)
+
+        return SpooledRequest( make_ref(segment, offset)
+                             , body
+                             , meta['META']
+                             , received_at
+        )
+
+    def read(self, ref):
+        """
+        Return the SpooledRequest referenced by 'ref'.
+        """
+
+        segment, offset = parse_ref(ref)
+
+        with open(self.segment_path(segment), 'rb') as f:
+            request = self._read_record(f, segment, offset)
+
+        if request is None:
+            raise SpoolException("No record at %s" % ref)
+
+        return request
+
+    def iter_segment(self, segment, offset=0):
+        """
+        Yield (next offset, SpooledRequest) for every record in a segment,
+        starting at 'offset'.
+
+        Corrupt records (e.g. left behind by a crashed writer) are logged and
+        skipped by scanning forward to the next record header.
+        """
+
+        with open(self.segment_path(segment), 'rb') as f:
+            while True:
+                try:
+                    request = self._read_record(f, segment, offset)
+                except SpoolException as e:
+                    logger.warning( "iter_segment(): %s at %s"
+                                  , e, make_ref(segment, offset)
+                    )
+
+                    offset = self._resync(f, offset + 1)
+                    if offset is None:
+                        return
+                    continue
+
+                if request is None:
+                    return
+
+                offset = f.tell()
+                yield offset, request
+
+    def _resync(self, f, offset, chunk_size=2**16):
+        """
+        Return the offset of the next record magic at or after 'offset'.
+        """
+
+        f.seek(offset)
+        while True:
+            data = f.read(chunk_size + len(MAGIC) - 1)
+            if len(data) < len(MAGIC):
+                return None
+
+            index = data.find(MAGIC)
+            if index != -1:
+                return offset + index
+
+            offset += chunk_size
+            f.seek(offset)
+    #}}}
+
+_spool = None
+def get_spool():
+    """
+    Return the process-wide Spool object.
+    """
+
+    global _spool
+    if _spool is None:
+        _spool = Spool()
+
+    return _spool
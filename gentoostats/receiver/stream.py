@@ -0,0 +1,212 @@
+"""
+Incremental parsing of submission bodies.
+
+json.loads() turns the whole body into nested dicts before any work starts,
+which for hosts with thousands of packages means tens of thousands of small
+objects. parse_stream() only decodes the small top-level sections eagerly. The
+PACKAGES map is merely located in the body (by scanning for its closing brace)
+and wrapped in a PackageStream, which decodes its entries on demand and hands
+them out in fixed-size batches.
+
+The body is scanned as the UTF-8 byte string it arrives as (strings are only
+decoded along with the values they belong to), so the memory needed on top of
+the body itself is that of the small sections and of one batch of packages.
+"""
+
+import re
+import json
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Submissions larger than this are rejected before they are read or parsed:
+MAX_SUBMISSION_SIZE = getattr( settings
+                             , 'GENTOOSTATS_MAX_SUBMISSION_SIZE'
+                             , 16 * 2**20
+)
+
+# Number of packages handed to the ingestion stage at a time:
+PACKAGE_BATCH_SIZE = getattr(settings, 'GENTOOSTATS_PACKAGE_BATCH_SIZE', 500)
+
+# Sections that are decoded lazily. WORLDSET is not one of them: it is a few
+# flat lists of atoms (a small fraction of PACKAGES and its per-package dicts),
+# and both validation and ingest_worldset() need all of it at once anyway.
+STREAMED_SECTIONS = ('PACKAGES',)
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+# Strings (which may contain brackets) and brackets:
+TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]', re.DOTALL)
+
+_decoder = json.JSONDecoder()
+
+class StreamError(ValueError): pass
+
+def _skip_whitespace(body, index):
+    return WHITESPACE_RE.match(body, index).end()
+
+def _expect(body, index, char):
+    index = _skip_whitespace(body, index)
+
+    if body[index:index + 1] != char:
+        raise StreamError("Expected '%s' at offset %d" % (char, index))
+
+    return index + 1
+
+def _decode(body, index):
+    """
+    Decode the JSON value starting at (or after whitespace at) 'index'.
+
+    Returns (value, index after the value).
+    """
+
+    index = _skip_whitespace(body, index)
+    return _decoder.raw_decode(body, index)
+
+def _skip_container(body, index):
+    """
+    Return the index after the object or array starting at 'index', without
+    decoding it.
+    """
+
+    depth = 0
+    for match in TOKEN_RE.finditer(body, index):
+        token = match.group()
+
+        if token in ('{', '['):
+            depth += 1
+        elif token in ('}', ']'):
+            depth -= 1
+            if depth == 0:
+                return match.end()
+
+    raise StreamError("Unterminated object at offset %d" % index)
+
+def _iter_members(body, index):
+    """
+    Yield (key, value start index, value end index) for each member of the
+    object starting at 'index'. Values are not decoded.
+    """
+
+    index = _expect(body, index, '{')
+
+    index = _skip_whitespace(body, index)
+    if body[index:index + 1] == '}':
+        return
+
+    while True:
+        key, index = _decode(body, index)
+        index = _expect(body, index, ':')
+        start = _skip_whitespace(body, index)
+
+        if body[start:start + 1] in ('{', '['):
+            index = _skip_container(body, start)
+        else:
+            _, index = _decoder.raw_decode(body, start)
+
+        yield key, start, index
+
+        index = _skip_whitespace(body, index)
+        char  = body[index:index + 1]
+
+        if char == '}':
+            return
+        if char != ',':
+            raise StreamError("Expected ',' or '}' at offset %d" % index)
+
+        index += 1
+
+class PackageStream(object):
+    """
+    The PACKAGES section of a submission, decoded on demand.
+    """
+
+    def __init__(self, body, start):
+        self.body  = body
+        self.start = start
+
+    def _members(self):
+        try:
+            for member in _iter_members(self.body, self.start):
+                yield member
+        except StreamError:
+            raise
+        except (IndexError, ValueError) as e:
+            raise StreamError(str(e))
+
+    def __iter__(self):
+        """
+        Yield (package, info) pairs in the order they appear in the body.
+        """
+
+        for key, start, end in self._members():
+            try:
+                value, _ = _decoder.raw_decode(self.body, start)
+            except ValueError as e:
+                raise StreamError("Invalid entry for '%s': %s" % (key, e))
+
+            yield key, value
+
+    def keys(self):
+        return [key for key, _, _ in self._members()]
+
+    def items(self):
+        return list(self)
+
+def iter_batches(packages, size=PACKAGE_BATCH_SIZE):
+    """
+    Yield lists of at most 'size' (package, info) pairs from a PACKAGES
+    section (a dict or a PackageStream).
+    """
+
+    if packages is None:
+        return
+
+    pairs = iter(packages) if isinstance(packages, PackageStream) \
+            else iter(packages.items())
+
+    batch = []
+    for pair in pairs:
+        batch.append(pair)
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def parse_stream(body):
+    """
+    Parse a submission body like json.loads(), except that the sections in
+    STREAMED_SECTIONS are returned as PackageStream objects.
+
+    Raises StreamError (a ValueError) for malformed bodies. Streamed sections
+    are only checked for balanced brackets here, so iterating over them may
+    raise StreamError as well.
+    """
+
+    data = dict()
+
+    try:
+        index = _expect(body, 0, '{')
+
+        for key, start, end in _iter_members(body, 0):
+            if key in STREAMED_SECTIONS and body[start] == '{':
+                data[key] = PackageStream(body, start)
+            else:
+                data[key], _ = _decoder.raw_decode(body, start)
+
+            index = end
+
+        index = _expect(body, index, '}')
+        if _skip_whitespace(body, index) != len(body):
+            raise StreamError("Extra data at offset %d" % index)
+    except StreamError:
+        raise
+    except (IndexError, ValueError) as e:
+        raise StreamError(str(e))
+
+    return data
@@ -0,0 +1,143 @@
+"""
+Synthetic protocol 2 submissions, for tests and benchmarks.
+
+SubmissionGenerator draws packages, USE flags and world set atoms from a fixed
+catalogue, so consecutive submissions share most of their lookup rows like
+real ones do. With a non-zero host reuse ratio, some submissions come from
+hosts that have submitted before (and mostly report the same packages again).
+"""
+
+import json
+import time
+import uuid
+import random
+
+class SubmissionGenerator(object):
+    def __init__( self
+                , packages        = 1000
+                , useflags        = 500
+                , use_per_package = 10
+                , world_size      = 50
+                , host_reuse      = 0.5
+                , catalogue_size  = 20000
+                , seed            = None
+    ):
+        """
+        'packages' is the number of packages per submission, 'useflags' the
+        number of distinct USE flags, 'use_per_package' the number of IUSE
+        flags per package, 'world_size' the number of atoms in the world set
+        and 'host_reuse' the probability that a submission comes from a host
+        that has submitted before.
+        """
+
+        self.packages        = packages
+        self.use_per_package = use_per_package
+        self.world_size      = world_size
+        self.host_reuse      = host_reuse
+
+        self.random = random.Random(seed)
+
+        self.useflags  = ["flag%d" % i for i in range(max(useflags, 1))]
+
+        # (category, package name, version); categories have to look like
+        # "foo-bar" (see category_validator):
+        self.catalogue = [
+            ( "cat-%d" % (i % 150)
+            , "pkg%d" % i
+            , "%d.%d" % (1 + i % 7, i % 13)
+            )
+            for i in range(max(catalogue_size, packages))
+        ]
+
+        # uuid -> (password, package indices, build times):
+        self.hosts = dict()
+
+    def _new_host(self):
+        host_id  = str(uuid.UUID(int=self.random.getrandbits(128)))
+        password = "%016x" % self.random.getrandbits(64)
+        indices  = self.random.sample(range(len(self.catalogue)), self.packages)
+        built_at = int(time.time()) - 86400 * 30
+
+        self.hosts[host_id] = ( password
+                              , indices
+                              , dict((i, built_at - i) for i in indices)
+        )
+        return host_id
+
+    def _package(self, index, built_at):
+        category, package_name, version = self.catalogue[index]
+
+        iuse = [ self.useflags[(index * 31 + i * 7) % len(self.useflags)]
+                 for i in range(self.use_per_package)
+        ]
+        use = iuse[::2]
+
+        key  = "%s/%s-%s" % (category, package_name, version)
+        info = dict( KEYWORD        = "amd64"
+                   , REPO           = "gentoo"
+                   , BUILD_TIME     = str(built_at)
+                   , BUILD_DURATION = str(index % 600)
+                   , SIZE           = str(1024 * (index % 5000))
+                   , IUSE           = sorted(set(iuse))
+                   , PKGUSE         = []
+                   , USE            = sorted(set(use))
+        )
+
+        return key, info
+
+    def generate(self):
+        """
+        Return the (host UUID, JSON body) of a new submission.
+        """
+
+        if self.hosts and self.random.random() < self.host_reuse:
+            host_id = self.random.choice(sorted(self.hosts))
+        else:
+            host_id = self._new_host()
+
+        password, indices, built_at = self.hosts[host_id]
+
+        # Returning hosts have rebuilt a few packages in the meantime:
+        now = int(time.time())
+        for i in self.random.sample(indices, len(indices) // 20):
+            built_at[i] = now
+
+        packages = dict(self._package(i, built_at[i]) for i in indices)
+
+        world = sorted(
+            "%s/%s" % self.catalogue[i][:2]
+            for i in indices[:self.world_size]
+        )
+
+        data = dict(
+            AUTH     = dict(UUID=host_id, PASSWD=password),
+            PROTOCOL = 2,
+
+            ARCH     = "amd64",
+            CHOST    = "x86_64-pc-linux-gnu",
+            CFLAGS   = "-O2 -pipe",
+            CXXFLAGS = "-O2 -pipe",
+            LDFLAGS  = "-Wl,-O1",
+            MAKEOPTS = "-j4",
+            PROFILE  = "default/linux/amd64/17.1",
+            PLATFORM = "Linux-6.1.57-gentoo-x86_64",
+            LANG     = "en_US.utf8",
+            SYNC     = "rsync://rsync.gentoo.org/gentoo-portage",
+            LASTSYNC = time.strftime( "%a, %d %b %Y %H:%M:%S +0000"
+                                    , time.gmtime(now)
+            ),
+
+            FEATURES        = ["sandbox", "parallel-fetch", "userpriv"],
+            ACCEPT_KEYWORDS = ["amd64"],
+            GENTOO_MIRRORS  = ["http://distfiles.gentoo.org"],
+            USE             = self.random.sample(
+                self.useflags, min(40, len(self.useflags))
+            ),
+
+            PACKAGES = packages,
+            WORLDSET = dict( world    = world
+                           , selected = ["@world", "@system"]
+            ),
+        )
+
+        return host_id, json.dumps(data)
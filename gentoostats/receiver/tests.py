@@ -1,16 +1,764 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+import os
+import gzip
+import json
+import time
+import shutil
+import socket
+import datetime
+import tempfile
+import subprocess
+from StringIO import StringIO
 
-Replace this with more appropriate tests for your application.
-"""
+from portage.exception import InvalidAtom
 
-from django.test import TestCase
+from django.db import connections, transaction, DatabaseError, \
+                      DEFAULT_DB_ALIAS
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
 
+from gentoostats.receiver import atoms, ingest, ingest_queue, metrics, \
+                                 replay, spool, stream, views
+from gentoostats.receiver.models import QueuedSubmission
+from gentoostats.receiver.synthetic import SubmissionGenerator
+from gentoostats.stats import archive, useflags
+from gentoostats.stats.interning import CACHES, useflag_cache
+from gentoostats.stats.rollups import DIMENSIONS, diff_rollups, fold_rollups
+from gentoostats.stats.useflags import get_use_flags
+from gentoostats.stats.models import Host, Submission, Installation, \
+                                     InstallationSet, AtomSet, \
+                                     FeatureRollup, RollupDelta
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+class IngestionTest(TransactionTestCase):
+    """
+    Posts synthetic submissions through accept_submission.
+
+    Ingestion manages its own transactions (and rolls back on errors), hence
+    TransactionTestCase.
+    """
+
+    def setUp(self):
+        # The tables are emptied between tests, the caches have to follow:
+        for cache in CACHES:
+            cache.clear()
+        useflags.clear_cache()
+
+        self.spool_dir = tempfile.mkdtemp(prefix='gentoostats-spool-')
+        self.old_spool = spool._spool
+        spool._spool = spool.Spool(self.spool_dir)
+
+        self.metrics_enabled = metrics.METRICS_ENABLED
+        metrics.METRICS_ENABLED = False
+
+        self.url = reverse('receiver:accept_submission_url')
+        self.generator = SubmissionGenerator( packages   = 50
+                                            , useflags   = 40
+                                            , world_size = 10
+                                            , host_reuse = 0
+                                            , seed       = 1
+        )
+
+    def tearDown(self):
+        spool._spool = self.old_spool
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+        metrics.METRICS_ENABLED = self.metrics_enabled
+
+    def post(self, body):
+        return self.client.post( self.url
+                               , body
+                               , content_type = 'application/json'
+                               , REMOTE_ADDR  = '127.0.0.1'
+        )
+
+    def test_submission(self):
+        host_id, body = self.generator.generate()
+
+        response = self.post(body)
+        self.assertEqual(response.status_code, 200, response.content)
+
+        submission = Submission.objects.get(host__id=host_id)
+        self.assertEqual(submission.installations.count(), 50)
+        self.assertEqual(
+            set(AtomSet.objects.filter(owner=submission)\
+                    .values_list('name', flat=True)),
+            set(['world', 'selected', 'system'])
+        )
+        self.assertEqual(
+            response['X-Gentoostats-Submission'], str(submission.pk)
+        )
+
+    def test_binary_header(self):
+        _, body = self.generator.generate()
+
+        response = self.client.post( self.url
+                                   , body
+                                   , content_type    = 'application/json'
+                                   , REMOTE_ADDR     = '127.0.0.1'
+                                   , HTTP_USER_AGENT = 'client \xff'
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+
+        ref = Submission.objects.get().raw_request_filename
+        self.assertEqual( spool.get_spool().read(ref).META['HTTP_USER_AGENT']
+                        , u'client \ufffd'
+        )
+
+    def test_returning_host(self):
+        self.generator.host_reuse = 1
+        host_id, body = self.generator.generate()
+        self.post(body)
+
+        installations = Installation.objects.count()
+
+        same_host_id, body = self.generator.generate()
+        self.assertEqual(same_host_id, host_id)
+
+        response = self.post(body)
+        self.assertEqual(response.status_code, 200, response.content)
+
+        self.assertEqual(Host.objects.count(), 1)
+        self.assertEqual(Submission.objects.count(), 2)
+        self.assertEqual( Host.objects.get().latest_submission_id
+                        , Submission.objects.latest('id').pk
+        )
+
+        # Only the rebuilt packages (5%) need new installations:
+        self.assertTrue(Installation.objects.count() <= installations + 3)
+        self.assertEqual(InstallationSet.objects.count(), 2)
+
+    def test_unchanged_resubmission(self):
+        _, body = self.generator.generate()
+        self.post(body)
+
+        response = self.post(body)
+        self.assertEqual(response.status_code, 200, response.content)
+
+        first, second = Submission.objects.order_by('id')
+        self.assertEqual(first.installation_set_id, second.installation_set_id)
+        self.assertEqual(InstallationSet.objects.count(), 1)
+
+    def test_delta_submission(self):
+        _, body = self.generator.generate()
+
+        data = json.loads(body)
+        info = data['PACKAGES'].values()[0]
+        for key in ( 'cat-x/foo-1:0'
+                   , 'cat-x/foo-1:1'
+                   , 'cat-x/foo-1:0::overlay'
+                   , 'cat-x/bar-1:0'
+        ):
+            data['PACKAGES'][key] = info
+
+        response = self.post(json.dumps(data))
+        self.assertEqual(response.status_code, 200, response.content)
+        base = Submission.objects.get(pk=response['X-Gentoostats-Submission'])
+        self.assertEqual(base.installations.count(), 54)
+
+        data.update( PROTOCOL = 3
+                   , BASE     = base.pk
+                   , PACKAGES = {'cat-x/bar-2:0': info}
+                   , REMOVED  = ['cat-x/foo-1:0::gentoo', 'cat-x/bar-1']
+        )
+
+        response = self.post(json.dumps(data))
+        self.assertEqual(response.status_code, 200, response.content)
+        submission = Submission.objects.get(
+            pk = response['X-Gentoostats-Submission']
+        )
+
+        # Other slots and repositories of a removed version stay:
+        self.assertEqual(
+            sorted( ( i.package.cp, i.package.version, i.package.slot
+                      , i.package.repository.name
+                    )
+                    for i in submission.installations.select_related()
+                    if i.package.cp.startswith('cat-x/')
+            ),
+            [ ('cat-x/bar', '2', '0', 'gentoo')
+            , ('cat-x/foo', '1', '0', 'overlay')
+            , ('cat-x/foo', '1', '1', 'gentoo')
+            ]
+        )
+        self.assertEqual(submission.installations.count(), 53)
+
+    def test_deadlock_retry(self):
+        _, body = self.generator.generate()
+
+        original = ingest._ingest_submission
+        calls = []
+
+        def deadlocking(*args):
+            calls.append(args)
+            submission = original(*args)
+            if len(calls) == 1:
+                # After writing everything (new lookup rows included):
+                raise DatabaseError("deadlock detected")
+            return submission
+
+        ingest._ingest_submission = deadlocking
+        try:
+            response = self.post(body)
+        finally:
+            ingest._ingest_submission = original
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Submission.objects.count(), 1)
+
+        for dimension in DIMENSIONS:
+            self.assertEqual(diff_rollups(dimension), [], dimension.name)
+
+    def test_base_without_installation_set(self):
+        _, body = self.generator.generate()
+        response = self.post(body)
+
+        # As if stored before build_installation_sets has run:
+        base_id = int(response['X-Gentoostats-Submission'])
+        Submission.objects.filter(pk=base_id).update(installation_set=None)
+
+        data = json.loads(body)
+        data.update(PROTOCOL=3, BASE=base_id, PACKAGES={}, REMOVED=[])
+
+        response = self.post(json.dumps(data))
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('Please send a full submission' in response.content)
+        self.assertEqual(Submission.objects.count(), 1)
+
+    def test_replay_delta_submission(self):
+        _, body = self.generator.generate()
+        response = self.post(body)
+        base_id = int(response['X-Gentoostats-Submission'])
+        base_ref = Submission.objects.get(pk=base_id).raw_request_filename
+
+        data = json.loads(body)
+        data.update(PROTOCOL=3, BASE=base_id, PACKAGES={}, REMOVED=[])
+        response = self.post(json.dumps(data))
+        self.assertEqual(response.status_code, 200, response.content)
+
+        records = [ (r.ref, r.body, r.META, r.received_at)
+                    for _, r in replay.iter_spool()
+        ]
+        base_refs = replay.load_base_refs(records, DEFAULT_DB_ALIAS)
+        self.assertEqual(base_refs, {records[1][0]: base_ref})
+
+        # Replaying into an empty database, where the BASE's id is soon taken
+        # by a submission of another host:
+        Host.objects.update(latest_submission=None)
+        Submission.objects.all().delete()
+        Host.objects.all().delete()
+
+        _, body = self.generator.generate()
+        self.post(body)
+
+        # Without the original database, the BASE can't be told:
+        self.assertEqual( replay.replay_partition((records[1:], dict()))
+                        , ['failed']
+        )
+
+        self.assertEqual( replay.replay_partition((records, base_refs))
+                        , ['done', 'done']
+        )
+
+        base  = Submission.objects.get(raw_request_filename=base_ref)
+        delta = Submission.objects.get(raw_request_filename=records[1][0])
+        self.assertNotEqual(base.pk, base_id)
+        self.assertEqual(delta.base_request, base_ref)
+        self.assertEqual(delta.installation_set_id, base.installation_set_id)
+
+    def test_rollups(self):
+        self.generator.host_reuse = 0.5
+        for _ in range(6):
+            _, body = self.generator.generate()
+            response = self.post(body)
+            self.assertEqual(response.status_code, 200, response.content)
+
+        for dimension in DIMENSIONS:
+            self.assertEqual(diff_rollups(dimension), [], dimension.name)
+
+        # Ingests only record their changes:
+        self.assertEqual(FeatureRollup.objects.count(), 0)
+        self.assertTrue(fold_rollups(batch_size=10) > 10)
+        self.assertEqual(RollupDelta.objects.count(), 0)
+
+        for dimension in DIMENSIONS:
+            self.assertEqual(diff_rollups(dimension), [], dimension.name)
+
+    def test_compact_use_flags(self):
+        ingest.COMPACT_USE_FLAGS = True
+        try:
+            _, body = self.generator.generate()
+            response = self.post(body)
+            self.assertEqual(response.status_code, 200, response.content)
+        finally:
+            ingest.COMPACT_USE_FLAGS = False
+
+        packages = json.loads(body)['PACKAGES']
+        for installation in Installation.objects.select_related('package'):
+            package = installation.package
+            info = packages["%s-%s" % (package.cp, package.version)]
+
+            self.assertEqual(installation.iuse.count(), 0)
+            self.assertEqual(
+                [sorted(flags) for flags in get_use_flags(installation)],
+                [sorted(info[f]) for f in ('IUSE', 'PKGUSE', 'USE')]
+            )
+
+    def test_pack_use_flags(self):
+        for _ in range(2):
+            _, body = self.generator.generate()
+            response = self.post(body)
+            self.assertEqual(response.status_code, 200, response.content)
+
+        expected = dict( (i.pk, [sorted(flags) for flags in get_use_flags(i)])
+                         for i in Installation.objects.all()
+        )
+
+        call_command( 'pack_use_flags'
+                    , batch_size   = 7
+                    , delete_links = True
+                    , stdout       = StringIO()
+        )
+
+        for installation in Installation.objects.all():
+            self.assertEqual(installation.iuse.count(), 0)
+            self.assertEqual(
+                [sorted(flags) for flags in get_use_flags(installation)],
+                expected[installation.pk]
+            )
+
+    def test_archive(self):
+        self.generator.host_reuse = 1
+        for _ in range(3):
+            _, body = self.generator.generate()
+            response = self.post(body)
+            self.assertEqual(response.status_code, 200, response.content)
+
+        latest = Host.objects.get().latest_submission_id
+        Submission.objects.update(
+            datetime = timezone.now() - datetime.timedelta(days=365)
+        )
+        InstallationSet.objects.update(
+            added_on = timezone.now() - datetime.timedelta(days=365)
+        )
+
+        archive_dir = tempfile.mkdtemp(prefix='gentoostats-archive-')
+        old_archive_dir = archive.ARCHIVE_DIR
+        archive.ARCHIVE_DIR = archive_dir
+        try:
+            self.assertEqual(archive.archive_submissions(days=30), 2)
+
+            records = []
+            for name in os.listdir(archive_dir):
+                with gzip.open(os.path.join(archive_dir, name)) as f:
+                    records.extend(json.loads(line) for line in f)
+        finally:
+            archive.ARCHIVE_DIR = old_archive_dir
+            shutil.rmtree(archive_dir, ignore_errors=True)
+
+        self.assertEqual(Submission.objects.get().pk, latest)
+        self.assertEqual(AtomSet.objects.count(), 3)
+        self.assertEqual(InstallationSet.objects.count(), 1)
+
+        models = [r['model'] for r in records]
+        self.assertEqual(models.count('stats.submission'), 2)
+        self.assertEqual(models.count('stats.atomset'), 6)
+        self.assertEqual(models.count('stats.installationset'), 2)
+
+        # The rollups still count the archived submissions:
+        for dimension in DIMENSIONS:
+            self.assertEqual(diff_rollups(dimension), [], dimension.name)
+
+    def test_archive_without_latest_submission(self):
+        self.generator.host_reuse = 1
+        for _ in range(2):
+            _, body = self.generator.generate()
+            self.post(body)
+
+        Submission.objects.update(
+            datetime = timezone.now() - datetime.timedelta(days=365)
+        )
+        Host.objects.update(latest_submission=None)
+
+        self.assertRaises(archive.ArchiveError, archive.archive_submissions)
+        self.assertEqual(Submission.objects.count(), 2)
+
+    def test_queue_order(self):
+        self.generator.host_reuse = 1
+
+        items = []
+        for n in range(2):
+            _, body = self.generator.generate()
+            ref = spool.get_spool().append(
+                dict(META=dict(REMOTE_ADDR='127.0.0.1'), received_at=n), body
+            )
+            items.append(ingest_queue.enqueue(ref, json.loads(body)))
+
+        # The later report has been queued first (e.g. by a retrying proxy):
+        later, earlier = items
+        QueuedSubmission.objects.filter(pk=earlier.pk).update(
+            received_at = later.received_at - datetime.timedelta(minutes=1)
+        )
+
+        first = ingest_queue.claim('worker-1')
+        self.assertEqual(first.pk, earlier.pk)
+
+        # The other item has to wait until the host's first one is done:
+        self.assertEqual(ingest_queue.claim('worker-2'), None)
+        self.assertTrue(ingest_queue.process(first))
+
+        second = ingest_queue.claim('worker-2')
+        self.assertEqual(second.pk, later.pk)
+        self.assertTrue(ingest_queue.process(second))
+
+        self.assertEqual(
+            Host.objects.get().latest_submission_id,
+            QueuedSubmission.objects.get(pk=later.pk).submission_id
+        )
+
+        for dimension in DIMENSIONS:
+            self.assertEqual(diff_rollups(dimension), [], dimension.name)
+
+    def test_queue_invalid_uuid(self):
+        _, body = self.generator.generate()
+        data = json.loads(body)
+        data['AUTH']['UUID'] = 'abcdefghijklmnop'
+
+        async_ingest = views.ASYNC_INGEST
+        views.ASYNC_INGEST = True
+        try:
+            response = self.post(json.dumps(data))
+        finally:
+            views.ASYNC_INGEST = async_ingest
+
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('UUID' in response.content, response.content)
+        self.assertEqual(QueuedSubmission.objects.count(), 0)
+
+    def test_installation_race(self):
+        _, body = self.generator.generate()
+        self.post(body)
+
+        installations = Installation.objects.count()
+        links = Installation.use.through.objects.count()
+
+        # As if a concurrent submission had created the same installations
+        # between the lookup and the INSERT:
+        parsed = [ ingest.parse_package(package, info)
+                   for package, info in json.loads(body)['PACKAGES'].items()
+        ]
+        ingest.add_state_hashes(parsed)
+        with transaction.commit_on_success():
+            ingest.create_installations(parsed)
+
+        self.assertEqual(Installation.objects.count(), installations)
+        self.assertEqual(Installation.use.through.objects.count(), links)
+        self.assertEqual(
+            set(p['installation_id'] for p in parsed),
+            set(Installation.objects.values_list('id', flat=True))
+        )
+
+    def test_interned_objects(self):
+        host_id, body = self.generator.generate()
+        self.post(body)
+
+        name = Submission.objects.get(host__id=host_id).global_use.all()[0].name
+
+        first  = useflag_cache.get(name)
+        second = useflag_cache.get(name)
+        self.assertEqual(first.pk, second.pk)
+        self.assertFalse(first is second)
+
+        # Callers don't share (and can't spoil) each other's objects:
+        first.name = 'changed'
+        self.assertEqual(useflag_cache.get(name).name, name)
+
+    def test_metrics(self):
+        metrics_dir = metrics.METRICS_DIR
+        metrics.METRICS_DIR = tempfile.mkdtemp(prefix='gentoostats-metrics-')
+        metrics.METRICS_ENABLED = True
+        try:
+            _, body = self.generator.generate()
+            self.post(body)
+            metrics.flush(force=True)
+
+            # The files of an exited process and of a host that hasn't
+            # written its file for too long:
+            exited = subprocess.Popen(['true'])
+            exited.wait()
+
+            stale = [ "metrics-%s-%d.json" % (socket.gethostname(), exited.pid)
+                    , "metrics-otherhost-1.json"
+            ]
+            for name in stale:
+                path = os.path.join(metrics.METRICS_DIR, name)
+                with open(path, 'w') as f:
+                    json.dump(metrics._histograms.data, f)
+
+            old = time.time() - metrics.METRICS_MAX_AGE - 60
+            os.utime(path, (old, old))
+
+            # stage -> (count, mean number of queries):
+            rows = dict( (row[0], (row[2], row[5]))
+                         for row in metrics.load_metrics().rows()
+            )
+            remaining = os.listdir(metrics.METRICS_DIR)
+        finally:
+            metrics.reset_metrics()
+            shutil.rmtree(metrics.METRICS_DIR, ignore_errors=True)
+            metrics.METRICS_DIR = metrics_dir
+
+        self.assertEqual(rows['total'][0], 1)
+        self.assertEqual(len(remaining), 1)
+        self.assertFalse(set(stale) & set(remaining))
+
+        self.assertTrue(rows['packages'][1] > 0)
+        self.assertTrue( rows['total'][1]
+                       >= rows['packages'][1] + rows['rollups'][1]
+        )
+
+        # The cursors of the connection are no longer wrapped:
+        self.assertFalse('cursor' in vars(connections[DEFAULT_DB_ALIAS]))
+
+    def test_wrong_password(self):
+        _, body = self.generator.generate()
+        self.post(body)
+
+        data = json.loads(body)
+        data['AUTH']['PASSWD'] = 'wrong'
+
+        response = self.post(json.dumps(data))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Submission.objects.count(), 1)
+
+    def test_invalid_use_flag(self):
+        _, body = self.generator.generate()
+
+        data = json.loads(body)
+        data['USE'].append('not a flag')
+
+        response = self.post(json.dumps(data))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Submission.objects.count(), 0)
+
+    def test_invalid_values(self):
+        _, body = self.generator.generate()
+
+        def package_use(value):
+            def change(data):
+                data['PACKAGES'].values()[0]['USE'] = value
+            return change
+
+        for change in ( lambda data: data.update(FEATURES='sandbox')
+                      , lambda data: data.update(REMOVED='cat-a/pkg-1')
+                      , lambda data: data.update(WORLDSET=['@world'])
+                      , lambda data: data.update(WORLDSET={'world': 'cat-a/pkg'})
+                      , lambda data: data.update(WORLDSET={'world': ['cat-a/pkg-1']})
+                      , lambda data: data.update(WORLDSET={'x' * 200: []})
+                      , lambda data: data['PACKAGES'].update(
+                            {'nocategory/pkg-1': dict(KEYWORD='amd64')}
+                        )
+                      , package_use('ssl')
+                      , package_use(1)
+        ):
+            # Twice, as values are only cached once they have passed:
+            for i in range(2):
+                data = json.loads(body)
+                change(data)
+
+                response = self.post(json.dumps(data))
+                self.assertEqual(response.status_code, 400, response.content)
+
+                # Rejected by the checks, not by whatever trips over it:
+                self.assertFalse( 'went wrong' in response.content
+                                , response.content
+                )
+
+        self.assertEqual(Submission.objects.count(), 0)
+
+        # The values checked in the meantime are still accepted:
+        response = self.post(body)
+        self.assertEqual(response.status_code, 200, response.content)
+
+class SpoolTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gentoostats-spool-')
+
+        # Small enough for every few records to start a new segment:
+        self.spool = spool.Spool(self.directory, segment_size=300)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def append(self, n):
+        meta = dict(META=dict(REMOTE_ADDR='10.0.0.%d' % n), received_at=n)
+        return self.spool.append(meta, "request %d " % n * 10)
+
+    def test_read_back(self):
+        refs = [self.append(n) for n in range(10)]
+
+        self.assertTrue(len(self.spool.segments()) > 1)
+        self.assertEqual(len(set(refs)), 10)
+
+        for n, ref in enumerate(refs):
+            request = self.spool.read(ref)
+            self.assertEqual(request.ref, ref)
+            self.assertEqual(request.body, "request %d " % n * 10)
+            self.assertEqual(request.META['REMOTE_ADDR'], '10.0.0.%d' % n)
+            self.assertEqual( request.received_at
+                            , datetime.datetime(1970, 1, 1, 0, 0, n
+                                               , tzinfo=timezone.utc)
+            )
+
+        read = [ request.ref for segment in self.spool.segments()
+                 for _, request in self.spool.iter_segment(segment)
+        ]
+        self.assertEqual(read, refs)
+
+    def test_corrupt_record(self):
+        refs = [self.append(n) for n in range(3)]
+
+        segment, offset = spool.parse_ref(refs[1])
+        with open(self.spool.segment_path(segment), 'r+b') as f:
+            f.seek(offset + spool.HEADER.size)
+            f.write(b'garbage')
+
+        self.assertRaises(spool.SpoolException, self.spool.read, refs[1])
+
+        read = [ request.ref for segment in self.spool.segments()
+                 for _, request in self.spool.iter_segment(segment)
+        ]
+        self.assertEqual(read, [refs[0], refs[2]])
+
+class StreamTest(SimpleTestCase):
+    def setUp(self):
+        generator = SubmissionGenerator(packages=30, seed=1)
+        _, self.body = generator.generate()
+
+    def test_same_as_json(self):
+        data = stream.parse_stream(self.body)
+        expected = json.loads(self.body)
+
+        self.assertTrue(isinstance(data['PACKAGES'], stream.PackageStream))
+        self.assertEqual( dict(data.pop('PACKAGES').items())
+                        , expected.pop('PACKAGES')
+        )
+        self.assertEqual(data, expected)
+
+    def test_batches(self):
+        packages = stream.parse_stream(self.body)['PACKAGES']
+
+        batches = list(stream.iter_batches(packages, size=7))
+        self.assertEqual([len(b) for b in batches], [7, 7, 7, 7, 2])
+        self.assertEqual( [k for b in batches for k, _ in b]
+                        , packages.keys()
+        )
+
+    def test_empty_packages(self):
+        data = stream.parse_stream('{"PACKAGES": {}, "PROTOCOL": 2}')
+
+        self.assertEqual(list(stream.iter_batches(data['PACKAGES'])), [])
+        self.assertEqual(data['PROTOCOL'], 2)
+
+    def test_malformed(self):
+        for body in ( ''
+                    , '{"PACKAGES": {"a": {"b": 1}}'
+                    , '{"PACKAGES": {"a": }}'
+                    , '{"PROTOCOL": 2 "PACKAGES": {}}'
+                    , '["PACKAGES"]'
+                    , '{"PACKAGES": {}} {"PACKAGES": {}}'
+                    , '{"PROTOCOL": 2}]'
+                    , '{} x'
+        ):
+            def parse():
+                data = stream.parse_stream(body)
+                list(stream.iter_batches(data.get('PACKAGES')))
+
+            self.assertRaises(stream.StreamError, parse)
+
+    def test_trailing_whitespace(self):
+        data = stream.parse_stream('{"PROTOCOL": 2}\r\n')
+        self.assertEqual(data, dict(PROTOCOL=2))
+
+    def test_utf8(self):
+        body = u'{"PACKAGES": {"cat/p\xe9-1": {"USE": ["\xe9"]}}}'
+
+        packages = stream.parse_stream(body.encode('utf-8'))['PACKAGES']
+        self.assertEqual(packages.items(), [(u'cat/p\xe9-1', dict(USE=[u'\xe9']))])
+
+class AtomParserTest(SimpleTestCase):
+    """
+    Checks parse_atom() (and its regular expressions in particular) against
+    portage.
+    """
+
+    VALID = ( '=sys-libs/glibc-2.37-r3'
+            , '=cat-a/pkg-1.0:0'
+            , '=cat-a/pkg-1.0:0/1.2::gentoo'
+            , '=cat-a/pkg-1.0_alpha1_p2-r3'
+            , '=cat-a/pkg-1a'
+            , '=cat-a/pkg-01.002'
+            , '=app-foo/bar-baz-1'
+            , '=cat+x/pkg-1'
+            , '=cat-a/pkg+-1'
+            , 'cat-a/pkg'
+            , 'cat-a/pkg:2'
+            , 'cat-a/pkg::overlay'
+            , 'dev-lang/python:3.11'
+            , 'virtual/pkg'
+            , 'Cat-A/Pkg'
+
+              # Only handled by portage:
+            , '>=cat-a/pkg-1'
+            , '<cat-a/pkg-1.0_rc1'
+            , '~cat-a/pkg-1'
+            , '=cat-a/pkg-1*'
+            , '!cat-a/pkg'
+            , '!!cat-a/pkg'
+            , 'cat-a/pkg[ssl]'
+            , '=cat-a/pkg-1[-ssl,foo?]'
+            , 'cat-a/pkg:*'
+            , 'cat-a/pkg:='
+            , 'cat-a/pkg:0='
+    )
+
+    INVALID = ( 'cat-a'
+              , 'cat-a/pkg-1'
+              , 'cat-a/pkg-1a'
+              , 'app-foo/bar-baz-1'
+              , '=cat-a/pkg'
+              , '=cat-a/pkg-1-r'
+              , '=cat-a/pkg-1.0.'
+              , '=-cat/pkg-1'
+              , '=cat-a/-pkg-1'
+              , 'cat-a/pkg:'
+              , '=cat-a/pkg-1:0/'
+              , '=cat-a/pkg-1::'
+              , '=cat-a/pkg-1:0::'
+              , 'cat-a/pkg::-repo'
+    )
+
+    def setUp(self):
+        atoms.clear_cache()
+
+    def test_valid(self):
+        for atom in self.VALID:
+            expected = atoms._parse_portage(atom)
+
+            self.assertEqual(atoms.parse_atom(atom), expected, atom)
+            # Cached:
+            self.assertEqual(atoms.parse_atom(atom), expected, atom)
+
+            self.assertTrue( atoms._parse_fast(atom) in (None, expected)
+                           , atom
+            )
+
+    def test_invalid(self):
+        for atom in self.INVALID:
+            self.assertRaises(InvalidAtom, atoms._parse_portage, atom)
+            self.assertEqual(atoms._parse_fast(atom), None, atom)
+
+            self.assertRaises(InvalidAtom, atoms.parse_atom, atom)
+            # Not cached:
+            self.assertRaises(InvalidAtom, atoms.parse_atom, atom)
@@ -9,4 +9,9 @@ urlpatterns = patterns('gentoostats.receiver.views',
        , 'accept_submission'
        , name='accept_submission_url'
     ),
+
+    url( r'^metrics/?$'
+       , 'ingest_metrics'
+       , name='ingest_metrics_url'
+    ),
 )
@@ -1,55 +1,68 @@
 import os
 import time
 import pickle
-import random
 import logging
 
+from .spool import get_spool, parse_ref
+
 PROJECT_DIR = os.path.dirname(__file__)
 
 logger = logging.getLogger(__name__)
 
-class FileExistsException(Exception): pass
 class BadRequestException(Exception): pass
 
-# This should be defined at the module level:
+# Requests saved by older versions are pickled instances of this class, so it
+# has to stay defined at the module level:
 class SimpleHttpRequest(object):
     def __init__(self, request):
         self.body = request.body
-        self.META = filter( lambda x: isinstance(x[1], basestring)
-                          , request.META.items()
+        self.META = dict(
+            filter( lambda x: isinstance(x[1], basestring)
+                  , request.META.items()
+            )
         )
 
 def save_request(request):
     """
-    Saves all 'str' or 'unicode' properties of a Django Request object in a
-    file.
+    Saves the body and all 'str' or 'unicode' META variables of a Django Request
+    object in the request spool.
 
-    Returns the name of the newly created file.
+    Returns a reference to the saved request (see spool.make_ref()).
 
-    Throws FileExistsException if a new file could not be created.
+    Throws SpoolException if the request could not be saved.
     """
 
-    ip_addr = request.META['REMOTE_ADDR']
-
     # We can't serialise the whole object, so we only serialise the strings:
     request_copy = SimpleHttpRequest(request)
 
-    # current unix timestamp, without microseconds:
-    timestamp = str(int(time.time()))
+    # Header values are whatever bytes the client sent, but records are JSON:
+    meta = dict(
+        META        = dict(
+            (k, v.decode('utf-8', 'replace') if isinstance(v, str) else v)
+            for k, v in request_copy.META.items()
+        ),
+        received_at = time.time(),
+    )
+
+    return get_spool().append(meta, request_copy.body)
 
-    # append a random int, just for safety
-    random_int = random.randint(1, 1024)
+def load_request(raw_request_filename):
+    """
+    Load a request saved by save_request().
+
+    Also accepts the file names of pickled requests saved by older versions.
+    Returns an object with 'body' and 'META' attributes.
+    """
 
-    file_name = "%s-%s-%s" % (ip_addr, timestamp, random_int)
-    file_path = os.path.join(PROJECT_DIR, 'requests', file_name)
+    if parse_ref(raw_request_filename):
+        return get_spool().read(raw_request_filename)
 
-    if os.path.exists(file_path):
-        error_message = "File '%s' already exists" % (file_path)
+    file_path = os.path.join(PROJECT_DIR, 'requests', raw_request_filename)
 
-        logger.error("save_request(): %s" % (error_message))
-        raise FileExistsException(error_message)
+    with open(file_path, 'rb') as f:
+        request = pickle.load(f)
 
-    with open(file_path, 'wb') as f:
-        pickle.dump(request_copy, f)
+    # Older versions stored META as a list of (key, value) pairs:
+    request.META = dict(request.META)
 
-    return file_name
+    return request
@@ -0,0 +1,162 @@
+"""
+Validation of raw submission values before anything is written.
+
+The strings of a submission are checked against the validators of the model
+fields they end up in (category_validator, use_flag_validator, max_length,
+etc.), so the ingest path doesn't need to full_clean() every object it touches.
+Values that passed are remembered in an LRU cache, and as most values (USE
+flags, keywords, categories, ...) recur in nearly every submission, the checks
+quickly become dictionary lookups.
+
+Model-level validation (validate_new_item()) is still done for rows that are
+about to be created.
+"""
+
+import logging
+
+from portage.exception import InvalidAtom
+from portage._sets import SETPREFIX as SET_PREFIX
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from .util import BadRequestException
+from .atoms import parse_atom
+from gentoostats.stats.util import LRUCache
+from gentoostats.stats.models import Host, Feature, UseFlag, Keyword, \
+                                    MirrorServer, Lang, SyncServer, \
+                                    Category, PackageName, Repository, \
+                                    Package, Atom, AtomSet
+
+logger = logging.getLogger(__name__)
+
+VALIDATION_CACHE_SIZE = getattr( settings
+                               , 'GENTOOSTATS_VALIDATION_CACHE_SIZE'
+                               , 100000
+)
+
+_valid = LRUCache(VALIDATION_CACHE_SIZE)
+
+def check_values(model, field_name, values, what=None):
+    """
+    Run the validators of model field 'field_name' on each of 'values' (None
+    is skipped). Raises BadRequestException for the first invalid value.
+    """
+
+    field = model._meta.get_field(field_name)
+
+    for value in values:
+        if value is None:
+            continue
+
+        key = (model.__name__, field_name, value)
+        if _valid.get(key):
+            continue
+
+        try:
+            if not isinstance(value, basestring):
+                raise ValidationError("Not a string.")
+
+            field.run_validators(value)
+        except (ValidationError, TypeError) as e:
+            error_message = "Error: %s '%s' failed validation." % (
+                what or field.verbose_name.capitalize(), value
+            )
+            logger.info("check_values(): " + error_message, exc_info=True)
+            raise BadRequestException(error_message)
+
+        _valid.set(key, True)
+
+def _check_list(data, key):
+    """
+    Return data[key], which must be a list (or missing).
+    """
+
+    values = data.get(key) or []
+
+    if not isinstance(values, list):
+        error_message = "Error: %s must be a list." % key
+        logger.info("_check_list(): " + error_message)
+        raise BadRequestException(error_message)
+
+    return values
+
+def validate_submission(data):
+    """
+    Check all values of a submission (as returned by parse_submission()),
+    except for the PACKAGES section (see validate_packages()).
+    """
+
+    check_values(Host, 'id',         [data['AUTH']['UUID'].lower()], "UUID")
+    check_values(Host, 'upload_key', [data['AUTH']['PASSWD']],
+                 "Password (is it too long?)")
+
+    check_values(Feature,      'name', _check_list(data, 'FEATURES'),        "FEATURE")
+    check_values(UseFlag,      'name', _check_list(data, 'USE'),             "USE flag")
+    check_values(Keyword,      'name', _check_list(data, 'ACCEPT_KEYWORDS'), "Keyword")
+    check_values(MirrorServer, 'url',  _check_list(data, 'GENTOO_MIRRORS'),  "Mirror")
+
+    check_values(Lang,       'name', [data.get('LANG') or None], "LANG")
+    check_values(SyncServer, 'url',  [data.get('SYNC') or None], "SYNC")
+
+    _check_list(data, 'REMOVED')
+
+    reported_sets = data.get('WORLDSET') or dict()
+    if not isinstance(reported_sets, dict):
+        error_message = "Error: WORLDSET must be a dictionary."
+        logger.info("validate_submission(): " + error_message)
+        raise BadRequestException(error_message)
+
+    check_values(AtomSet, 'name', reported_sets.keys(), "Set")
+
+    for entries in reported_sets.values():
+        if not isinstance(entries, list) or \
+           not all(isinstance(e, basestring) for e in entries):
+            error_message = "Error: WORLDSET entries must be lists."
+            logger.info("validate_submission(): " + error_message)
+            raise BadRequestException(error_message)
+
+        subsets = [e for e in entries if e.startswith(SET_PREFIX)]
+        atoms   = [e for e in entries if not e.startswith(SET_PREFIX)]
+
+        check_values(AtomSet, 'name', [s[len(SET_PREFIX):] for s in subsets], "Set")
+        check_values(Atom, 'full_atom', atoms, "Atom")
+
+        parsed = []
+        for entry in atoms:
+            try:
+                parsed.append(parse_atom(entry))
+            except InvalidAtom as e:
+                error_message = "Error: Atom '%s' failed validation." % entry
+                logger.info("validate_submission(): " + error_message, exc_info=True)
+                raise BadRequestException(error_message)
+
+        check_values(Category,    'name',    [a.category     for a in parsed])
+        check_values(PackageName, 'name',    [a.package_name for a in parsed])
+        check_values(Atom,        'version', [a.version or None for a in parsed])
+        check_values(Atom,        'slot',    [a.slot         for a in parsed])
+        check_values(Repository,  'name',    [a.repo         for a in parsed])
+
+def validate_packages(parsed):
+    """
+    Check the values of packages parsed by parse_package().
+    """
+
+    for p in parsed:
+        if not all(isinstance(p[f], list) for f in ('iuse', 'pkguse', 'use')):
+            error_message = "Error: Invalid USE data for '%s'." % p['atom']
+            logger.info("validate_packages(): " + error_message)
+            raise BadRequestException(error_message)
+
+    check_values(Category,    'name',    [p['category']     for p in parsed])
+    check_values(PackageName, 'name',    [p['package_name'] for p in parsed])
+    check_values(Package,     'version', [p['version']      for p in parsed])
+    check_values(Package,     'slot',    [p['slot']         for p in parsed])
+    check_values(Repository,  'name',    [p['repo']         for p in parsed])
+    check_values(Keyword,     'name',    [p['keyword']      for p in parsed])
+
+    check_values(
+        UseFlag, 'name',
+        (u for p in parsed for u in p['iuse'] + p['pkguse'] + p['use']),
+        "USE flag",
+    )
@@ -0,0 +1,202 @@
+"""
+Popularity of applications among the hosts with a fresh latest submission.
+
+The catalog (GENTOOSTATS_APP_CATALOG, DEFAULT_APP_CATALOG by default) is a list
+of sections:
+
+    [section name, [app name, cp, cp, ...], [app name, cp, ...], ...]
+
+where an app counts as installed on a host if any of its packages is.
+app_stats() counts the hosts of every tracked package and app in one pass:
+hosts with the same installation set are counted together, and only the links
+of those sets to tracked packages are fetched.
+"""
+
+from __future__ import division
+
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Submission, InstallationSet
+
+DEFAULT_APP_CATALOG = [
+    [ 'Browsers'
+    ,   ['Chrome', 'www-client/google-chrome', 'www-client/chromium']
+    ,   ['Firefox', 'www-client/firefox', 'www-client/firefox-bin']
+    ,   ['Opera', 'www-client/opera']
+    ,   ['Epiphany', 'www-client/epiphany']
+    ,   ['Konqueror', 'kde-base/konqueror']
+    ,   ['rekonq', 'www-client/rekonq']
+    ,   ['Conkeror', 'www-client/conkeror']
+    ,   ['Midori', 'www-client/midori']
+    ,   ['Uzbl', 'www-client/uzbl']
+    ],
+
+    [ 'CLI Browsers'
+    ,   ['Wget', 'net-misc/wget']
+    ,   ['cURL', 'net-misc/curl']
+    ,   ['Lynx', 'www-client/lynx']
+    ,   ['Links', 'www-client/links']
+    ,   ['ELinks', 'www-client/elinks']
+    ,   ['W3M', 'www-client/w3m', 'www-client/w3mmee']
+    ],
+
+    [ 'Editors/IDEs'
+    ,   ['Vi/Vim', 'app-editors/vim', 'app-editors/gvim', 'app-editors/nvi', 'app-editors/elvis']
+    ,   ['Emacs', 'app-editors/emacs', 'app-editors/qemacs', 'app-editors/xemacs', 'app-editors/jove']
+    ,   ['Eclipse', 'dev-util/eclipse-sdk']
+    ,   ['Yi', 'app-editors/yi']
+    ,   ['Nano', 'app-editors/nano']
+    ,   ['Gedit', 'app-editors/gedit']
+    ,   ['Kate', 'kde-base/kate']
+    ,   ['Kwrite', 'kde-base/kwrite']
+    ,   ['Ne', 'app-editors/ne']
+    ,   ['Jed', 'app-editors/jed']
+    ,   ['Jedit', 'app-editors/jedit']
+    ,   ['Joe', 'app-editors/joe']
+    ,   ['Ed', 'sys-apps/ed']
+    ,   ['Leafpad', 'app-editors/leafpad']
+    ,   ['Geany', 'dev-util/geany']
+    ],
+
+    [ 'Desktop Environments'
+    ,   ['KDE SC', 'kde-base/kdebase-meta']
+    ,   ['GNOME', 'gnome-base/gnome']
+    ,   ['Xfce', 'xfce-base/xfce4-meta']
+    ,   ['LXDE', 'lxde-base/lxde-meta']
+    #,   ['E17', 'dev-libs/ecore']
+    ],
+
+    [ 'Window Managers'
+    ,   ['Xmonad', 'x11-wm/xmonad']
+    ,   ['Ratpoison', 'x11-wm/ratpoison']
+    ,   ['Openbox', 'x11-wm/openbox']
+    ,   ['Fluxbox', 'x11-wm/fluxbox']
+    ,   ['Enlightenment', 'x11-wm/enlightenment']
+    ,   ['dwm', 'x11-wm/dwm']
+    ,   ['i3', 'x11-wm/i3']
+    ,   ['Compiz', 'x11-wm/compiz', 'x11-wm/compiz-fusion']
+    ,   ['FVWM', 'x11-wm/fvwm']
+    ,   ['Wmii', 'x11-wm/wmii']
+    ,   ['Window Maker', 'x11-wm/windowmaker']
+    ,   ['subtle', 'x11-wm/subtle']
+    ,   ['awesome', 'x11-wm/awesome']
+    ,   ['evilwm', 'x11-wm/evilwm']
+    ,   ['IceWM', 'x11-wm/icewm']
+    ],
+
+    [ 'Shells'
+    ,   ['Bash', 'app-shells/bash']
+    ,   ['Zsh', 'app-shells/zsh']
+    ,   ['Tcsh', 'app-shells/tcsh']
+    ,   ['fish', 'app-shells/fish']
+    ],
+
+    [ 'Web servers'
+    ,   ['Apache', 'www-servers/apache']
+    ,   ['Nginx', 'www-servers/nginx']
+    ,   ['lighttpd', 'www-servers/lighttpd']
+    ],
+
+    [ 'Graphics Drivers'
+    ,   ['Nvidia (proprietary)', 'x11-drivers/nvidia-drivers']
+    ,   ['Nouveau', 'x11-drivers/xf86-video-nouveau']
+    ,   ['fglrx (proprietary)', 'x11-drivers/ati-drivers']
+    ,   ['radeon', 'x11-drivers/xf86-video-ati']
+    ,   ['Intel', 'x11-drivers/xf86-video-intel']
+    ],
+]
+
+APP_CATALOG = getattr(settings, 'GENTOOSTATS_APP_CATALOG', DEFAULT_APP_CATALOG)
+
+# Only hosts whose latest submission is at most this many days old count:
+FRESH_SUBMISSION_MAX_AGE = 30
+
+# In seconds:
+CACHE_TIMEOUT = getattr(settings, 'GENTOOSTATS_APP_STATS_CACHE_TIMEOUT', 10 * 60)
+CACHE_KEY     = 'gentoostats:app_stats'
+
+def count_hosts(cps, since):
+    """
+    Return (number of hosts, {installation set ID: number of hosts}, {cp: set
+    of installation set IDs}) for the hosts whose latest submission is newer
+    than 'since', and the tracked packages 'cps'.
+    """
+
+    fresh = Submission.objects.latest_submissions.order_by()\
+            .filter(datetime__gte=since)
+
+    hosts = defaultdict(int)
+    for set_id, num_hosts in fresh.values_list('installation_set')\
+                                  .annotate(num_hosts=Count('pk')):
+        hosts[set_id] += num_hosts
+
+    through = InstallationSet.installations.through
+    rows = through.objects.order_by()\
+            .filter( installationset__in          = fresh.values('installation_set')
+                   , installation__package__cp__in = list(cps)
+            )\
+            .values_list('installationset', 'installation__package__cp')\
+            .distinct()
+
+    sets = defaultdict(set)
+    for set_id, cp in rows:
+        sets[cp].add(set_id)
+
+    return sum(hosts.values()), hosts, sets
+
+def app_stats(catalog=None):
+    """
+    Return (number of fresh hosts, the catalog with percentages), where each
+    app of the catalog is replaced by [(name, percentage), (cp, percentage),
+    ...] and each section's apps are sorted by their percentage.
+    """
+
+    if catalog is None:
+        catalog = APP_CATALOG
+
+    since = timezone.now() - datetime.timedelta(days=FRESH_SUBMISSION_MAX_AGE)
+    cps = set(cp for section in catalog for app in section[1:] for cp in app[1:])
+
+    num_hosts, hosts, sets = count_hosts(cps, since)
+
+    def percentify(set_ids):
+        if not num_hosts:
+            return 0
+
+        return int(round(100 * sum(hosts[s] for s in set_ids) / num_hosts))
+
+    stats = []
+    for section in catalog:
+        apps = []
+        for app in section[1:]:
+            name, pkgs = app[0], app[1:]
+
+            # A host with several of the packages counts once for the app:
+            app_sets = set().union(*[sets[cp] for cp in pkgs])
+
+            apps.append( [(name, percentify(app_sets))]
+                       + [(cp, percentify(sets[cp])) for cp in pkgs]
+            )
+
+        apps.sort(key=lambda app: app[0][1], reverse=True)
+        stats.append([section[0]] + apps)
+
+    return num_hosts, stats
+
+def cached_app_stats():
+    """
+    app_stats() of APP_CATALOG, cached for CACHE_TIMEOUT seconds.
+    """
+
+    result = cache.get(CACHE_KEY)
+    if result is None:
+        result = app_stats()
+        cache.set(CACHE_KEY, result, CACHE_TIMEOUT)
+
+    return result
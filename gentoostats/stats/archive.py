@@ -0,0 +1,268 @@
+"""
+Archival of superseded submissions.
+
+The views only need the latest submission of each host (and recent ones), but
+submissions and their rows in the through tables are never deleted otherwise.
+archive_submissions() moves those that are older than ARCHIVE_AFTER days and
+not the latest of their host out of the database, into gzip-compressed files
+in ARCHIVE_DIR: one per month in which they were received, with one JSON
+object per line in the format of Django's serializers (many-to-many relations
+included). Their atom sets go with them, as do installation sets older than
+ARCHIVE_AFTER days that no submission uses any more.
+
+What the rollups need of them is kept in ArchivedReport rows, so that
+"manage.py rebuild_rollups" still computes num_submissions and num_all_hosts
+as if the submissions were there.
+"""
+
+import os
+import gzip
+import json
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .util import chunked, bulk_create_or_fallback
+from .rollups import DIMENSIONS, fetch_values
+from .models import Host, Submission, AtomSet, InstallationSet, ArchivedReport
+
+ARCHIVE_DIR = getattr( settings
+                     , 'GENTOOSTATS_ARCHIVE_DIR'
+                     , os.path.join(os.path.dirname(__file__), 'archive')
+)
+
+# In days:
+ARCHIVE_AFTER = getattr(settings, 'GENTOOSTATS_ARCHIVE_AFTER', 180)
+
+class ArchiveError(Exception):
+    pass
+
+def _to_python(field, value):
+    if value is not None and field.rel:
+        # FK values are whatever the database returned (e.g. buffers for
+        # host UUIDs on SQLite):
+        return field.rel.get_related_field().to_python(value)
+
+    return value
+
+def serialize(model, objects):
+    """
+    Return the objects as dicts in the format of Django's serializers.
+
+    Many-to-many relations are fetched with a few queries for all objects,
+    instead of a few per object like the serializers themselves do.
+    """
+
+    records = dict()
+    for obj in objects:
+        fields = dict()
+        for field in model._meta.local_fields:
+            if not field.primary_key:
+                fields[field.name] = \
+                    _to_python(field, getattr(obj, field.attname))
+
+        records[obj.pk] = dict( model  = unicode(model._meta)
+                              , pk     = obj.pk
+                              , fields = fields
+        )
+
+    for field in model._meta.local_many_to_many:
+        through = field.rel.through
+        source  = field.m2m_field_name()
+        target  = field.m2m_reverse_field_name()
+
+        for record in records.values():
+            record['fields'][field.name] = []
+
+        for chunk in chunked(records):
+            rows = through.objects.order_by()\
+                    .filter(**{source + '__in': chunk})\
+                    .values_list(source, target)
+
+            for pk, target_pk in rows:
+                records[pk]['fields'][field.name].append(target_pk)
+
+    return [records[obj.pk] for obj in objects]
+
+def write_records(name, records):
+    """
+    Append records (see serialize()) to the archive file 'name'.
+    """
+
+    if not os.path.isdir(ARCHIVE_DIR):
+        os.makedirs(ARCHIVE_DIR)
+
+    # Appending adds a new gzip member, which readers handle transparently:
+    with gzip.open(os.path.join(ARCHIVE_DIR, name), 'ab') as f:
+        for record in records:
+            f.write(json.dumps(record, cls=DjangoJSONEncoder) + '\n')
+
+def archive_reports(submissions):
+    """
+    Add the dimension objects reported by 'submissions' to the ArchivedReport
+    rows of their hosts.
+    """
+
+    to_python = Host._meta.pk.to_python
+    hosts = dict((s.pk, to_python(s.host_id)) for s in submissions)
+
+    # (dimension, host, key) -> number of submissions:
+    counts = defaultdict(int)
+    for dimension in DIMENSIONS:
+        values = fetch_values(list(hosts), dimension.path)
+        for submission_id, keys in values.items():
+            for key in keys:
+                counts[(dimension.name, hosts[submission_id], key)] += 1
+
+    existing = dict()
+    for chunk in chunked(set(hosts.values())):
+        rows = ArchivedReport.objects.filter(host__in=chunk)\
+                .values_list('pk', 'dimension', 'host', 'key')
+
+        for pk, dimension, host_id, key in rows:
+            report = (dimension, to_python(host_id), key)
+            if report in counts:
+                existing[report] = pk
+
+    bulk_create_or_fallback(
+        ArchivedReport,
+        [ ArchivedReport( dimension       = dimension
+                        , host_id         = host_id
+                        , key             = key
+                        , num_submissions = count
+          )
+          for (dimension, host_id, key), count in counts.items()
+          if (dimension, host_id, key) not in existing
+        ],
+        lambda obj: ArchivedReport.objects.create(
+            dimension       = obj.dimension,
+            host_id         = obj.host_id,
+            key             = obj.key,
+            num_submissions = obj.num_submissions,
+        )
+    )
+
+    # Most rows are reported by a single submission, so group them:
+    groups = defaultdict(list)
+    for report, pk in existing.items():
+        groups[counts[report]].append(pk)
+
+    for count, pks in groups.items():
+        for chunk in chunked(pks):
+            ArchivedReport.objects.filter(pk__in=chunk)\
+                    .update(num_submissions=F('num_submissions') + count)
+
+def _archive_name(kind, when):
+    return "%s-%s.jsonl.gz" % (kind, when.strftime('%Y-%m'))
+
+def archive_submissions(days=ARCHIVE_AFTER, batch_size=1000, log=None):
+    """
+    Archive the submissions that were received more than 'days' days ago and
+    are not the latest submission of their host, then the installation sets
+    added before then that are left unused. Returns the number of archived
+    submissions.
+
+    Records are written before the rows are deleted, so an interrupted run (or
+    an installation set that a new submission starts using in the meantime)
+    may leave some of them in the archive twice (with the same "pk").
+    """
+
+    # All submissions of such hosts would be archived:
+    if Host.objects.filter( latest_submission__isnull = True
+                          , submissions__isnull       = False
+    ).exists():
+        raise ArchiveError( "Some hosts with submissions have no latest "
+                            "submission, run set_latest_submissions first."
+        )
+
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+
+    candidates = Submission.objects.order_by('id')\
+            .filter(datetime__lt=cutoff)\
+            .exclude(pk__in=Submission.objects.latest_submission_ids)
+
+    total = 0
+    last_id = 0
+
+    while True:
+        batch = list(candidates.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+
+        months = defaultdict(list)
+        owners = dict()
+        for submission, record in zip(batch, serialize(Submission, batch)):
+            months[_archive_name('submissions', submission.datetime)]\
+                    .append(record)
+            owners[submission.pk] = submission
+
+        atom_sets = [ atom_set for chunk in chunked(owners)
+                      for atom_set in AtomSet.objects.filter(owner__in=chunk)
+        ]
+        for atom_set, record in zip(atom_sets, serialize(AtomSet, atom_sets)):
+            owner = owners[atom_set.owner_id]
+            months[_archive_name('submissions', owner.datetime)].append(record)
+
+        for name, records in sorted(months.items()):
+            write_records(name, records)
+
+        with transaction.commit_on_success():
+            archive_reports(batch)
+
+            # Also deletes the atom sets and the through table rows:
+            for chunk in chunked(owners):
+                Submission.objects.filter(pk__in=chunk).delete()
+
+        last_id = batch[-1].pk
+        total += len(batch)
+
+        if log:
+            log("%d submissions archived" % total)
+
+    unused = InstallationSet.objects.order_by('id')\
+            .filter(added_on__lt=cutoff, submissions__isnull=True)
+
+    last_id = 0
+    while True:
+        batch = list(unused.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+
+        months = defaultdict(list)
+        for installation_set, record in \
+                zip(batch, serialize(InstallationSet, batch)):
+            months[_archive_name('installation-sets', installation_set.added_on)]\
+                    .append(record)
+
+        for name, records in sorted(months.items()):
+            write_records(name, records)
+
+        with transaction.commit_on_success():
+            # Lock the sets before checking that they are still unused, so
+            # that no submission can start using one of them before the
+            # DELETE (FOR UPDATE can't be applied to the check's outer join):
+            locked = []
+            for chunk in chunked([s.pk for s in batch]):
+                locked.extend(
+                    InstallationSet.objects.select_for_update()\
+                        .filter(pk__in=chunk)\
+                        .order_by('pk')\
+                        .values_list('pk', flat=True)
+                )
+
+            for chunk in chunked(locked):
+                still_unused = list(
+                    InstallationSet.objects\
+                        .filter(pk__in=chunk, submissions__isnull=True)\
+                        .values_list('pk', flat=True)
+                )
+                InstallationSet.objects.filter(pk__in=still_unused).delete()
+
+        last_id = batch[-1].pk
+
+    return total
@@ -0,0 +1,73 @@
+"""
+Custom model fields.
+"""
+
+import uuid
+
+from django.db import models
+from django.core.exceptions import ValidationError
+
+class UUIDField(models.Field):
+    """
+    A UUID, stored in 16 bytes (instead of the 36 characters of its text
+    form), which makes a primary key referenced by millions of rows a lot
+    smaller, as are the indexes on them. Only PostgreSQL (uuid) and SQLite
+    (blob) return such values in a form that can't be mistaken for text, other
+    databases store the 32 hex digits.
+
+    The Python value is always the canonical text form (lowercase, with
+    hyphens), so the rest of the code can keep treating it as a string. Any
+    accepted spelling (upper case, without hyphens) of a UUID matches the same
+    row.
+    """
+
+    __metaclass__ = models.SubfieldBase
+
+    description = "UUID (stored as 16 bytes)"
+
+    def db_type(self, connection):
+        return { 'postgresql': 'uuid'
+               , 'sqlite':     'blob'
+        }.get(connection.vendor, 'char(32)')
+
+    def to_python(self, value):
+        if value is None or value == '':
+            return value
+
+        if isinstance(value, uuid.UUID):
+            return str(value)
+
+        try:
+            if isinstance(value, (buffer, bytearray)):
+                # The stored form, as returned by SQLite:
+                return str(uuid.UUID(bytes=str(value)))
+
+            return str(uuid.UUID(value))
+        except (AttributeError, TypeError, ValueError):
+            raise ValidationError("'%s' is not a valid UUID." % value)
+
+    def get_prep_value(self, value):
+        return self.to_python(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+
+        if not value:
+            return None
+
+        if connection.vendor == 'postgresql':
+            return value
+
+        if connection.vendor == 'sqlite':
+            # Plain strings would be stored as (invalid) text:
+            return buffer(uuid.UUID(value).bytes)
+
+        return uuid.UUID(value).hex
+
+try:
+    # South is optional:
+    from south.modelsinspector import add_introspection_rules
+    add_introspection_rules([], [r'^gentoostats\.stats\.fields\.UUIDField$'])
+except ImportError:
+    pass
@@ -0,0 +1,189 @@
+"""
+Process-wide interning caches for the lookup tables that nearly every
+submission references (USE flags, FEATURES, keywords, mirrors, etc.).
+
+Each cache maps a name (or URL) to the primary key of its row, so once it's
+warm, resolving a known value costs no database round trip at all. Names held
+by a cache have already passed validation, so callers don't need to full_clean()
+them again.
+
+Only the keys are shared between threads: every caller gets model objects of
+its own, which hold nothing but the primary key and the name (or URL). That's
+all the receiver needs to link them to a submission; code that needs their
+other fields should fetch the objects from the database instead.
+
+Rows written by a transaction that is later rolled back must never end up in a
+cache. Code that writes to the database should therefore run inside deferred(),
+which only publishes the objects it has seen once the block has succeeded.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .util import LRUCache, chunked, get_or_create_many
+from .models import UseFlag, UseFlagNumber, Feature, Keyword, MirrorServer, \
+                    Lang, SyncServer
+
+CACHE_SIZE = getattr(settings, 'GENTOOSTATS_INTERN_CACHE_SIZE', 10000)
+
+class InternCache(object):
+    """
+    An LRU cache of the primary keys of 'model' objects, keyed by their unique
+    'field'.
+    """
+
+    def __init__(self, model, field='name', max_size=CACHE_SIZE):
+        self.model = model
+        self.field = field
+
+        self._cache = LRUCache(max_size)
+        self._local = threading.local()
+
+    def _remember(self, objects, created=False):
+        staged = getattr(self._local, 'staged', None)
+        entries = [(getattr(o, self.field), (o.pk, o._state.db)) for o in objects]
+
+        if staged is not None:
+            staged.update(entries)
+        elif not created:
+            # Outside deferred() only rows that existed beforehand are safe.
+            for value, entry in entries:
+                self._cache.set(value, entry)
+
+    def _build(self, value, entry):
+        pk, db = entry
+
+        obj = self.model(**{self.field: value})
+        obj.pk = pk
+
+        # Like an object fetched from 'db', so that it can be added to the
+        # relations of objects from that database:
+        obj._state.adding = False
+        obj._state.db = db
+
+        return obj
+
+    def _lookup(self, values):
+        staged = getattr(self._local, 'staged', None) or dict()
+
+        result = dict()
+        for v in values:
+            entry = staged.get(v) or self._cache.get(v)
+            if entry is not None:
+                result[v] = self._build(v, entry)
+
+        return result
+
+    def get(self, value):
+        """
+        Return the object for 'value', or None if it does not exist.
+        """
+
+        return self.get_many([value]).get(value)
+
+    def get_many(self, values):
+        """
+        Return a dict mapping values to objects (of the caller's own, see
+        above). Unknown values are omitted.
+        """
+
+        values = set(v for v in values if v)
+
+        result = self._lookup(values)
+        missing = values.difference(result)
+
+        for chunk in chunked(missing):
+            objects = list(
+                self.model.objects.filter(**{self.field + '__in': chunk})
+            )
+
+            self._remember(objects)
+            result.update((getattr(o, self.field), o) for o in objects)
+
+        return result
+
+    def get_or_create_many(self, values):
+        """
+        Like get_many(), but missing objects are created.
+        """
+
+        values = set(v for v in values if v)
+
+        result = self.get_many(values)
+        missing = values.difference(result)
+
+        if missing:
+            created = get_or_create_many(self.model, missing, self.field)
+            self._remember(created.values(), created=True)
+            result.update(created)
+
+        return result
+
+    def begin(self):
+        self._local.staged = dict()
+
+    def publish(self):
+        staged = getattr(self._local, 'staged', None) or dict()
+        self._local.staged = None
+
+        for value, entry in staged.items():
+            self._cache.set(value, entry)
+
+    def discard(self):
+        self._local.staged = None
+
+    def clear(self):
+        self._cache.clear()
+
+useflag_cache = InternCache(UseFlag)
+useflag_number_cache = InternCache(UseFlagNumber)
+feature_cache = InternCache(Feature)
+keyword_cache = InternCache(Keyword)
+mirror_cache  = InternCache(MirrorServer, 'url')
+lang_cache    = InternCache(Lang)
+sync_cache    = InternCache(SyncServer, 'url')
+
+CACHES = ( useflag_cache
+         , useflag_number_cache
+         , feature_cache
+         , keyword_cache
+         , mirror_cache
+         , lang_cache
+         , sync_cache
+)
+
+@contextmanager
+def deferred():
+    """
+    Stage all cache insertions made by the current thread and publish them
+    only if the block finishes without an exception.
+
+    Use this around (not inside) a transaction that writes lookup rows, so that
+    the rows are committed by the time they become visible to other requests.
+    """
+
+    for cache in CACHES:
+        cache.begin()
+
+    try:
+        yield
+    except:
+        for cache in CACHES:
+            cache.discard()
+        raise
+    else:
+        for cache in CACHES:
+            cache.publish()
+
+def discard_staged():
+    """
+    Forget the cache insertions the current thread has staged inside
+    deferred() so far, because the transaction that created the rows has been
+    rolled back (and is about to be retried).
+    """
+
+    for cache in CACHES:
+        if getattr(cache._local, 'staged', None) is not None:
+            cache.begin()
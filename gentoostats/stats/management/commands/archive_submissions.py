@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gentoostats.stats.archive import ARCHIVE_AFTER, ARCHIVE_DIR, \
+                                      ArchiveError, archive_submissions
+
+class Command(BaseCommand):
+    help = "Moves submissions that have been superseded by a later one of " \
+           "the same host, and are older than GENTOOSTATS_ARCHIVE_AFTER " \
+           "days, to compressed files in GENTOOSTATS_ARCHIVE_DIR (%s)." \
+           % ARCHIVE_DIR
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--days'
+                   , type    = 'int'
+                   , default = ARCHIVE_AFTER
+                   , help    = 'Minimum age of archived submissions '
+                               '(default: %d).' % ARCHIVE_AFTER
+        ),
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of submissions per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            total = archive_submissions(
+                days       = options['days'],
+                batch_size = options['batch_size'],
+                log        = lambda message: self.stdout.write(message + "\n"),
+            )
+        except ArchiveError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write("%d submissions archived in total\n" % total)
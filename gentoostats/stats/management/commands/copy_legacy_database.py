@@ -0,0 +1,184 @@
+from optparse import make_option
+
+from django.db import connection, connections, transaction
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+
+from gentoostats.stats.models import *
+from gentoostats.receiver.management.commands.build_installation_sets \
+    import LEGACY_TABLE
+
+# In dependency order:
+MODELS = ( Category, PackageName, Repository, UseFlag, UseFlagNumber, Lang
+         , Feature, Keyword, MirrorServer, SyncServer, Host, Package, Atom
+         , Installation, InstallationSet, Submission, AtomSet
+)
+
+# Models that used to be identified by their name instead of an integer:
+RENUMBERED = (Category, PackageName, UseFlag, Lang, Feature, Keyword)
+
+# Filled in afterwards (by set_latest_submissions):
+SKIPPED_FIELDS = (Host._meta.get_field('latest_submission'),)
+
+# Unique now, but not in older databases (later duplicates are left empty):
+DEDUPLICATED_FIELDS = (Installation._meta.get_field('state_hash'),)
+
+class Command(BaseCommand):
+    help = "Copies the submissions from a database with the old schema " \
+           "(hosts identified by 36 character strings, categories, package " \
+           "names, USE flags, LANGs, FEATURES and keywords by their names) " \
+           "into the (empty) default database, then fills in the installation " \
+           "sets, latest submissions, rollups and version keys."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--database'
+                   , default = 'legacy'
+                   , help    = 'The DATABASES entry of the old database '
+                               '(default: legacy).'
+        ),
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 10000
+                   , help    = 'Number of rows per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError( "There is no '%s' database in DATABASES."
+                              % options['database']
+            )
+
+        self.legacy     = connections[options['database']]
+        self.batch_size = options['batch_size']
+
+        through_models = tuple( f.rel.through
+                                for model in MODELS
+                                for f in model._meta.local_many_to_many
+        )
+
+        for model in MODELS + through_models:
+            if model.objects.exists():
+                raise CommandError( "The %s table is not empty."
+                                  % model._meta.db_table
+                )
+
+        # Legacy name -> new ID, for each renumbered model:
+        self.ids = dict()
+
+        # Values already copied, for each deduplicated field:
+        self.seen = dict((f, set()) for f in DEDUPLICATED_FIELDS)
+
+        # Tables added later (e.g. InstallationSet) are left empty:
+        tables = set(self.legacy.introspection.table_names())
+
+        for model in MODELS + through_models:
+            if model._meta.db_table in tables:
+                self.copy(model)
+            else:
+                self.stdout.write( "%s: not in the old database\n"
+                                 % model._meta.db_table
+                )
+
+        # IDs have been copied as they were, so the sequences are behind:
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql( no_style()
+                                                    , MODELS + through_models
+        ):
+            cursor.execute(sql)
+        transaction.commit_unless_managed()
+
+        # Older databases linked each submission to its installations:
+        if LEGACY_TABLE in tables:
+            call_command( 'build_installation_sets'
+                        , database   = options['database']
+                        , batch_size = 1000
+            )
+
+        call_command('set_latest_submissions', batch_size=1000)
+        call_command('rebuild_rollups')
+        call_command('set_version_keys', batch_size=1000)
+
+    def copy(self, model):
+        renumbered = model in RENUMBERED
+
+        legacy_cursor = self.legacy.cursor()
+        cursor = connection.cursor()
+
+        # Columns added later (e.g. Package.version_key) are left empty:
+        columns = set(
+            c[0] for c in self.legacy.introspection.get_table_description(
+                legacy_cursor, model._meta.db_table
+            )
+        )
+
+        fields = [ f for f in model._meta.local_fields
+                   if f.column in columns
+                   and f not in SKIPPED_FIELDS
+                   and not (renumbered and f.primary_key)
+        ]
+
+        # The legacy primary key, for paging through the rows:
+        key = model._meta.get_field('name') if renumbered else model._meta.pk
+        position = fields.index(key)
+
+        qn = self.legacy.ops.quote_name
+        select = "SELECT %s FROM %s" % ( ', '.join(qn(f.column) for f in fields)
+                                       , qn(model._meta.db_table)
+        )
+        after = " WHERE %s > %%s" % qn(key.column)
+        order = " ORDER BY %s LIMIT %d" % (qn(key.column), self.batch_size)
+
+        qn = connection.ops.quote_name
+        insert = "INSERT INTO %s (%s) VALUES (%s)" % \
+            ( qn(model._meta.db_table)
+            , ', '.join(qn(f.column) for f in fields)
+            , ', '.join(['%s'] * len(fields))
+            )
+
+        total = 0
+        last_key = None
+
+        while True:
+            if last_key is None:
+                legacy_cursor.execute(select + order)
+            else:
+                legacy_cursor.execute(select + after + order, [last_key])
+
+            rows = legacy_cursor.fetchall()
+            if not rows:
+                break
+
+            cursor.executemany(insert, [self.convert(fields, row) for row in rows])
+            transaction.commit_unless_managed()
+
+            last_key = rows[-1][position]
+            total += len(rows)
+
+            self.stdout.write( "%s: %d rows copied\n"
+                             % (model._meta.db_table, total)
+            )
+
+        if renumbered:
+            self.ids[model] = dict(model.objects.values_list('name', 'pk'))
+
+    def convert(self, fields, row):
+        """
+        Return the values of a legacy row, as they are stored now.
+        """
+
+        values = []
+        for field, value in zip(fields, row):
+            if value is not None and field.rel and field.rel.to in self.ids:
+                value = self.ids[field.rel.to][value]
+
+            if value is not None and field in self.seen:
+                if value in self.seen[field]:
+                    value = None
+                else:
+                    self.seen[field].add(value)
+
+            values.append(field.get_db_prep_save(value, connection=connection))
+
+        return values
@@ -0,0 +1,36 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from gentoostats.stats.rollups import fold_rollups
+
+class Command(BaseCommand):
+    help = "Adds the changes recorded by the ingests since the last run to " \
+           "the precomputed dimension statistics."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--interval'
+                   , type    = 'float'
+                   , default = None
+                   , help    = 'Keep running, folding new changes every '
+                               'INTERVAL seconds.'
+        ),
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 10000
+                   , help    = 'Number of changes per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            total = fold_rollups(batch_size=options['batch_size'])
+
+            if int(options['verbosity']) > 0:
+                self.stdout.write("%d changes folded\n" % total)
+
+            if options['interval'] is None:
+                break
+
+            time.sleep(options['interval'])
@@ -0,0 +1,81 @@
+from optparse import make_option
+
+from django.db import transaction
+from django.db.models import Count, Min
+from django.core.management.base import BaseCommand
+
+from gentoostats.stats.util import chunked
+from gentoostats.stats.models import Installation
+
+class Command(BaseCommand):
+    help = "Computes the state hash of installations that don't have one yet. " \
+           "Installations identical to one that has a hash already are left " \
+           "without one, since state hashes are unique."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of installations per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        self.clear_duplicates()
+
+        total = 0
+        last_id = 0
+
+        while True:
+            batch = list(
+                Installation.objects.order_by('id')\
+                    .filter(state_hash__isnull=True, id__gt=last_id)\
+                    .select_related( 'package__category', 'package__package_name'
+                                   , 'package__repository', 'keyword'
+                    )\
+                    .prefetch_related('iuse', 'pkguse', 'use')\
+                    [:options['batch_size']]
+            )
+
+            if not batch:
+                break
+
+            hashes = dict((i.pk, i.compute_state_hash()) for i in batch)
+
+            with transaction.commit_on_success():
+                taken = set()
+                for chunk in chunked(set(hashes.values())):
+                    taken.update(
+                        Installation.objects.filter(state_hash__in=chunk)\
+                            .values_list('state_hash', flat=True)
+                    )
+
+                for pk, state_hash in sorted(hashes.items()):
+                    if state_hash not in taken:
+                        taken.add(state_hash)
+                        Installation.objects.filter(pk=pk)\
+                            .update(state_hash=state_hash)
+
+            last_id = batch[-1].id
+            total += len(batch)
+            self.stdout.write("%d installations hashed\n" % total)
+
+    def clear_duplicates(self):
+        """
+        Keep the hash of only the first of identical installations (hashed
+        before state hashes had to be unique), so that the unique index can
+        be added.
+        """
+
+        duplicates = Installation.objects.order_by()\
+                .filter(state_hash__isnull=False)\
+                .values('state_hash')\
+                .annotate(count=Count('id'), first=Min('id'))\
+                .filter(count__gt=1)\
+                .values_list('state_hash', 'first')
+
+        with transaction.commit_on_success():
+            for state_hash, first in duplicates:
+                Installation.objects.filter(state_hash=state_hash)\
+                    .exclude(pk=first)\
+                    .update(state_hash=None)
@@ -0,0 +1,78 @@
+from optparse import make_option
+from collections import defaultdict
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from gentoostats.stats.util import chunked
+from gentoostats.stats.models import Installation
+from gentoostats.stats.interning import deferred
+from gentoostats.stats.useflags import get_use_flags, flag_numbers, encode_flags
+
+class Command(BaseCommand):
+    help = "Converts the USE flags of installations to the packed " \
+           "representation (see GENTOOSTATS_COMPACT_USE_FLAGS)."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of installations per transaction.'
+        ),
+        make_option( '--delete-links'
+                   , action  = 'store_true'
+                   , default = False
+                   , help    = 'Delete the rows of the iuse, pkguse and use '
+                               'tables of converted installations.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        total = 0
+        last_id = 0
+
+        while True:
+            batch = list(
+                Installation.objects.order_by('id')\
+                    .filter(packed_use__isnull=True, id__gt=last_id)\
+                    .prefetch_related('iuse', 'pkguse', 'use')\
+                    [:options['batch_size']]
+            )
+
+            if not batch:
+                break
+
+            flags = dict((i.pk, get_use_flags(i)) for i in batch)
+
+            with deferred():
+                with transaction.commit_on_success():
+                    numbers = flag_numbers(
+                        f for lists in flags.values() for names in lists for f in names
+                    )
+
+                    # Many installations have the same flags, so update
+                    # them together:
+                    groups = defaultdict(list)
+                    for id, lists in flags.items():
+                        packed = tuple(encode_flags(names, numbers) for names in lists)
+                        groups[packed].append(id)
+
+                    for (iuse, pkguse, use), ids in groups.items():
+                        for chunk in chunked(sorted(ids)):
+                            Installation.objects.filter(pk__in=chunk).update(
+                                packed_iuse   = iuse,
+                                packed_pkguse = pkguse,
+                                packed_use    = use,
+                            )
+
+                    if options['delete_links']:
+                        for field in ('iuse', 'pkguse', 'use'):
+                            through = getattr(Installation, field).through
+                            for chunk in chunked(flags):
+                                through.objects.filter(
+                                    installation__in = chunk
+                                ).delete()
+
+            last_id = batch[-1].id
+            total += len(batch)
+            self.stdout.write("%d installations converted\n" % total)
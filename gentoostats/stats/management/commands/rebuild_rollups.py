@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gentoostats.stats.rollups import DIMENSIONS, diff_rollups, rebuild_rollups
+
+class Command(BaseCommand):
+    args = '[dimension ...]'
+    help = "Checks the precomputed dimension statistics against the " \
+           "submissions, and rebuilds those that differ. Dimensions: " + \
+           ", ".join(d.name for d in DIMENSIONS) + " (default: all)."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--check'
+                   , action  = 'store_true'
+                   , default = False
+                   , help    = 'Only report differences (and fail if there '
+                               'are any).'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        dimensions = dict((d.name, d) for d in DIMENSIONS)
+        for name in args:
+            if name not in dimensions:
+                raise CommandError("Unknown dimension '%s'." % name)
+
+        total = 0
+        for dimension in DIMENSIONS:
+            if args and dimension.name not in args:
+                continue
+
+            mismatches = diff_rollups(dimension)
+            total += len(mismatches)
+
+            self.stdout.write( "%s: %d rows differ\n"
+                             % (dimension.name, len(mismatches))
+            )
+            if int(options['verbosity']) > 1:
+                for key, stored, computed in sorted(mismatches):
+                    self.stdout.write( "    %s: stored %r, computed %r\n"
+                                     % (key, stored, computed)
+                    )
+
+            if mismatches and not options['check']:
+                rebuild_rollups(dimension)
+
+        if total and options['check']:
+            raise CommandError("%d rollup rows differ." % total)
@@ -0,0 +1,67 @@
+from optparse import make_option
+
+from django.db import transaction
+from django.db.models import Max
+from django.core.management.base import BaseCommand
+
+from gentoostats.stats.models import Host, Submission
+
+class Command(BaseCommand):
+    help = "Points Host.latest_submission at each host's latest submission."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of hosts per transaction.'
+        ),
+        make_option( '--all'
+                   , action  = 'store_true'
+                   , default = False
+                   , help    = 'Check all hosts, not only those without a '
+                               'latest submission.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        hosts = Host.objects.order_by('id')
+        if not options['all']:
+            hosts = hosts.filter(latest_submission__isnull=True)
+
+        total = updated = 0
+        last_id = None
+
+        while True:
+            page = hosts
+            if last_id is not None:
+                page = page.filter(id__gt=last_id)
+
+            batch = list(
+                page.values_list('id', 'latest_submission')\
+                    [:options['batch_size']]
+            )
+
+            if not batch:
+                break
+
+            latest = dict(
+                Submission.objects.order_by()\
+                    .filter(host__in=[id for id, _ in batch])\
+                    .values('host')\
+                    .annotate(latest_submission_id=Max('id'))\
+                    .values_list('host', 'latest_submission_id')
+            )
+
+            with transaction.commit_on_success():
+                for id, current in batch:
+                    if id in latest and latest[id] != current:
+                        Host.objects.filter(pk=id)\
+                                .update(latest_submission=latest[id])
+                        updated += 1
+
+            last_id = batch[-1][0]
+            total += len(batch)
+
+            self.stdout.write( "%d hosts checked, %d updated\n"
+                             % (total, updated)
+            )
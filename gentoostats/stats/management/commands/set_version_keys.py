@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from gentoostats.stats.models import Package
+from gentoostats.stats.versions import version_key
+
+class Command(BaseCommand):
+    help = "Computes Package.version_key for packages that don't have one."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--batch-size'
+                   , type    = 'int'
+                   , default = 1000
+                   , help    = 'Number of packages per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        total = 0
+        last_id = 0
+
+        while True:
+            batch = list(
+                Package.objects.order_by('id')\
+                    .filter(version_key__isnull=True, id__gt=last_id)\
+                    .values_list('id', 'version')\
+                    [:options['batch_size']]
+            )
+
+            if not batch:
+                break
+
+            with transaction.commit_on_success():
+                for id, version in batch:
+                    key = version_key(version)
+                    if key is not None:
+                        Package.objects.filter(pk=id).update(version_key=key)
+
+            last_id = batch[-1][0]
+            total += len(batch)
+            self.stdout.write("%d packages checked\n" % total)
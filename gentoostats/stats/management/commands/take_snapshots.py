@@ -0,0 +1,43 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gentoostats.stats.snapshots import SNAPSHOTS, take_snapshot
+
+class Command(BaseCommand):
+    args = '[page ...]'
+    help = "Computes and stores the data of the pages that are served from " \
+           "snapshots. Pages: " + ", ".join(sorted(SNAPSHOTS)) + \
+           " (default: all)."
+
+    option_list = BaseCommand.option_list + (
+        make_option( '--interval'
+                   , type    = 'float'
+                   , default = None
+                   , help    = 'Keep running, taking new snapshots every '
+                               'INTERVAL seconds.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        for name in args:
+            if name not in SNAPSHOTS:
+                raise CommandError("Unknown page '%s'." % name)
+
+        names = args or sorted(SNAPSHOTS)
+
+        while True:
+            for name in names:
+                start = time.time()
+                take_snapshot(name)
+
+                if int(options['verbosity']) > 0:
+                    self.stdout.write( "%s: generated in %.1f s\n"
+                                     % (name, time.time() - start)
+                    )
+
+            if options['interval'] is None:
+                break
+
+            time.sleep(options['interval'])
@@ -1,11 +1,17 @@
+import hashlib
+import calendar
+
 from portage.dep import Atom as PortageAtom
 from portage.exception import InvalidAtom
 from portage._sets import SETPREFIX as SET_PREFIX
 
 from django.db import models
-from django.db.models import Max, Count
+from django.db.models import Count
 from django.core.validators import RegexValidator, URLValidator, validate_email
-from django.core.exceptions import ValidationError
+from django.core.exceptions import ValidationError, ObjectDoesNotExist
+
+from .fields import UUIDField
+from .versions import version_key
 
 # I have tried being consistent with the names defined here:
 # http://devmanual.gentoo.org/ebuild-writing/variables/index.html
@@ -16,10 +22,21 @@ from django.core.exceptions import ValidationError
 
 DEFAULT_REPO_NAME = 'gentoo'
 
+def get_rollup(obj):
+    """
+    Return the precomputed statistics of a dimension object (see
+    gentoostats.stats.rollups), or None if there are none yet.
+    """
+
+    try:
+        return obj.rollup
+    except ObjectDoesNotExist:
+        return None
+
 # 'virtual' match idea taken from euscan. Thanks, fox!
 category_validator = RegexValidator(r'^(?:\w+-\w+)|virtual$')
 class Category(models.Model):
-    name = models.CharField( primary_key = True
+    name = models.CharField( unique      = True
                            , max_length  = 31
                            , validators  = [category_validator]
     )
@@ -35,7 +52,7 @@ class Category(models.Model):
 
 package_name_validator = RegexValidator(r'^\S+$')
 class PackageName(models.Model):
-    name = models.CharField( primary_key = True
+    name = models.CharField( unique      = True
                            , max_length  = 63
                            , validators  = [package_name_validator]
     )
@@ -72,26 +89,42 @@ class Repository(models.Model):
 
     @property
     def num_submissions(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_submissions
+
         return Submission.objects\
-                .filter(installations__package__repository__name=self.name)\
+                .filter(installation_set__installations__package__repository__name=self.name)\
                 .distinct().count()
 
     @property
     def num_all_hosts(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_all_hosts
+
         return Submission.objects.order_by()\
-                .filter(installations__package__repository__name=self.name)\
+                .filter(installation_set__installations__package__repository__name=self.name)\
                 .aggregate(Count('host', distinct=True)).values()[0]
 
     @property
     def num_hosts(self):
-        return Submission.objects.latest_submissions\
-                .filter(installations__package__repository__name=self.name)\
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_hosts
+
+        return Host.objects\
+                .filter(latest_submission__installation_set__installations__package__repository__name=self.name)\
                 .distinct().count()
 
     @property
     def num_packages(self):
-        return Submission.objects.latest_submissions\
-                .filter(installations__package__repository__name=self.name).count()
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_packages
+
+        return Host.objects\
+                .filter(latest_submission__installation_set__installations__package__repository__name=self.name).count()
 
 version_validator = RegexValidator(r'^\S+$')
 slot_validator    = RegexValidator(r'^\S+$')
@@ -161,6 +194,16 @@ class Package(AtomABC):
     # category + package_name, denormalised and indexed for performance:
     cp = models.CharField(max_length=95, unique=False, db_index=True)
 
+    # Sorts like the versions do in Portage (see gentoostats.stats.versions),
+    # e.g. filter(version_key__lt=version_key('4.6')). None for versions
+    # Portage doesn't understand:
+    version_key = models.CharField( max_length = 127
+                                  , blank      = True
+                                  , null       = True
+                                  , db_index   = True
+                                  , editable   = False
+    )
+
     class Meta:
         unique_together = ( 'category'
                           , 'package_name'
@@ -169,7 +212,7 @@ class Package(AtomABC):
                           , 'repository'
         )
 
-        ordering = ['category', 'package_name', 'version', 'slot']
+        ordering = ['cp', 'version_key', 'slot']
 
     def __unicode__(self):
         slot       = ":%s"  % (self.slot)       if self.slot                            else ''
@@ -184,6 +227,7 @@ class Package(AtomABC):
 
     def save(self, *args, **kwargs):
         self.cp = self.category.name + '/' + self.package_name.name
+        self.version_key = version_key(self.version)
         super(Package, self).save(*args, **kwargs)
 
     @models.permalink
@@ -260,7 +304,7 @@ class UseFlag(models.Model):
     A USE flag.
     """
 
-    name = models.CharField( primary_key = True
+    name = models.CharField( unique      = True
                            , max_length  = 63
                            , validators  = [use_flag_validator]
     )
@@ -276,29 +320,55 @@ class UseFlag(models.Model):
 
     @property
     def num_submissions(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_submissions
+
         return Submission.objects.filter(global_use__name=self.name).count()
 
     @property
     def num_all_hosts(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_all_hosts
+
         return Submission.objects.filter(global_use__name=self.name).order_by()\
                 .aggregate(Count('host', distinct=True)).values()[0]
 
     @property
     def num_hosts(self):
-        return Submission.objects.latest_submissions\
-                .filter(global_use__name=self.name).count()
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_hosts
+
+        return Host.objects\
+                .filter(latest_submission__global_use__name=self.name).count()
 
     @property
     def num_previous_hosts(self):
         return self.num_all_hosts - self.num_hosts
 
+class UseFlagNumber(models.Model):
+    """
+    A small, dense integer ID (the PK) for each USE flag name, used by the
+    compact encoding of installation USE flags (see gentoostats.stats.useflags).
+    """
+
+    name = models.CharField( unique     = True
+                           , max_length = 63
+                           , validators = [use_flag_validator]
+    )
+
+    def __unicode__(self):
+        return "%s (%d)" % (self.name, self.id)
+
 lang_validator = RegexValidator(r'^\S+$') # TODO
 class Lang(models.Model):
     """
     System $LANG.
     """
 
-    name = models.CharField( primary_key = True
+    name = models.CharField( unique      = True
                            , max_length  = 31
                            , validators  = [lang_validator]
     )
@@ -310,17 +380,29 @@ class Lang(models.Model):
 
     @property
     def num_submissions(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_submissions
+
         return Submission.objects.filter(lang__name=self.name).count()
 
     @property
     def num_all_hosts(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_all_hosts
+
         return Submission.objects.filter(lang__name=self.name).order_by()\
                 .aggregate(Count('host', distinct=True)).values()[0]
 
     @property
     def num_hosts(self):
-        return Submission.objects.latest_submissions\
-                .filter(lang__name=self.name).count()
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_hosts
+
+        return Host.objects\
+                .filter(latest_submission__lang__name=self.name).count()
 
     @property
     def num_previous_hosts(self):
@@ -332,17 +414,15 @@ uuid_validator = RegexValidator(
 )
 class Host(models.Model):
     """
-    A computer, identified by 32 hexadecimal digits (with hyphens, case-
-    sensitive). Make sure to store the UUID in lowercase to make this
-    case-insensitive.
+    A computer, identified by a UUID (32 hexadecimal digits, usually with
+    hyphens; case-insensitive, since only its 16 bytes are stored).
 
     UUID Info: http://tools.ietf.org/html/rfc4122
                http://en.wikipedia.org/wiki/Universally_unique_identifier
     """
 
-    id = models.CharField( primary_key = True
-                         , max_length  = 36
-                         , validators  = [uuid_validator]
+    id = UUIDField( primary_key = True
+                  , validators  = [uuid_validator]
     )
 
     added_on = models.DateTimeField(auto_now_add=True)
@@ -357,12 +437,16 @@ class Host(models.Model):
     # TODO: What if the user wants to change his upload_key?
     # Should we support this at all?
 
-    # A small optimisation:
-    # latest_submission = models.ForeignKey( 'Submission'
-    #                                      , related_name = '+'
-    #                                      , null         = True
-    #                                      , default      = None
-    # )
+    # The host's submission with the highest PK, kept up to date by the
+    # receiver (see "manage.py set_latest_submissions" for older hosts). Saves
+    # a GROUP BY over all submissions whenever only current hosts matter:
+    latest_submission = models.ForeignKey( 'Submission'
+                                         , related_name = '+'
+                                         , blank        = True
+                                         , null         = True
+                                         , default      = None
+                                         , on_delete    = models.SET_NULL
+    )
 
     def __unicode__(self):
         return self.id
@@ -371,15 +455,6 @@ class Host(models.Model):
     def get_absolute_url(self):
         return ('stats:host_details_url', (), {'host_id': self.id})
 
-    @property
-    def latest_submission(self):
-        # TODO: Determine whether all hosts should have at least one submission.
-
-        try:
-            return self.submissions.latest('datetime')
-        except Exception as e:
-            return None
-
     @property
     def submission_history(self):
         return self.submissions.order_by('datetime')\
@@ -393,7 +468,7 @@ class Feature(models.Model):
 
     # TODO: make this case insensitive (like Host.id)?
 
-    name = models.CharField( primary_key = True
+    name = models.CharField( unique      = True
                            , max_length  = 63
                            , validators  = [feature_validator]
     )
@@ -409,17 +484,29 @@ class Feature(models.Model):
 
     @property
     def num_submissions(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_submissions
+
         return Submission.objects.filter(features__name=self.name).count()
 
     @property
     def num_all_hosts(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_all_hosts
+
         return Submission.objects.filter(features__name=self.name).order_by()\
                 .aggregate(Count('host', distinct=True)).values()[0]
 
     @property
     def num_hosts(self):
-        return Submission.objects.latest_submissions\
-                .filter(features__name=self.name).count()
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_hosts
+
+        return Host.objects\
+                .filter(latest_submission__features__name=self.name).count()
 
     @property
     def num_previous_hosts(self):
@@ -442,17 +529,29 @@ class MirrorServer(models.Model):
 
     @property
     def num_submissions(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_submissions
+
         return Submission.objects.filter(mirrors__url=self.url).count()
 
     @property
     def num_all_hosts(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_all_hosts
+
         return Submission.objects.filter(mirrors__url=self.url).order_by()\
                 .aggregate(Count('host', distinct=True)).values()[0]
 
     @property
     def num_hosts(self):
-        return Submission.objects.latest_submissions\
-                .filter(mirrors__url=self.url).count()
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_hosts
+
+        return Host.objects\
+                .filter(latest_submission__mirrors__url=self.url).count()
 
     @property
     def num_previous_hosts(self):
@@ -476,17 +575,29 @@ class SyncServer(models.Model):
 
     @property
     def num_submissions(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_submissions
+
         return Submission.objects.filter(sync__url=self.url).count()
 
     @property
     def num_all_hosts(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_all_hosts
+
         return Submission.objects.filter(sync__url=self.url).order_by()\
                 .aggregate(Count('host', distinct=True)).values()[0]
 
     @property
     def num_hosts(self):
-        return Submission.objects.latest_submissions\
-                .filter(sync__url=self.url).count()
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_hosts
+
+        return Host.objects\
+                .filter(latest_submission__sync__url=self.url).count()
 
     @property
     def num_previous_hosts(self):
@@ -494,7 +605,7 @@ class SyncServer(models.Model):
 
 # TODO: add validator
 class Keyword(models.Model):
-    name     = models.CharField(primary_key=True, max_length=127)
+    name     = models.CharField(unique=True, max_length=127)
 
     added_on = models.DateTimeField(auto_now_add=True)
 
@@ -507,28 +618,66 @@ class Keyword(models.Model):
 
     @property
     def num_submissions(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_submissions
+
         return Submission.objects.filter(global_keywords__name=self.name).count()
 
     @property
     def num_all_hosts(self):
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_all_hosts
+
         return Submission.objects.filter(global_keywords__name=self.name)\
                 .order_by().aggregate(Count('host', distinct=True)).values()[0]
 
     @property
     def num_hosts(self):
-        return Submission.objects.latest_submissions\
-                .filter(global_keywords__name=self.name).count()
+        rollup = get_rollup(self)
+        if rollup is not None:
+            return rollup.num_hosts
+
+        return Host.objects\
+                .filter(latest_submission__global_keywords__name=self.name).count()
 
     @property
     def num_previous_hosts(self):
         return self.num_all_hosts - self.num_hosts
 
+def installation_state_hash( category, package_name, version, slot, repository
+                           , keyword, built_at, build_duration, size
+                           , iuse, pkguse, use
+):
+    """
+    Return a stable SHA-1 digest of the complete state of an installation,
+    including its USE flags.
+
+    All arguments are plain values (names, not model objects), so the digest
+    can be computed before anything is looked up in the database.
+    """
+
+    if built_at is not None:
+        built_at = calendar.timegm(built_at.utctimetuple())
+
+    state = [ category, package_name, version, slot, repository
+            , keyword, built_at, build_duration, size
+    ]
+
+    state = [u'' if x is None else unicode(x) for x in state]
+    for flags in (iuse, pkguse, use):
+        state.append(u' '.join(sorted(set(f for f in flags if f))))
+
+    return hashlib.sha1(u'\n'.join(state).encode('utf-8')).hexdigest()
+
 class Installation(models.Model):
     """
     Package installations on hosts.
 
-    It is expected that each installation is unique to each host, but that may
-    not always hold true.
+    Installations are shared between hosts: identical installations (same
+    package, keyword, build details and USE flags) are stored only once and are
+    identified by their state_hash.
     """
 
     package = models.ForeignKey(Package, related_name='installations')
@@ -545,12 +694,78 @@ class Installation(models.Model):
     pkguse = models.ManyToManyField(UseFlag, blank=True, related_name='installations_pkguse')
     use    = models.ManyToManyField(UseFlag, blank=True, related_name='installations_use')
 
+    # The same flags as comma-separated UseFlagNumber IDs, instead of the above
+    # (see gentoostats.stats.useflags). None if the flags are in the tables:
+    packed_iuse   = models.TextField(blank=True, null=True)
+    packed_pkguse = models.TextField(blank=True, null=True)
+    packed_use    = models.TextField(blank=True, null=True)
+
+    # See installation_state_hash(). Installations are immutable once created,
+    # and there's only one of each state (rows without a hash aside).
+    state_hash = models.CharField( max_length = 40
+                                 , blank      = True
+                                 , null       = True
+                                 , unique     = True
+    )
+
     class Meta():
         ordering = ['package', 'built_at']
 
     def __unicode__(self):
         return "'%s' installed at '%s'" % (self.package, self.built_at)
 
+    def compute_state_hash(self):
+        # Imported here because .useflags depends on this module:
+        from .useflags import get_use_flags
+
+        package = self.package
+        iuse, pkguse, use = get_use_flags(self)
+
+        return installation_state_hash(
+            package.category.name,
+            package.package_name.name,
+            package.version,
+            package.slot,
+            package.repository.name if package.repository_id else None,
+            self.keyword.name,
+            self.built_at,
+            self.build_duration,
+            self.size,
+            iuse,
+            pkguse,
+            use,
+        )
+
+def installation_set_hash(installation_ids):
+    """
+    Return a stable SHA-1 digest of a set of Installation IDs.
+    """
+
+    ids = sorted(set(installation_ids))
+    return hashlib.sha1(','.join(str(i) for i in ids)).hexdigest()
+
+class InstallationSet(models.Model):
+    """
+    The installations reported by a submission.
+
+    Sets are immutable and shared: all submissions that report exactly the same
+    installations (usually consecutive submissions of a host that hasn't
+    changed anything in the meantime) point to the same set, which is
+    identified by its state_hash.
+    """
+
+    # See installation_set_hash():
+    state_hash = models.CharField(max_length=40, unique=True)
+
+    installations = models.ManyToManyField( Installation
+                                          , related_name = 'installation_sets'
+    )
+
+    added_on = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return "Installation set %s" % self.state_hash
+
 class AtomSet(models.Model):
     name  = models.CharField(max_length=127)
     owner = models.ForeignKey('Submission')
@@ -578,27 +793,34 @@ class SubmissionManager(models.Manager):
     @property
     def latest_submission_ids(self):
         """
-        Return the latest submission IDs of each host (ordered by PK).
+        Return the latest submission IDs of each host.
         """
 
-        # The following will result in the following query:
+        # Uses Host.latest_submission instead of:
         #     SELECT MAX("stats_submission"."id") AS "latest_submission_id" FROM
         #     "stats_submission" GROUP BY "stats_submission"."host_id"
-        return Submission.objects.order_by().values('host')\
-                .annotate(latest_submission_id=Max('id'))\
-                .values_list('latest_submission_id', flat=True)
+        return Host.objects.order_by()\
+                .filter(latest_submission__isnull=False)\
+                .values_list('latest_submission', flat=True)
 
     @property
     def latest_submissions(self):
         """
-        Return the latest submissions of each host (ordered by PK).
+        Return the latest submissions of each host.
         """
 
         return Submission.objects.filter(pk__in=self.latest_submission_ids)
 
 class Submission(models.Model):
+    # Reference ("<segment>:<offset>") to the raw request in the receiver's
+    # spool, or the file name of a request saved by older versions:
     raw_request_filename = models.CharField(max_length=127, unique=True)
 
+    # The raw_request_filename of the BASE of a delta (PROTOCOL 3) submission.
+    # Unlike its id, it stays the same when the requests are replayed into
+    # another database:
+    base_request = models.CharField(max_length=127, blank=True, null=True)
+
     host     = models.ForeignKey(Host, related_name='submissions')
     country  = models.CharField(max_length=127, blank=True, null=True)
     ip_addr  = models.GenericIPAddressField()
@@ -656,10 +878,11 @@ class Submission(models.Model):
     global_use      = models.ManyToManyField(UseFlag, blank=True, related_name='submissions')
     global_keywords = models.ManyToManyField(Keyword, blank=True, related_name='submissions')
 
-    installations = models.ManyToManyField(
-        Installation,
-        blank=True,
-        related_name='submissions',
+    # Shared with all submissions that report the same installations:
+    installation_set = models.ForeignKey( InstallationSet
+                                        , blank        = True
+                                        , null         = True
+                                        , related_name = 'submissions'
     )
 
     reported_sets = models.ManyToManyField(
@@ -689,6 +912,13 @@ class Submission(models.Model):
     def get_absolute_url(self):
         return ('stats:submission_details_url', (), {'id': self.id})
 
+    @property
+    def installations(self):
+        if self.installation_set_id is None:
+            return Installation.objects.none()
+
+        return Installation.objects.filter(installation_sets=self.installation_set_id)
+
     @property
     def tree_age(self):
         """
@@ -706,3 +936,97 @@ class Submission(models.Model):
                 pass
 
         return None
+
+class RollupABC(models.Model):
+    """
+    Abstract base class for the precomputed statistics of a dimension (such
+    as a FEATURE or a mirror). Maintained by gentoostats.stats.rollups.
+    """
+
+    # submissions that report the dimension object:
+    num_submissions = models.IntegerField(default=0)
+
+    # hosts that have ever reported it:
+    num_all_hosts   = models.IntegerField(default=0)
+
+    # hosts whose latest submission reports it:
+    num_hosts       = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+class FeatureRollup(RollupABC):
+    feature = models.OneToOneField(Feature, primary_key=True, related_name='rollup')
+
+class UseFlagRollup(RollupABC):
+    useflag = models.OneToOneField(UseFlag, primary_key=True, related_name='rollup')
+
+class KeywordRollup(RollupABC):
+    keyword = models.OneToOneField(Keyword, primary_key=True, related_name='rollup')
+
+class LangRollup(RollupABC):
+    lang = models.OneToOneField(Lang, primary_key=True, related_name='rollup')
+
+class MirrorServerRollup(RollupABC):
+    server = models.OneToOneField(MirrorServer, primary_key=True, related_name='rollup')
+
+class SyncServerRollup(RollupABC):
+    server = models.OneToOneField(SyncServer, primary_key=True, related_name='rollup')
+
+class RepositoryRollup(RollupABC):
+    repository = models.OneToOneField(Repository, primary_key=True, related_name='rollup')
+
+    # installations from the repository on the latest submissions:
+    num_packages = models.IntegerField(default=0)
+
+class RollupDelta(models.Model):
+    """
+    A change to the rollup row of the dimension object 'key' (of the dimension
+    called 'dimension', see gentoostats.stats.rollups) that has not been added
+    to the row itself yet.
+
+    Ingests append these instead of updating the rollup rows, which nearly
+    every submission shares (the gentoo repository, amd64, common USE flags)
+    and which would serialize concurrent ingests on their row locks.
+    """
+
+    dimension = models.CharField(max_length=15)
+    key       = models.IntegerField()
+
+    num_submissions = models.IntegerField(default=0)
+    num_all_hosts   = models.IntegerField(default=0)
+    num_hosts       = models.IntegerField(default=0)
+    num_packages    = models.IntegerField(default=0)
+
+class ArchivedReport(models.Model):
+    """
+    The archived submissions of 'host' reported the dimension object 'key'
+    (the PK of a Feature, UseFlag, ... see gentoostats.stats.rollups)
+    num_submissions times.
+
+    Written by gentoostats.stats.archive, so that the rollups can still be
+    computed once the submissions themselves are gone.
+    """
+
+    host      = models.ForeignKey(Host, related_name='archived_reports')
+    dimension = models.CharField(max_length=15)
+    key       = models.IntegerField()
+
+    num_submissions = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('dimension', 'key', 'host')
+
+class Snapshot(models.Model):
+    """
+    The data of a page that is too expensive to compute on each request, as
+    a JSON document. Only the latest one of each page is kept (see
+    gentoostats.stats.snapshots).
+    """
+
+    name         = models.CharField(max_length=63, unique=True)
+    data         = models.TextField()
+    generated_at = models.DateTimeField()
+
+    def __unicode__(self):
+        return "%s (%s)" % (self.name, self.generated_at)
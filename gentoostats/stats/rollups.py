@@ -0,0 +1,389 @@
+"""
+Precomputed statistics of the dimensions (FEATURES, USE flags, keywords,
+LANG, mirrors, SYNC servers and repositories).
+
+Every dimension object has a rollup row with its number of submissions, of
+hosts that have ever reported it, and of hosts whose latest submission reports
+it. update_rollups() records what a new submission changes as RollupDelta rows
+inside the ingest transaction, and fold_rollups() ("manage.py fold_rollups",
+which should run regularly) adds those to the rollup rows, so the rollups lag
+behind the submissions in between. "manage.py rebuild_rollups" compares them
+(pending changes included) with (and resets them to) the numbers computed from
+the submissions themselves (and the ArchivedReport rows of archived
+submissions, see gentoostats.stats.archive).
+"""
+
+from collections import namedtuple, defaultdict
+
+from django.db import transaction
+from django.db.models import F, Count, Sum
+
+from .util import chunked, bulk_create_or_fallback
+from .models import *
+
+# 'path' leads from a Submission to the dimension's objects:
+Dimension = namedtuple('Dimension', 'name rollup path')
+
+DIMENSIONS = ( Dimension('features',     FeatureRollup,      'features')
+             , Dimension('useflags',     UseFlagRollup,      'global_use')
+             , Dimension('keywords',     KeywordRollup,      'global_keywords')
+             , Dimension('langs',        LangRollup,         'lang')
+             , Dimension('mirrors',      MirrorServerRollup, 'mirrors')
+             , Dimension('syncs',        SyncServerRollup,   'sync')
+             , Dimension( 'repositories'
+                        , RepositoryRollup
+                        , 'installation_set__installations__package__repository'
+               )
+)
+
+def counters(rollup):
+    return [ f.name for f in rollup._meta.fields
+             if f.name.startswith('num_')
+    ]
+
+def fetch_values(submission_ids, path):
+    """
+    Return {submission ID: {dimension PK: number of rows}}.
+    """
+
+    values = defaultdict(dict)
+    for chunk in chunked(submission_ids):
+        rows = Submission.objects.order_by()\
+                .filter(pk__in=chunk)\
+                .values_list('pk', path)\
+                .annotate(count=Count('pk'))
+
+        for submission_id, key, count in rows:
+            if key is not None:
+                values[submission_id][key] = count
+
+    return values
+
+def _append(dimension, deltas):
+    """
+    Record 'deltas' ({PK: {counter: delta}}) as RollupDelta rows.
+
+    Unlike updating the rollup rows, this takes no locks that concurrent
+    ingests would wait for.
+    """
+
+    rows = [ RollupDelta(dimension=dimension.name, key=key, **delta)
+             for key, delta in sorted(deltas.items())
+             if any(delta.values())
+    ]
+
+    for chunk in chunked(rows):
+        RollupDelta.objects.bulk_create(chunk)
+
+def _apply(rollup, deltas):
+    """
+    Add 'deltas' ({PK: {counter: delta}}) to the rollup rows.
+    """
+
+    deltas = dict( (key, delta) for key, delta in deltas.items()
+                   if any(delta.values())
+    )
+    if not deltas:
+        return
+
+    # Rows are locked in primary key order, so that this can't deadlock with
+    # a concurrent rebuild_rollups() or fold_rollups():
+    keys = sorted(deltas)
+
+    existing = set()
+    for chunk in chunked(keys):
+        existing.update(
+            rollup.objects.select_for_update()\
+                .filter(pk__in=chunk)\
+                .order_by('pk')\
+                .values_list('pk', flat=True)
+        )
+
+    bulk_create_or_fallback(
+        rollup,
+        [rollup(pk=key) for key in keys if key not in existing],
+        lambda obj: rollup.objects.get_or_create(pk=obj.pk),
+    )
+
+    # Most rows change by the same amounts, so group them:
+    groups = defaultdict(list)
+    for key, delta in deltas.items():
+        groups[tuple(sorted(delta.items()))].append(key)
+
+    for delta, keys in groups.items():
+        update = dict( (counter, F(counter) + value)
+                       for counter, value in delta if value
+        )
+
+        for chunk in chunked(keys):
+            rollup.objects.filter(pk__in=chunk).update(**update)
+
+def update_rollups(submission):
+    """
+    Make 'submission' the latest submission of its host (unless a later one
+    has been ingested already) and add it to the rollups.
+
+    Has to be called inside the ingest transaction, once all relations of the
+    submission have been added.
+    """
+
+    # Lock the host, so that submissions of the same host are added one after
+    # another:
+    previous_id = Host.objects.select_for_update()\
+            .filter(pk=submission.host_id)\
+            .values_list('latest_submission', flat=True)[0]
+
+    is_latest = previous_id is None or previous_id < submission.pk
+    if is_latest:
+        Host.objects.filter(pk=submission.host_id)\
+                .update(latest_submission=submission)
+
+    submission_ids = [submission.pk]
+    if previous_id is not None:
+        submission_ids.append(previous_id)
+
+    for dimension in DIMENSIONS:
+        values   = fetch_values(submission_ids, dimension.path)
+        new      = values.get(submission.pk, dict())
+        previous = values.get(previous_id, dict())
+
+        has_packages = 'num_packages' in counters(dimension.rollup)
+        deltas = defaultdict(lambda: defaultdict(int))
+
+        for key in new:
+            deltas[key]['num_submissions'] += 1
+
+        if is_latest:
+            for key, count in new.items():
+                deltas[key]['num_hosts'] += 1
+                if has_packages:
+                    deltas[key]['num_packages'] += count
+
+            for key, count in previous.items():
+                deltas[key]['num_hosts'] -= 1
+                if has_packages:
+                    deltas[key]['num_packages'] -= count
+
+        # The host is new to whatever none of its other submissions report:
+        candidates = set(new) - set(previous)
+        if candidates:
+            seen = set(
+                Submission.objects.order_by()\
+                    .filter(host=submission.host_id)\
+                    .exclude(pk=submission.pk)\
+                    .filter(**{dimension.path + '__in': list(candidates)})\
+                    .values_list(dimension.path, flat=True)\
+                    .distinct()
+            )
+            seen.update(
+                ArchivedReport.objects\
+                    .filter( dimension = dimension.name
+                           , host      = submission.host_id
+                           , key__in   = list(candidates)
+                    )\
+                    .values_list('key', flat=True)
+            )
+
+            for key in candidates - seen:
+                deltas[key]['num_all_hosts'] += 1
+
+        _append(dimension, deltas)
+
+def fold_rollups(batch_size=10000):
+    """
+    Add the RollupDelta rows to the rollup rows, and delete them. Returns the
+    number of folded RollupDelta rows.
+    """
+
+    names = counters(RollupDelta)
+    dimensions = dict((d.name, d) for d in DIMENSIONS)
+
+    total = 0
+    last_id = 0
+
+    while True:
+        with transaction.commit_on_success():
+            # Locked, so that a concurrent run can't fold them again. Rows
+            # that are committed later with a lower id are left for the next
+            # run:
+            rows = list(
+                RollupDelta.objects.select_for_update()\
+                    .order_by('id')\
+                    .filter(id__gt=last_id)\
+                    .values_list('id', 'dimension', 'key', *names)\
+                    [:batch_size]
+            )
+
+            if not rows:
+                break
+
+            # {dimension name: {PK: {counter: delta}}}:
+            deltas = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+            for row in rows:
+                delta = deltas[row[1]][row[2]]
+                for name, value in zip(names, row[3:]):
+                    delta[name] += value
+
+            for name, dimension_deltas in sorted(deltas.items()):
+                rollup = dimensions[name].rollup
+                known  = counters(rollup)
+
+                _apply(rollup, dict(
+                    (key, dict((c, v) for c, v in delta.items() if c in known))
+                    for key, delta in dimension_deltas.items()
+                ))
+
+            for chunk in chunked([row[0] for row in rows]):
+                RollupDelta.objects.filter(pk__in=chunk).delete()
+
+        last_id = rows[-1][0]
+        total += len(rows)
+
+    return total
+
+def pending_deltas(dimension):
+    """
+    Return {dimension PK: {counter: delta}} of the RollupDelta rows of
+    'dimension' that have not been folded yet.
+    """
+
+    names = counters(dimension.rollup)
+
+    rows = RollupDelta.objects.order_by()\
+            .filter(dimension=dimension.name)\
+            .values('key')\
+            .annotate(*[Sum(name) for name in names])
+
+    return dict(
+        (row['key'], dict((name, row[name + '__sum']) for name in names))
+        for row in rows
+    )
+
+def compute_rollups(dimension):
+    """
+    Return {dimension PK: {counter: value}}, computed from the submissions.
+    """
+
+    result = defaultdict(lambda: dict.fromkeys(counters(dimension.rollup), 0))
+
+    # Read by name, as the order of the annotations isn't defined:
+    rows = Submission.objects.order_by()\
+            .values(dimension.path)\
+            .annotate( num_submissions = Count('pk',   distinct=True)
+                     , num_all_hosts   = Count('host', distinct=True)
+            )
+    for row in rows:
+        key = row[dimension.path]
+        if key is not None:
+            result[key]['num_submissions'] = row['num_submissions']
+            result[key]['num_all_hosts']   = row['num_all_hosts']
+
+    archived = ArchivedReport.objects.order_by()\
+            .filter(dimension=dimension.name)
+
+    rows = archived.values_list('key')\
+            .annotate(num_submissions=Sum('num_submissions'))
+    for key, num_submissions in rows:
+        result[key]['num_submissions'] += num_submissions
+
+    # Hosts of archived submissions, unless they have been counted already
+    # because one of their remaining submissions reports the same object:
+    counted = archived\
+            .filter(**{'host__submissions__' + dimension.path: F('key')})\
+            .values('pk')
+    rows = archived.exclude(pk__in=counted)\
+            .values_list('key')\
+            .annotate(num_all_hosts=Count('pk'))
+    for key, num_all_hosts in rows:
+        result[key]['num_all_hosts'] += num_all_hosts
+
+    rows = Submission.objects.latest_submissions.order_by()\
+            .values(dimension.path)\
+            .annotate( num_hosts    = Count('pk', distinct=True)
+                     , num_packages = Count('pk')
+            )
+    for row in rows:
+        key = row[dimension.path]
+        if key is not None:
+            result[key]['num_hosts'] = row['num_hosts']
+            if 'num_packages' in result[key]:
+                result[key]['num_packages'] = row['num_packages']
+
+    return result
+
+def diff_rollups(dimension):
+    """
+    Return a list of (PK, stored counters, computed counters) of the rollup
+    rows that don't match the submissions.
+    """
+
+    names    = counters(dimension.rollup)
+    computed = compute_rollups(dimension)
+    stored   = dict(
+        (row[0], dict(zip(names, row[1:])))
+        for row in dimension.rollup.objects.values_list('pk', *names)
+    )
+
+    zeros = dict.fromkeys(names, 0)
+
+    # As they will be once the pending changes have been folded:
+    for key, delta in pending_deltas(dimension).items():
+        stored[key] = dict( (name, stored.get(key, zeros)[name] + delta[name])
+                            for name in names
+        )
+
+    mismatches = []
+    for key in set(computed) | set(stored):
+        if stored.get(key, zeros) != computed.get(key, zeros):
+            mismatches.append(( key
+                              , stored.get(key, zeros)
+                              , computed.get(key, zeros)
+            ))
+
+    return mismatches
+
+def rebuild_rollups(dimension):
+    """
+    Replace the rollup rows of 'dimension' with computed ones.
+
+    Submissions that are ingested in the meantime may be lost, so this is
+    better done while the receiver is stopped.
+    """
+
+    rollup = dimension.rollup
+    rows   = [ rollup(pk=key, **values)
+               for key, values in compute_rollups(dimension).items()
+    ]
+
+    with transaction.commit_on_success():
+        # The computed rows include whatever they record:
+        RollupDelta.objects.filter(dimension=dimension.name).delete()
+
+        rollup.objects.all().delete()
+        for chunk in chunked(rows):
+            rollup.objects.bulk_create(chunk)
+
+def with_rollups(queryset, name):
+    """
+    Return the objects of 'queryset' (of the dimension called 'name') with
+    their rollups, so that num_hosts etc. don't need a query per object.
+
+    Objects without a rollup row yet (e.g. until "manage.py rebuild_rollups"
+    has been run after an upgrade) get one that is computed for all of them
+    at once, but not saved.
+    """
+
+    dimension = [d for d in DIMENSIONS if d.name == name][0]
+    rollup    = dimension.rollup
+
+    objects = list(queryset.select_related('rollup'))
+    missing = [obj for obj in objects if get_rollup(obj) is None]
+
+    if missing:
+        computed   = compute_rollups(dimension)
+        cache_name = queryset.model.rollup.cache_name
+
+        for obj in missing:
+            setattr(obj, cache_name, rollup(pk=obj.pk, **computed[obj.pk]))
+
+    return objects
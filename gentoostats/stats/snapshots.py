@@ -0,0 +1,99 @@
+"""
+Snapshots of pages that are too expensive to compute on each request.
+
+"manage.py take_snapshots" (run from cron, or with --interval) computes the
+data of each page in SNAPSHOTS and stores it as one JSON document, so that the
+views only have to read it back, no matter how many submissions there are.
+"""
+
+import json
+
+from django.db import transaction, IntegrityError
+from django.db.models import Count
+from django.utils import timezone
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Host, Submission, Feature, Lang, Keyword, Snapshot
+
+def overall_stats():
+    """
+    Return the data of the overall_stats page.
+    """
+
+    latest = Submission.objects.latest_submissions
+
+    recent = Submission.objects.order_by('-datetime')\
+            .prefetch_related('global_keywords')[:10]
+
+    def dimension_stats(model):
+        # The number of hosts comes from the rollups (see .rollups):
+        return list(
+            model.objects.filter(rollup__num_hosts__gt=0)\
+                .order_by('name')\
+                .values_list('name', 'rollup__num_hosts')
+        )
+
+    return dict(
+        num_hosts       = Host.objects.count(),
+        num_submissions = Submission.objects.count(),
+
+        recent_submissions = [
+            dict( datetime = s.datetime
+                , arch     = s.arch
+                , keywords = [k.name for k in s.global_keywords.all()]
+            )
+            for s in reversed(list(recent))
+        ],
+
+        country_stats = list(latest.filter(country__isnull=False).values_list('country').annotate(num_hosts=Count('country')).order_by('country')),
+        arch_stats    = list(latest.values_list('arch').annotate(num_hosts=Count('arch')).order_by('arch')),
+        profile_stats = list(latest.values_list('profile').annotate(num_hosts=Count('profile')).order_by('profile')),
+
+        features = dimension_stats(Feature),
+        langs    = dimension_stats(Lang),
+        keywords = dimension_stats(Keyword),
+    )
+
+SNAPSHOTS = dict(
+    overall_stats = overall_stats,
+)
+
+def take_snapshot(name):
+    """
+    Compute and store the data of page 'name', replacing its previous
+    snapshot.
+    """
+
+    data = json.dumps(SNAPSHOTS[name](), cls=DjangoJSONEncoder)
+    generated_at = timezone.now()
+
+    with transaction.commit_on_success():
+        updated = Snapshot.objects.filter(name=name)\
+                .update(data=data, generated_at=generated_at)
+
+        if not updated:
+            sid = transaction.savepoint()
+            try:
+                Snapshot.objects.create( name         = name
+                                       , data         = data
+                                       , generated_at = generated_at
+                )
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # Created by a concurrent job in the meantime:
+                transaction.savepoint_rollback(sid)
+                Snapshot.objects.filter(name=name)\
+                        .update(data=data, generated_at=generated_at)
+
+def get_snapshot(name):
+    """
+    Return (data, generated_at) of the latest snapshot of page 'name', or None
+    if there is none yet.
+    """
+
+    try:
+        snapshot = Snapshot.objects.get(name=name)
+    except Snapshot.DoesNotExist:
+        return None
+
+    return json.loads(snapshot.data), snapshot.generated_at
@@ -4,6 +4,8 @@ from django import template
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
+from gentoostats.stats.useflags import get_use_flags
+
 register = template.Library()
 
 # The following is taken from gentoolkit.flag, I've copied it here for
@@ -47,9 +49,7 @@ def divide(a, b):
 def format_use_flags(installation):
     """Prints USE flag information with <span> elements."""
 
-    use    = installation.use.values_list('name', flat=True)
-    iuse   = installation.iuse.values_list('name', flat=True)
-    pkguse = installation.pkguse.values_list('name', flat=True)
+    iuse, pkguse, use = get_use_flags(installation)
 
     # Remove '-' and '+' from IUSE use flags:
     iuse = [reduce_flag(f) for f in iuse]
@@ -1,16 +1,449 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
-"""
+import os
+import sys
+import time
+import uuid
+import datetime
 
 from django.test import TestCase
+from django.db import connection, reset_queries
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+
+from .util import add_relations, chunked
+from .rollups import DIMENSIONS, counters, rebuild_rollups, with_rollups
+from .versions import version_key
+from .snapshots import take_snapshot
+from .apps import app_stats
+from .models import Host, Submission, Installation, InstallationSet, \
+                    Package, Category, PackageName, Repository, Atom, \
+                    AtomSet, UseFlag, Keyword, Feature, Lang, MirrorServer, \
+                    SyncServer, installation_set_hash
+
+# Number of hosts of the seeded databases (each one is a superset of the
+# previous one). Checking that the number of queries doesn't grow with the data
+# takes several (and larger) ones, e.g.
+# GENTOOSTATS_QUERY_BUDGET_SCALES=1000,10000,100000:
+SCALES = [
+    int(n) for n in os.environ.get( 'GENTOOSTATS_QUERY_BUDGET_SCALES'
+                                  , '1000'
+                                  ).split(',')
+]
+
+# Sizes of the lookup tables, independent of the number of hosts:
+MIRRORS   = 4
+SYNCS     = 2
+REPOS     = 3
+KEYWORDS  = 3
+FEATURES  = 8
+LANGS     = 3
+USEFLAGS  = 30
+PACKAGES  = 12
+PROFILES  = ('default/linux/amd64/17.1', 'default/linux/x86/17.0', 'hardened/linux/amd64')
+ARCHES    = ('amd64', 'x86')
+COUNTRIES = ('Germany', 'France', 'Greece', None)
+
+# Per host:
+HOST_FEATURES      = 3
+HOST_USEFLAGS      = 5
+HOST_INSTALLATIONS = 4
+
+# Upper bounds on the number of queries of each page. None of them may issue
+# queries per host, or per row of the lookup tables:
+QUERY_BUDGETS = ( ('overall_stats',    5)
+                , ('use_stats',        5)
+                , ('server_stats',     5)
+                , ('repository_stats', 5)
+                , ('host_details',     30)
+)
+
+class StatsQueryBudgetTest(TestCase):
+    """
+    Renders the stats pages on databases of increasing size, and checks the
+    number of queries of each page against its budget.
+
+    The render times are written to stderr, e.g.:
+
+        query budget: host_details     hosts=  1000 queries=  20    41.2 ms
+    """
 
+    def setUp(self):
+        self.mirrors  = [ MirrorServer.objects.create(url="http://mirror%d.example.org" % i)
+                          for i in range(MIRRORS)
+        ]
+        self.syncs    = [ SyncServer.objects.create(url="rsync://rsync%d.example.org/gentoo-portage" % i)
+                          for i in range(SYNCS)
+        ]
+        self.keywords = [ Keyword.objects.create(name="arch%d" % i)
+                          for i in range(KEYWORDS)
+        ]
+        self.features = [ Feature.objects.create(name="feature%d" % i)
+                          for i in range(FEATURES)
+        ]
+        self.langs    = [ Lang.objects.create(name="lang%d.utf8" % i)
+                          for i in range(LANGS)
+        ]
+        self.useflags = [ UseFlag.objects.create(name="flag%d" % i)
+                          for i in range(USEFLAGS)
+        ]
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+        repositories = [ Repository.objects.create(name="repo%d" % i)
+                         for i in range(REPOS)
+        ]
+
+        self.installations = []
+        for i in range(PACKAGES):
+            package = Package.objects.create(
+                category     = Category.objects.get_or_create(name="cat-%d" % (i % 4))[0],
+                package_name = PackageName.objects.get_or_create(name="pkg%d" % i)[0],
+                version      = "1.%d" % i,
+                repository   = repositories[i % REPOS],
+            )
+
+            self.installations.append(Installation.objects.create(
+                package = package,
+                keyword = self.keywords[0],
+            ))
+
+        # Hosts share the installation sets, like unchanged systems do:
+        self.installation_sets = []
+        for i in range(PACKAGES):
+            installations = [ self.installations[(i + j) % PACKAGES]
+                              for j in range(HOST_INSTALLATIONS)
+            ]
+
+            installation_set = InstallationSet.objects.create(
+                state_hash = installation_set_hash(o.id for o in installations)
+            )
+            installation_set.installations.add(*installations)
+            self.installation_sets.append(installation_set)
+
+        self.hosts = 0
+
+    def seed(self, hosts):
         """
-        Tests that 1 + 1 always equals 2.
+        Add hosts (with one submission each) until there are 'hosts' of them.
         """
-        self.assertEqual(1 + 1, 2)
+
+        for chunk in chunked(range(self.hosts, hosts)):
+            # Foreign keys are checked at commit time:
+            Host.objects.bulk_create([
+                Host( id                   = str(uuid.UUID(int=i + 1))
+                    , upload_key           = "key%d" % i
+                    , latest_submission_id = i + 1
+                )
+                for i in chunk
+            ])
+
+            Submission.objects.bulk_create([
+                Submission( id                   = i + 1
+                          , raw_request_filename = "budget-%d" % i
+                          , host_id              = str(uuid.UUID(int=i + 1))
+                          , ip_addr              = "10.0.%d.%d" % (i // 256 % 256, i % 256)
+                          , country              = COUNTRIES[i % len(COUNTRIES)]
+                          , protocol             = 2
+                          , arch                 = ARCHES[i % len(ARCHES)]
+                          , profile              = PROFILES[i % len(PROFILES)]
+                          , lang                 = self.langs[i % LANGS]
+                          , sync                 = self.syncs[i % SYNCS]
+                          , installation_set     = self.installation_sets[i % PACKAGES]
+                )
+                for i in chunk
+            ])
+
+            def pairs(objects, per_host):
+                return [ (i + 1, objects[(i + j) % len(objects)].pk)
+                         for i in chunk
+                         for j in range(per_host)
+                ]
+
+            add_relations( Submission, 'mirrors'
+                         , pairs(self.mirrors, 1)
+                         , check_existing = False
+            )
+            add_relations( Submission, 'global_keywords'
+                         , pairs(self.keywords, 1)
+                         , check_existing = False
+            )
+            add_relations( Submission, 'features'
+                         , pairs(self.features, HOST_FEATURES)
+                         , check_existing = False
+            )
+            add_relations( Submission, 'global_use'
+                         , pairs(self.useflags, HOST_USEFLAGS)
+                         , check_existing = False
+            )
+
+        if not self.hosts and hosts:
+            self.add_world_set(Submission.objects.get(pk=1))
+
+        for dimension in DIMENSIONS:
+            rebuild_rollups(dimension)
+
+        take_snapshot('overall_stats')
+
+        self.hosts = max(self.hosts, hosts)
+
+    def add_world_set(self, submission):
+        world = AtomSet.objects.create(name='world', owner=submission)
+        for installation in self.installations[:3]:
+            package = installation.package
+            world.atoms.add(Atom.objects.create( full_atom    = package.cp
+                                               , category     = package.category
+                                               , package_name = package.package_name
+            ))
+
+        selected = AtomSet.objects.create(name='selected', owner=submission)
+        selected.subsets.add(world)
+
+        submission.reported_sets.add(world, selected)
+
+    def render(self, name):
+        """
+        Return the (number of queries, seconds) it takes to render a page.
+        """
+
+        if name == 'host_details':
+            url = reverse( 'stats:host_details_url'
+                         , kwargs = dict(host_id=str(uuid.UUID(int=1)))
+            )
+        else:
+            url = reverse('stats:%s_url' % name)
+
+        # The pages are cached:
+        cache.clear()
+        reset_queries()
+
+        started  = time.time()
+        response = self.client.get(url)
+        seconds  = time.time() - started
+
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries), seconds
+
+    def test_query_budgets(self):
+        connection.use_debug_cursor = True
+        try:
+            queries = dict()
+            for hosts in SCALES:
+                self.seed(hosts)
+
+                for name, budget in QUERY_BUDGETS:
+                    count, seconds = self.render(name)
+                    sys.stderr.write( "\nquery budget: %-16s hosts=%6d queries=%4d %8.1f ms"
+                                    % (name, hosts, count, seconds * 1000)
+                    )
+
+                    self.assertTrue( count <= budget
+                                   , "%s issued %d queries with %d hosts "
+                                     "(budget: %d)" % (name, count, hosts, budget)
+                    )
+
+                    # The number of queries must not grow with the data:
+                    first_count = queries.setdefault(name, count)
+                    self.assertEqual( count, first_count
+                                    , "%s issued %d queries with %d hosts, but "
+                                      "%d with %d hosts" % ( name, count, hosts
+                                                           , first_count
+                                                           , SCALES[0]
+                                      )
+                    )
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_missing_rollups(self):
+        self.seed(SCALES[0])
+
+        dimensions = dict((d.name, d) for d in DIMENSIONS)
+        listings   = ( (MirrorServer, 'mirrors')
+                     , (SyncServer,   'syncs')
+                     , (Repository,   'repositories')
+        )
+
+        expected = dict()
+        for model, name in listings:
+            names = counters(dimensions[name].rollup)
+            expected[name] = dict(
+                (row[0], row[1:])
+                for row in dimensions[name].rollup.objects.values_list('pk', *names)
+            )
+            dimensions[name].rollup.objects.all().delete()
+
+        connection.use_debug_cursor = True
+        try:
+            for name in ('server_stats', 'repository_stats'):
+                # Computing the rollups takes a few grouped queries per
+                # dimension, however many objects there are:
+                count, seconds = self.render(name)
+                self.assertTrue(count <= 2 * dict(QUERY_BUDGETS)[name])
+        finally:
+            connection.use_debug_cursor = None
+
+        for model, name in listings:
+            names = counters(dimensions[name].rollup)
+            for obj in with_rollups(model.objects.all(), name):
+                self.assertEqual( tuple(getattr(obj, n) for n in names)
+                                , expected[name].get(obj.pk, (0,) * len(names))
+                )
+
+class HostUUIDTest(TestCase):
+    def test_spellings(self):
+        host = Host.objects.create( id         = str(uuid.UUID(int=42))
+                                  , upload_key = 'secret'
+        )
+        host = Host.objects.get(pk=host.pk)
+        self.assertEqual(host.id, '00000000-0000-0000-0000-00000000002a')
+
+        for spelling in ( '00000000-0000-0000-0000-00000000002A'
+                        , '0000000000000000000000000000002a'
+                        , uuid.UUID(int=42)
+        ):
+            self.assertEqual(Host.objects.get(id=spelling), host)
+
+        submission = Submission.objects.create( host                 = host
+                                              , raw_request_filename = "uuid"
+                                              , ip_addr              = "10.0.0.1"
+                                              , protocol             = 2
+        )
+        self.assertEqual(
+            Submission.objects.filter(host=host.id).get(), submission
+        )
+
+    def test_invalid(self):
+        # Text is never taken for the 16 byte stored form:
+        for value in (u'abcdefghijklmnop', u'\xe9' * 16, 'x' * 36, 42):
+            self.assertRaises( ValidationError
+                             , Host._meta.pk.to_python
+                             , value
+            )
+
+class VersionKeyTest(TestCase):
+    # In the order of Portage's vercmp():
+    VERSIONS = [ '0.9', '1', '1.0', '1.0a', '1.0.0', '1.0.1', '1.01', '1.010.1'
+               , '1.02', '1.1_alpha', '1.1_beta2', '1.1_pre', '1.1_rc1'
+               , '1.1_rc1_p1', '1.1_rc2', '1.1', '1.1-r1', '1.1_p', '1.1_p1-r3'
+               , '1.1_p2', '1.1b', '1.2', '1.9', '1.10', '1.100', '2', '10'
+               , '9999'
+    ]
+
+    def test_order(self):
+        self.assertEqual(version_key('1.1'), version_key('1.1-r0'))
+        self.assertEqual(version_key('1.01'), version_key('1.010'))
+        self.assertEqual(version_key('not a version'), None)
+
+        # (sorted() is stable, so equal keys would go unnoticed otherwise)
+        keys = [version_key(v) for v in self.VERSIONS]
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(sorted(keys), keys)
+
+    def test_queries(self):
+        category     = Category.objects.create(name='app-misc')
+        package_name = PackageName.objects.create(name='foo')
+
+        for version in reversed(self.VERSIONS):
+            Package.objects.create( category     = category
+                                  , package_name = package_name
+                                  , version      = version
+            )
+
+        self.assertEqual(
+            list(Package.objects.values_list('version', flat=True)),
+            self.VERSIONS
+        )
+        self.assertEqual(
+            list(Package.objects.filter(version_key__lt=version_key('1.0.1'))\
+                    .values_list('version', flat=True)),
+            self.VERSIONS[:5]
+        )
+
+class SnapshotTest(TestCase):
+    def get_overall_stats(self):
+        cache.clear()
+        response = self.client.get(reverse('stats:overall_stats_url'))
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_overall_stats(self):
+        Host.objects.create(id=str(uuid.UUID(int=1)), upload_key='secret')
+
+        # The first request takes the missing snapshot:
+        context = self.get_overall_stats()
+        self.assertEqual(context['num_hosts'], 1)
+        generated_at = context['generated_at']
+
+        # Later ones show it until the next one is taken:
+        Host.objects.create(id=str(uuid.UUID(int=2)), upload_key='secret')
+        context = self.get_overall_stats()
+        self.assertEqual(context['num_hosts'], 1)
+        self.assertEqual(context['generated_at'], generated_at)
+
+        take_snapshot('overall_stats')
+        self.assertEqual(self.get_overall_stats()['num_hosts'], 2)
+
+class AppStatsTest(TestCase):
+    CATALOG = [ [ 'Editors'
+                ,   ['Vi/Vim', 'app-editors/vim', 'app-editors/gvim']
+                ,   ['Emacs', 'app-editors/emacs']
+                ]
+    ]
+
+    def test_app_stats(self):
+        keyword = Keyword.objects.create(name='amd64')
+
+        installations = dict()
+        for cp in ('app-editors/vim', 'app-editors/gvim', 'app-editors/emacs'):
+            category, package_name = cp.split('/')
+            package = Package.objects.create(
+                category     = Category.objects.get_or_create(name=category)[0],
+                package_name = PackageName.objects.create(name=package_name),
+                version      = '1',
+            )
+            installations[cp] = Installation.objects.create( package = package
+                                                           , keyword = keyword
+            )
+
+        # The last host hasn't submitted anything for too long to count:
+        hosts = [ ('app-editors/vim', 'app-editors/gvim')
+                , ('app-editors/gvim',)
+                , ('app-editors/emacs',)
+                , ('app-editors/emacs',)
+                , ()
+                , ('app-editors/vim',)
+        ]
+
+        installation_sets = dict()
+        for i, cps in enumerate(hosts):
+            if cps and cps not in installation_sets:
+                installation_set = InstallationSet.objects.create(
+                    state_hash = installation_set_hash(
+                        installations[cp].pk for cp in cps
+                    )
+                )
+                installation_set.installations.add(
+                    *[installations[cp] for cp in cps]
+                )
+                installation_sets[cps] = installation_set
+
+            host = Host.objects.create( id         = str(uuid.UUID(int=i + 1))
+                                      , upload_key = 'secret'
+            )
+            host.latest_submission = Submission.objects.create(
+                host                 = host,
+                raw_request_filename = "apps-%d" % i,
+                ip_addr              = "10.0.0.1",
+                protocol             = 2,
+                installation_set     = installation_sets.get(cps),
+            )
+            host.save()
+
+        Submission.objects.filter(host=host).update(
+            datetime = timezone.now() - datetime.timedelta(days=365)
+        )
+
+        self.assertEqual(app_stats(self.CATALOG), (5, [
+            [ 'Editors'
+            ,   [('Vi/Vim', 40), ('app-editors/vim', 20), ('app-editors/gvim', 40)]
+            ,   [('Emacs', 40), ('app-editors/emacs', 40)]
+            ]
+        ]))
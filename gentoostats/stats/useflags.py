@@ -0,0 +1,105 @@
+"""
+Compact encoding of installation USE flags.
+
+The IUSE, PKGUSE and USE flags of an installation are normally stored in three
+ManyToMany tables, the largest tables of the database. With
+GENTOOSTATS_COMPACT_USE_FLAGS enabled, the receiver stores them in the
+Installation's packed_* columns instead: each flag name gets a small integer
+ID (UseFlagNumber), and each set of flags is stored as the sorted,
+comma-separated list of its IDs.
+
+get_use_flags() decodes both representations, so the rest of the code doesn't
+have to care which one an installation uses ("manage.py pack_use_flags"
+converts existing installations).
+"""
+
+from django.conf import settings
+
+from .util import LRUCache, chunked
+from .interning import useflag_number_cache
+from .models import UseFlagNumber
+
+COMPACT_USE_FLAGS = getattr(settings, 'GENTOOSTATS_COMPACT_USE_FLAGS', False)
+
+# Number -> name. Numbers never change once they are committed, and only
+# committed rows are read, so there is nothing to invalidate:
+_names = LRUCache(getattr(settings, 'GENTOOSTATS_INTERN_CACHE_SIZE', 10000))
+
+def encode_numbers(numbers):
+    """
+    Return the packed form of a list of UseFlagNumber IDs.
+    """
+
+    return ','.join(str(n) for n in sorted(set(numbers)))
+
+def decode_numbers(packed):
+    """
+    Return the UseFlagNumber IDs of a packed column.
+    """
+
+    return [int(n) for n in packed.split(',')] if packed else []
+
+def flag_numbers(names):
+    """
+    Return a dict mapping flag names to their UseFlagNumber IDs, creating the
+    missing ones.
+
+    Should be called inside interning.deferred().
+    """
+
+    numbers = useflag_number_cache.get_or_create_many(names)
+    return dict((name, obj.pk) for name, obj in numbers.items())
+
+def encode_flags(flags, numbers):
+    """
+    Return the packed form of a list of flag names, given the flag_numbers()
+    of (at least) all of them.
+    """
+
+    return encode_numbers(numbers[f] for f in flags if f)
+
+def flag_names(numbers):
+    """
+    Return a dict mapping UseFlagNumber IDs to flag names.
+    """
+
+    numbers = set(numbers)
+
+    result = dict()
+    for n in numbers:
+        name = _names.get(n)
+        if name is not None:
+            result[n] = name
+
+    for chunk in chunked(numbers.difference(result)):
+        rows = UseFlagNumber.objects.filter(pk__in=chunk)\
+                .values_list('pk', 'name')
+
+        for n, name in rows:
+            _names.set(n, name)
+            result[n] = name
+
+    return result
+
+def clear_cache():
+    _names.clear()
+
+def get_use_flags(installation):
+    """
+    Return the (IUSE, PKGUSE, USE) flag names of an installation.
+    """
+
+    if installation.packed_use is None:
+        # .all() instead of .values_list() to benefit from prefetching:
+        return ( [f.name for f in installation.iuse.all()]
+               , [f.name for f in installation.pkguse.all()]
+               , [f.name for f in installation.use.all()]
+        )
+
+    packed = [ decode_numbers(installation.packed_iuse)
+             , decode_numbers(installation.packed_pkguse)
+             , decode_numbers(installation.packed_use)
+    ]
+
+    names = flag_names(n for numbers in packed for n in numbers)
+    return tuple([names[n] for n in numbers] for numbers in packed)
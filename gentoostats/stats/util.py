@@ -1,10 +1,74 @@
-from .models import UseFlag
+import logging
+import threading
+from itertools import islice
+from collections import OrderedDict
+
+from django.db import transaction, IntegrityError
+from django.db.models import ForeignKey
+from django.core.exceptions import ValidationError
+
+from gentoostats.receiver.util import BadRequestException
+
+logger = logging.getLogger(__name__)
+
+# Keep IN (...) lists and multi-row INSERTs below SQLite's 999 parameter limit:
+BATCH_SIZE = 450
 
 def split_list(lst):
     """Split a list into head:tail."""
 
     return lst[0], lst[1:]
 
+def chunked(iterable, size=BATCH_SIZE):
+    """Split an iterable into lists of at most 'size' items."""
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class LRUCache(object):
+    """
+    A small thread-safe mapping that evicts its least recently used entries
+    once it holds more than 'max_size' of them.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            # Move the entry to the most recently used end:
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
 def add_hyphens_to_uuid(uuid):
     """
     Try adding 4 hyphens to an UUID if its length after all existing hyphens are
@@ -40,15 +104,120 @@ def validate_item(item):
         logger.info("validate_item(): " + error_message, exc_info=True)
         raise BadRequestException(error_message)
 
-def get_useflag_objects(useflag_list):
-    if not useflag_list:
-        return useflag_list
+def validate_new_item(item):
+    """
+    Like validate_item(), but meant for objects that are about to be
+    bulk-created.
+
+    Only the field validators are run. Uniqueness and foreign key checks are
+    skipped, because each of them costs a query and the bulk callers have
+    already resolved both.
+    """
 
-    useflag_list = [
-        UseFlag.objects.get_or_create(name=u)[0] \
-        for u in useflag_list
+    exclude = [
+        f.name for f in item._meta.fields if isinstance(f, ForeignKey)
     ]
 
-    map(validate_item, useflag_list)
+    try:
+        item.clean_fields(exclude=exclude)
+    except ValidationError as e:
+        error_message = "Error: '%s' failed validation." % str(item)
+        logger.info("validate_new_item(): " + error_message, exc_info=True)
+        raise BadRequestException(error_message)
+
+def bulk_create_or_fallback(model, objects, fallback):
+    """
+    bulk_create() 'objects' inside a savepoint.
 
-    return useflag_list
+    If that fails because a concurrent submission has created some of the rows
+    in the meantime, roll back to the savepoint and call fallback(obj) (usually
+    a get_or_create() wrapper) for every object instead.
+    """
+
+    for chunk in chunked(objects):
+        sid = transaction.savepoint()
+        try:
+            model.objects.bulk_create(chunk)
+            transaction.savepoint_commit(sid)
+        except IntegrityError as e:
+            transaction.savepoint_rollback(sid)
+            logger.info( "bulk_create_or_fallback(): race on %s, retrying"
+                       , model.__name__
+            )
+
+            for obj in chunk:
+                fallback(obj)
+
+def get_or_create_many(model, values, field='name'):
+    """
+    Bulk equivalent of get_or_create() for models identified by a single
+    unique field.
+
+    Returns a dict mapping each (non-empty) value to its model object. Existing
+    objects are fetched with a few IN (...) queries, the missing ones are
+    validated and created with bulk_create().
+    """
+
+    values = set(v for v in values if v)
+
+    objects = dict()
+    for chunk in chunked(values):
+        for obj in model.objects.filter(**{field + '__in': chunk}):
+            objects[getattr(obj, field)] = obj
+
+    missing = [model(**{field: v}) for v in values if v not in objects]
+    if not missing:
+        return objects
+
+    for obj in missing:
+        validate_new_item(obj)
+
+    bulk_create_or_fallback(
+        model, missing,
+        lambda obj: model.objects.get_or_create(**{field: getattr(obj, field)})
+    )
+
+    if model._meta.pk.name == field:
+        # The PK is known in advance, so there is no need to re-fetch anything.
+        objects.update((getattr(obj, field), obj) for obj in missing)
+    else:
+        # bulk_create() does not set auto-incremented PKs:
+        for chunk in chunked(missing):
+            names = [getattr(obj, field) for obj in chunk]
+            for obj in model.objects.filter(**{field + '__in': names}):
+                objects[getattr(obj, field)] = obj
+
+    return objects
+
+def add_relations(model, field_name, pairs, check_existing=True):
+    """
+    Bulk equivalent of obj.<field_name>.add(*targets) for many objects at once.
+
+    'pairs' is an iterable of (source PK, target PK) tuples. Relations that
+    already exist are skipped, unless check_existing is False (e.g. because the
+    source objects have just been created).
+    """
+
+    field   = model._meta.get_field(field_name)
+    through = field.rel.through
+
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+
+    pairs = set(pairs)
+    if not pairs:
+        return
+
+    if check_existing:
+        sources = set(s for s, _ in pairs)
+        for chunk in chunked(sources):
+            existing = through.objects.filter(**{source + '__in': chunk})\
+                    .values_list(source, target)
+
+            pairs.difference_update(existing)
+
+    links = [
+        through(**{source + '_id': s, target + '_id': t}) for s, t in pairs
+    ]
+    for chunk in chunked(links):
+        through.objects.bulk_create(chunk)
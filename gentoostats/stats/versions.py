@@ -0,0 +1,80 @@
+"""
+Sort keys for Portage versions.
+
+version_key() turns a version into a string that sorts (as a plain string, in
+the database) the way Portage's vercmp() orders the versions themselves, so
+that Package.version_key can be used for ORDER BY and range filters.
+
+The key only uses digits and lowercase letters, whose order is the same in
+every collation we care about. It is a sequence of tokens:
+
+    numeric components:  '2' + length + digits  (integers, e.g. 1.10)
+                         '1' + digits as a-j + '0'  (with a leading zero,
+                                                 compared as fractions, e.g. 1.05)
+                         '0' after the last one
+    letter:              the letter, or '0'
+    suffixes:            '1' (_alpha), '2' (_beta), '3' (_pre), '4' (_rc),
+                         '6' (_p), each followed by length + digits of its
+                         number, and '5' after the last one
+    revision:            length + digits
+
+Lengths are single base 36 digits; versions are at most 31 characters long.
+"""
+
+import re
+
+VERSION_RE = re.compile(
+    r'^(\d+)((?:\.\d+)*)([a-z]?)((?:_(?:pre|p|beta|alpha|rc)\d*)*)(?:-r(\d+))?$'
+)
+SUFFIX_RE  = re.compile(r'_(pre|p|beta|alpha|rc)(\d*)')
+
+SUFFIX_KEYS = dict(alpha='1', beta='2', pre='3', rc='4', p='6')
+END_OF_SUFFIXES = '5'
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def _int_key(digits):
+    """
+    Return a key for an integer given as a string of digits.
+    """
+
+    digits = digits.lstrip('0') or '0'
+    if len(digits) >= len(DIGITS):
+        raise ValueError("Number too long: %s" % digits)
+
+    return DIGITS[len(digits)] + digits
+
+def _component_key(component):
+    if component.startswith('0'):
+        # Compared digit by digit, as if all were padded with zeros to the
+        # same length:
+        digits = component.rstrip('0')
+        return '1' + ''.join(DIGITS[10 + int(d)] for d in digits) + '0'
+
+    return '2' + _int_key(component)
+
+def version_key(version):
+    """
+    Return the sort key of a Portage version (with or without revision), or
+    None if it is not a valid version.
+    """
+
+    match = VERSION_RE.match(version or '')
+    if not match:
+        return None
+
+    first, components, letter, suffixes, revision = match.groups()
+
+    key = ['2' + _int_key(first)]
+    key.extend(_component_key(c) for c in components.split('.')[1:])
+    key.append('0')
+
+    key.append(letter or '0')
+
+    for suffix, number in SUFFIX_RE.findall(suffixes):
+        key.append(SUFFIX_KEYS[suffix] + _int_key(number))
+    key.append(END_OF_SUFFIXES)
+
+    key.append(_int_key(revision or '0'))
+
+    return ''.join(key)
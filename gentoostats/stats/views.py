@@ -1,26 +1,25 @@
 from __future__ import division
 
 import json
-import operator
-import datetime
 
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.cache import cache_page, cache_control
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ObjectDoesNotExist
-from django.utils.timezone import utc
+from django.utils.dateparse import parse_datetime
 from django.views.generic import ListView, DetailView
-from django.db.models import Q, Min, Max, Count
+from django.db.models import Min, Max, Count
 from django.shortcuts import render, redirect, \
                              get_object_or_404, get_list_or_404
 from django.http import Http404
 
-from .util import split_list, add_hyphens_to_uuid
+from .util import add_hyphens_to_uuid
+from .snapshots import get_snapshot, take_snapshot
+from .apps import cached_app_stats
+from .rollups import with_rollups
 from .forms import *
 from .models import *
 
-FRESH_SUBMISSION_MAX_AGE = 30 # in days
-
 class ImprovedDetailView(DetailView):
     """
     A DetailView subclass that respects 'extra_context'.
@@ -83,26 +82,21 @@ def stats(request):
 @cache_page(1 * 60)
 def overall_stats(request):
     """
-    Show overall stats for the website.
+    Show overall stats for the website, as of the latest snapshot (see
+    .snapshots).
     """
 
-    latest_submission_q = Q(submissions__in=Submission.objects.latest_submission_ids)
+    snapshot = get_snapshot('overall_stats')
+    if snapshot is None:
+        # Only until "manage.py take_snapshots" has run for the first time:
+        take_snapshot('overall_stats')
+        snapshot = get_snapshot('overall_stats')
 
-    features = Feature.objects.filter(latest_submission_q).annotate(num_hosts_fast=Count('submissions')).order_by('name')
-    langs    = Lang.objects.filter(latest_submission_q).annotate(num_hosts_fast=Count('submissions')).order_by('name')
-    keywords = Keyword.objects.filter(latest_submission_q).annotate(num_hosts_fast=Count('submissions')).order_by('name')
+    data, generated_at = snapshot
+    for submission in data['recent_submissions']:
+        submission['datetime'] = parse_datetime(submission['datetime'])
 
-    context = dict(
-        hosts         = Host.objects.all(),
-        submissions   = Submission.objects.select_related().order_by('-datetime'),
-        country_stats = Submission.objects.latest_submissions.filter(country__isnull=False).values_list('country').annotate(num_hosts=Count('country')).order_by('country'),
-        arch_stats    = Submission.objects.latest_submissions.values_list('arch').annotate(num_hosts=Count('arch')).order_by('arch'),
-        profile_stats = Submission.objects.latest_submissions.values_list('profile').annotate(num_hosts=Count('profile')).order_by('profile'),
-
-        features = features,
-        langs    = langs,
-        keywords = keywords,
-    )
+    context = dict(data, generated_at=generated_at)
 
     return render(request, 'stats/overall_stats.html', context)
 
@@ -150,7 +144,7 @@ def host_details(request, host_id):
         )
 
     context = dict(
-        host = get_object_or_404( Host.objects.select_related('submissions')
+        host = get_object_or_404( Host.objects.select_related('latest_submission')
                                 , id = host_id
         ),
     )
@@ -212,8 +206,8 @@ def server_stats(request):
     """
 
     context = dict(
-        mirror_servers = MirrorServer.objects.all(),
-        sync_servers   = SyncServer.objects.all(),
+        mirror_servers = with_rollups(MirrorServer.objects.all(), 'mirrors'),
+        sync_servers   = with_rollups(SyncServer.objects.all(), 'syncs'),
     )
 
     return render(request, 'stats/server_stats.html', context)
@@ -252,7 +246,7 @@ def repository_stats(request):
     """
 
     context = dict(
-        repositories = Repository.objects.all(),
+        repositories = with_rollups(Repository.objects.all(), 'repositories'),
     )
 
     return render(request, 'stats/repository_stats.html', context)
@@ -328,8 +322,7 @@ def use_stats(request):
     Global USE flag stats.
     """
 
-    latest_submission_q = Q(submissions__in=Submission.objects.latest_submission_ids)
-    use_stats = UseFlag.objects.filter(latest_submission_q).annotate(num_hosts_fast=Count('submissions')).order_by('name')
+    use_stats = UseFlag.objects.filter(rollup__num_hosts__gt=0).select_related('rollup').order_by('name')
 
     context = dict(
         use_stats = use_stats,
@@ -379,132 +372,13 @@ def profile_details(request, profile):
     return render(request, 'stats/generic_details.html', context)
 
 @cache_control(public=True)
-#@cache_page(10 * 60) # TODO: uncomment this in production
-@cache_page(0)
+@cache_page(10 * 60)
 def app_stats(request, dead=False):
-    stats = [
-        [ 'Browsers'
-        ,   ['Chrome', 'www-client/google-chrome', 'www-client/chromium']
-        ,   ['Firefox', 'www-client/firefox', 'www-client/firefox-bin']
-        ,   ['Opera', 'www-client/opera']
-        ,   ['Epiphany', 'www-client/epiphany']
-        ,   ['Konqueror', 'kde-base/konqueror']
-        ,   ['rekonq', 'www-client/rekonq']
-        ,   ['Conkeror', 'www-client/conkeror']
-        ,   ['Midori', 'www-client/midori']
-        ,   ['Uzbl', 'www-client/uzbl']
-        ],
-
-        [ 'CLI Browsers'
-        ,   ['Wget', 'net-misc/wget']
-        ,   ['cURL', 'net-misc/curl']
-        ,   ['Lynx', 'www-client/lynx']
-        ,   ['Links', 'www-client/links']
-        ,   ['ELinks', 'www-client/elinks']
-        ,   ['W3M', 'www-client/w3m', 'www-client/w3mmee']
-        ],
-
-        [ 'Editors/IDEs'
-        ,   ['Vi/Vim', 'app-editors/vim', 'app-editors/gvim', 'app-editors/nvi', 'app-editors/elvis']
-        ,   ['Emacs', 'app-editors/emacs', 'app-editors/qemacs', 'app-editors/xemacs', 'app-editors/jove']
-        ,   ['Eclipse', 'dev-util/eclipse-sdk']
-        ,   ['Yi', 'app-editors/yi']
-        ,   ['Nano', 'app-editors/nano']
-        ,   ['Gedit', 'app-editors/gedit']
-        ,   ['Kate', 'kde-base/kate']
-        ,   ['Kwrite', 'kde-base/kwrite']
-        ,   ['Ne', 'app-editors/ne']
-        ,   ['Jed', 'app-editors/jed']
-        ,   ['Jedit', 'app-editors/jedit']
-        ,   ['Joe', 'app-editors/joe']
-        ,   ['Ed', 'sys-apps/ed']
-        ,   ['Leafpad', 'app-editors/leafpad']
-        ,   ['Geany', 'dev-util/geany']
-        ],
-
-        [ 'Desktop Environments'
-        ,   ['KDE SC', 'kde-base/kdebase-meta']
-        ,   ['GNOME', 'gnome-base/gnome']
-        ,   ['Xfce', 'xfce-base/xfce4-meta']
-        ,   ['LXDE', 'lxde-base/lxde-meta']
-        #,   ['E17', 'dev-libs/ecore']
-        ],
-
-        [ 'Window Managers'
-        ,   ['Xmonad', 'x11-wm/xmonad']
-        ,   ['Ratpoison', 'x11-wm/ratpoison']
-        ,   ['Openbox', 'x11-wm/openbox']
-        ,   ['Fluxbox', 'x11-wm/fluxbox']
-        ,   ['Enlightenment', 'x11-wm/enlightenment']
-        ,   ['dwm', 'x11-wm/dwm']
-        ,   ['i3', 'x11-wm/i3']
-        ,   ['Compiz', 'x11-wm/compiz', 'x11-wm/compiz-fusion']
-        ,   ['FVWM', 'x11-wm/fvwm']
-        ,   ['Wmii', 'x11-wm/wmii']
-        ,   ['Window Maker', 'x11-wm/windowmaker']
-        ,   ['subtle', 'x11-wm/subtle']
-        ,   ['awesome', 'x11-wm/awesome']
-        ,   ['evilwm', 'x11-wm/evilwm']
-        ,   ['IceWM', 'x11-wm/icewm']
-        ],
-
-        [ 'Shells'
-        ,   ['Bash', 'app-shells/bash']
-        ,   ['Zsh', 'app-shells/zsh']
-        ,   ['Tcsh', 'app-shells/tcsh']
-        ,   ['fish', 'app-shells/fish']
-        ],
-
-        [ 'Web servers'
-        ,   ['Apache', 'www-servers/apache']
-        ,   ['Nginx', 'www-servers/nginx']
-        ,   ['lighttpd', 'www-servers/lighttpd']
-        ],
-
-        [ 'Graphics Drivers'
-        ,   ['Nvidia (proprietary)', 'x11-drivers/nvidia-drivers']
-        ,   ['Nouveau', 'x11-drivers/xf86-video-nouveau']
-        ,   ['fglrx (proprietary)', 'x11-drivers/ati-drivers']
-        ,   ['radeon', 'x11-drivers/xf86-video-ati']
-        ,   ['Intel', 'x11-drivers/xf86-video-intel']
-        ],
-    ]
-
-    delta = datetime.timedelta(days=FRESH_SUBMISSION_MAX_AGE)
-    submission_age = datetime.datetime.utcnow().replace(tzinfo=utc) - delta
-
-    fresh_submissions_qs = Submission.objects.latest_submissions.filter(datetime__gte=submission_age)
-    num_hosts = fresh_submissions_qs.count()
-
-    def percentify(n):
-        # TODO: uncomment this in production.
-        # return round(100 * n / num_hosts)
-
-        import random
-        return random.randint(0, 100)
-
-    for section in stats:
-        cat, apps = split_list(section)
-        for app in apps:
-            # Turn this: ['Vi/Vim', 'app-editors/vim', 'app-editors/gvim', ...]
-            # into this: [('Vi/Vim', nT), ('app-editors/vim', n1), ('app-editors/gvim', n2), ...]
-            # 'nT' is the total percentage of hosts with this app, calculated by
-            # chaining Q objects. n1, n2, etc. are also percentages.
-
-            q_list = []
-            name, pkgs = split_list(app)
-
-            for index, pkg in enumerate(pkgs):
-                q_list.append(Q(installations__package__cp=pkg))
-
-                num = fresh_submissions_qs.filter(installations__package__cp=pkg).count()
-                app[index+1] = (pkg, percentify(num))
-
-            num_total = fresh_submissions_qs.filter(reduce(operator.or_, q_list)).distinct().count()
-            app[0] = (name, percentify(num_total))
-
-        # sort 'apps' by each app's usage percentage:
-        section[1:] = sorted(apps, key=lambda x: x[0][1], reverse=True)
+    """
+    Show the popularity of the applications of the app catalog (see .apps).
+    """
+
+    num_hosts, stats = cached_app_stats()
 
     context = dict(
         num_hosts = num_hosts,